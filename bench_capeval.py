@@ -0,0 +1,200 @@
+"""
+Benchmarks for capeval on synthetic data, run fully offline.
+
+Times loading the CAPE data, opening and saving the price cache, price
+lookups, the simulation (step and event engines) and the plots (interactive and headless) over a grid
+of investor and month counts, and records the results as JSON so that runs
+from different commits can be compared:
+
+    python bench_capeval.py --output before.json
+    python bench_capeval.py --output after.json --compare before.json
+
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy
+from matplotlib import pyplot as plt
+
+import capeval
+
+INDEX = 'BENCH'
+
+
+def write_pe_file(filename, months, seed=0):
+    """Write `months` rows of made up CAPE data and return the first date"""
+    start_year = min(1871, 9990 - months // 12)
+    rng = numpy.random.RandomState(seed)
+    pe_ratios = 10. + 30. * rng.random_sample(months)
+    with open(filename, 'w') as fp:
+        for i, pe in enumerate(pe_ratios):
+            fp.write('{:02d}/{},{:0.2f}\n'.format(
+                i % 12 + 1, start_year + i // 12, pe))
+    return datetime(start_year, 1, 1)
+
+
+def write_price_file(filename, start, months, seed=0):
+    """Write made up daily prices covering `months` months from `start`"""
+    first = numpy.datetime64(start, 'D') - 14
+    last = (numpy.datetime64(start, 'M') + months + 2).astype('datetime64[D]')
+    dates = numpy.arange(first, last)
+    dates = dates[numpy.is_busday(dates)]
+    rng = numpy.random.RandomState(seed)
+    data = numpy.empty(len(dates), dtype=[('date', 'M8[D]'), ('price', 'f8')])
+    data['date'] = dates
+    data['price'] = 100. * numpy.exp(numpy.cumsum(
+        0.0002 + 0.01 * rng.standard_normal(len(dates))))
+    numpy.save(filename, data)
+
+
+def timed(func, repeat):
+    """Best wall time of `repeat` calls of `func`"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_months(months, investor_counts, args):
+    """Run every benchmark for one data length, returning result dicts"""
+    results = []
+
+    def record(name, seconds, investors=None):
+        results.append({'name': name, 'months': months,
+                        'investors': investors, 'seconds': seconds})
+        print('{:<24} months={:<8} investors={:<8} {:10.4f}s'.format(
+            name, months, investors or '-', seconds))
+
+    pe_file = os.path.abspath('pe_{}.csv'.format(months))
+    start = write_pe_file(pe_file, months)
+    write_price_file('{}.npy'.format(INDEX), start, months)
+    source = capeval.LocalPriceSource('{index}.npy')
+    end = datetime(9999, 1, 1)
+
+    record('load_pe_data', timed(
+        lambda: capeval.load_pe_data(pe_file, start, end, use_cache=False),
+        args.repeat))
+    capeval.load_pe_data(pe_file)
+    record('load_pe_data_cached', timed(
+        lambda: capeval.load_pe_data(pe_file, start, end), args.repeat))
+
+    # the first run fills the price cache from the price source
+    base = capeval.CapeValidator(pe_file, start, [], end_date=end,
+                                 index=INDEX, price_source=source)
+    dates = base._pe_datetimes()
+    record('fetch_prices_cold', timed(
+        lambda: base._get_market_prices(dates), 1))
+    record('save_index_cache', timed(base.save_index_cache, 1))
+    record('load_index_cache', timed(base.load_index_cache, args.repeat))
+    record('get_market_prices', timed(
+        lambda: base._get_market_prices(dates), args.repeat))
+    record('plot_pe_ratio', timed(
+        lambda: plt.close(base.plot_pe_ratio()), args.repeat))
+
+    for investors in investor_counts:
+        if investors * months > args.max_cells:
+            print('skipping {} investors x {} months (> --max_cells)'.format(
+                investors, months))
+            continue
+        buys = numpy.linspace(10., 40., investors)
+        validator = capeval.CapeValidator(
+            pe_file, start, buys, end_date=end, index=INDEX,
+            price_source=source)
+        record('calculate_worth_vs_time', timed(
+            validator.calculate_worth_vs_time, args.repeat), investors)
+        pe_ratios, prices = validator.pe_ratios, validator.market_prices
+        record('simulate_events', timed(
+            lambda: capeval.simulate_events(pe_ratios, prices, buys),
+            args.repeat), investors)
+        if investors <= args.max_plot_investors:
+            record('plot_worth_vs_time', timed(
+                lambda: plt.close(validator.plot_worth_vs_time()),
+                args.repeat), investors)
+        record('render_worth_vs_time', timed(
+            lambda: validator.render_worth_vs_time('worth.png'),
+            args.repeat), investors)
+        del validator
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print the ratio of each timing to the matching one in `baseline`"""
+    key = lambda r: (r['name'], r['months'], r['investors'])
+    before = dict((key(r), r['seconds']) for r in baseline['results'])
+    print('\ncompared to {}:'.format(baseline.get('commit')))
+    for result in results:
+        if key(result) in before and before[key(result)]:
+            print('{:<24} months={:<8} investors={:<8} {:8.2f}x'.format(
+                result['name'], result['months'], result['investors'] or '-',
+                result['seconds'] / before[key(result)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="capeval benchmarks")
+    parser.add_argument('--investors', default='10,100,1000,10000,100000',
+                        help='comma separated investor counts')
+    parser.add_argument('--months', default='100,1000,10000,100000',
+                        help='comma separated month counts')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max_cells', type=float, default=2e7,
+                        help='skip investors x months combinations larger '
+                             'than this')
+    parser.add_argument('--max_plot_investors', type=int, default=100)
+    parser.add_argument('--output', default=None,
+                        help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of an earlier run to compare to')
+    args = parser.parse_args()
+
+    investor_counts = [int(x) for x in args.investors.split(',')]
+    results = []
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for months in [int(x) for x in args.months.split(',')]:
+            results.extend(bench_months(months, investor_counts, args))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,764 @@
 import argparse
+import copy
+import functools
+import hashlib
+import json
 import os
 import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from matplotlib.dates import YearLocator, DateFormatter, MonthLocator
+from urllib.parse import quote, urlsplit
 
 import numpy
-from matplotlib import pyplot as plt
-from pandas.io.data import get_data_yahoo
+
+# matplotlib, pandas, asyncio, http.client and concurrent.futures are only
+# imported where they are used, so that simulation-only use and pool workers
+# start quickly
+
+try:
+    import fcntl
+except ImportError:  # pragma no cover
+    fcntl = None
+
+
+class RunStats(object):
+    """Wall time per phase and event counters collected during a run. Cheap
+    enough to always be on.
+
+    `timings` maps phase names to accumulated seconds (phases may nest, e.g.
+    `sweep` includes the `fetch_prices` it triggers), `counters` maps event
+    names to counts and `peak_matrix_bytes` is the largest size the result
+    matrices reached.
+
+    """
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.peak_matrix_bytes = 0
+
+    @contextmanager
+    def phase(self, name):
+        """Add the wall time spent in the `with` block to phase `name`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.) + \
+                time.perf_counter() - start
+
+    def count(self, name, n=1):
+        """Add `n` to the counter `name`"""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_matrix_bytes(self, nbytes):
+        self.peak_matrix_bytes = max(self.peak_matrix_bytes, nbytes)
+
+    def as_dict(self):
+        return {'timings': dict(self.timings),
+                'counters': dict(self.counters),
+                'peak_matrix_bytes': self.peak_matrix_bytes}
+
+    def save_json(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump(self.as_dict(), fp, indent=2, sort_keys=True)
+
+
+def _phase(name):
+    """Decorator that records the wall time of a method in `self.stats`"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stats.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _pe_cache_filename(pe_data_file):
+    directory, basename = os.path.split(pe_data_file)
+    return os.path.join(directory, '.{}.npz'.format(basename))
+
+
+def _atomic_save(filename, save, *args, **kwargs):
+    """Write a file with `save(fp, ...)` and move it into place atomically"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile(
+            dir=directory, suffix='.tmp', delete=False) as fp:
+        save(fp, *args, **kwargs)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(fp.name, filename)
+
+
+def parse_pe_data(text):
+    """Parse the contents of a CAPE data file (`MM/YYYY,pe` rows) into
+    `(dates, pe_ratios)` arrays.
+
+    The CAPE for a given month is the average of prices over the entire
+    month, so each row is dated at the first weekday after the month ends.
+
+    """
+    # fields may be padded with whitespace, e.g. `01/1881, 18.47`
+    rows = []
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        fields = re.split(r'[\s,/]+', line.strip())
+        if len(fields) != 3:
+            raise ValueError("Line {} of the pe data has {} fields instead "
+                             "of MM/YYYY,pe: {!r}".format(
+                                 number, len(fields), line))
+        rows.append(fields)
+    if not rows:
+        return (numpy.empty(0, dtype='datetime64[D]'), numpy.empty(0))
+    values = numpy.array(rows, dtype=float)
+    months = (values[:, 1].astype(int) - 1970) * 12 + \
+        values[:, 0].astype(int) - 1
+    month_ends = (months + 1).astype('datetime64[M]').astype('datetime64[D]')
+    dates = numpy.busday_offset(month_ends, 0, roll='forward')
+    return dates, values[:, 2]
+
+
+def load_pe_data(pe_data_file, start_date=None, end_date=None,
+                 use_cache=True):
+    """Load the CAPE data from the specified file as `(dates, pe_ratios)`
+    arrays, keeping only the dates between `start_date` and `end_date`
+    (inclusive) when given.
+
+    With `use_cache`, the parsed arrays are kept in a hidden `.npz` file next
+    to the csv and reused for as long as the csv is not modified.
+
+    """
+    stat = os.stat(pe_data_file)
+    key = numpy.array([stat.st_mtime_ns, stat.st_size])
+    cache_filename = _pe_cache_filename(pe_data_file)
+    dates = None
+    if use_cache and os.path.exists(cache_filename):
+        with numpy.load(cache_filename) as cache:
+            if (cache['key'] == key).all():
+                dates = cache['dates'].astype('datetime64[D]')
+                pe_ratios = cache['pe_ratios']
+    if dates is None:
+        with open(pe_data_file) as fp:
+            dates, pe_ratios = parse_pe_data(fp.read())
+        if use_cache:
+            try:
+                _atomic_save(cache_filename, numpy.savez, key=key,
+                             dates=dates.astype('int64'),
+                             pe_ratios=pe_ratios)
+            except OSError:  # pragma no cover
+                pass  # e.g. a read-only directory, just don't cache
+    lo, hi = 0, len(dates)
+    timestamps = dates.astype('datetime64[us]')
+    if start_date is not None:
+        lo = numpy.searchsorted(
+            timestamps, numpy.datetime64(start_date, 'us'), 'left')
+    if end_date is not None:
+        hi = numpy.searchsorted(
+            timestamps, numpy.datetime64(end_date, 'us'), 'right')
+    return dates[lo:hi], pe_ratios[lo:hi]
+
+
+def _parse_price_csv(text):
+    """Parse `YYYY-MM-DD,price` rows into sorted `(dates, prices)` arrays. A
+    header row is allowed, in which case the `Adj Close` column is used if
+    there is one (as in yahoo csv exports).
+
+    """
+    rows = [line.strip().split(',') for line in text.splitlines()
+            if line.strip()]
+    column = 1
+    if rows and not rows[0][0][:1].isdigit():
+        header = rows.pop(0)
+        if 'Adj Close' in header:
+            column = header.index('Adj Close')
+    dates = numpy.array([row[0] for row in rows], dtype='datetime64[D]')
+    prices = numpy.array([float(row[column]) for row in rows])
+    order = numpy.argsort(dates, kind='mergesort')
+    return dates[order], prices[order]
+
+
+class PriceFetchError(IOError):
+    """Prices could not be fetched, even after retrying"""
+
+
+class PriceSource(object):
+    """Interface for loading the daily prices of an index in bulk.
+
+    Sources that make requests count them (and any retries) in `stats` when
+    it is set to a `RunStats`, which `CapeValidator` does.
+
+    """
+    stats = None
+
+    def _count(self, name):
+        if self.stats is not None:
+            self.stats.count(name)
+
+    def load(self, index, start, end):
+        """Return the closing prices of `index` for every trading day between
+        `start` and `end` (inclusive) as a `(dates, prices)` pair of sorted
+        numpy arrays (datetime64[D] and float64 respectively).
+
+        """
+        raise NotImplementedError
+
+    def load_ranges(self, index, ranges):
+        """Load several `(start, end)` ranges at once, returning a `(dates,
+        prices)` pair for each. By default this makes a single `load` of the
+        span covering all of them.
+
+        """
+        dates, prices = self.load(index, min(start for start, _ in ranges),
+                                  max(end for _, end in ranges))
+        results = []
+        for start, end in ranges:
+            lo = numpy.searchsorted(dates, numpy.datetime64(start, 'D'),
+                                    'left')
+            hi = numpy.searchsorted(dates, numpy.datetime64(end, 'D'), 'right')
+            results.append((dates[lo:hi], prices[lo:hi]))
+        return results
+
+
+class YahooPriceSource(PriceSource):
+    """Fetches adjusted closing prices from yahoo, one request per range"""
+
+    def load(self, index, start, end):
+        from pandas.io.data import get_data_yahoo
+        self._count('fetch_requests')
+        df = get_data_yahoo(index, start, end)
+        dates = numpy.array(df.index, dtype='datetime64[D]')
+        prices = numpy.asarray(df['Adj Close'], dtype=float)
+        order = numpy.argsort(dates, kind='mergesort')
+        return dates[order], prices[order]
+
+
+class LocalPriceSource(PriceSource):
+    """Reads prices from local files so that a backtest can run offline.
+
+    :param path str     filename of the price data. May contain an `{index}`
+        placeholder to keep several indices side by side. Files ending in
+        `.npy` must hold a structured array with `date` and `price` fields;
+        anything else is read as csv with `YYYY-MM-DD,price` rows. A csv
+        header row is allowed, in which case the `Adj Close` column is used
+        if there is one (so yahoo csv exports can be used as is).
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._series = {}
+
+    def _read_csv(self, filename):
+        with open(filename) as fp:
+            return _parse_price_csv(fp.read())
+
+    def _read_npy(self, filename):
+        data = numpy.load(filename)
+        return (data['date'].astype('datetime64[D]'),
+                data['price'].astype(float))
+
+    def _get_series(self, index):
+        if index not in self._series:
+            filename = self.path.format(index=index)
+            if filename.endswith('.npy'):
+                dates, prices = self._read_npy(filename)
+            else:
+                dates, prices = self._read_csv(filename)
+            order = numpy.argsort(dates, kind='mergesort')
+            self._series[index] = dates[order], prices[order]
+        return self._series[index]
+
+    def load(self, index, start, end):
+        dates, prices = self._get_series(index)
+        lo = numpy.searchsorted(dates, numpy.datetime64(start, 'D'), 'left')
+        hi = numpy.searchsorted(dates, numpy.datetime64(end, 'D'), 'right')
+        return dates[lo:hi], prices[lo:hi]
+
+
+class AsyncHttpPriceSource(PriceSource):
+    """Fetches csv price data over HTTP, requesting many ranges concurrently.
+
+    Requests are made with asyncio over a pool of keep-alive connections,
+    with at most `max_in_flight` requests at a time. Failed requests
+    (connection errors, 5xx and 429 responses) are retried up to `retries`
+    times, waiting `backoff * 2 ** attempt` seconds in between, after which
+    a `PriceFetchError` is raised. Other error responses fail immediately.
+
+    :param url  str     url of the csv price data for a range. Formatted with
+        `index`, `start` and `end` (datetimes) as well as `start_month` and
+        `end_month` (zero based, as the yahoo api expects).
+    :param max_in_flight    int     maximum number of concurrent requests
+    :param retries  int     number of times to retry a failed request
+    :param backoff  float   seconds to wait before the first retry
+    :param timeout  float   socket timeout in seconds
+
+    """
+    yahoo_url = ('http://ichart.finance.yahoo.com/table.csv?s={index}'
+                 '&a={start_month}&b={start.day}&c={start.year}'
+                 '&d={end_month}&e={end.day}&f={end.year}&g=d&ignore=.csv')
+
+    def __init__(self, url=yahoo_url, max_in_flight=8, retries=4,
+                 backoff=0.5, timeout=30.):
+        self.url = url
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def load(self, index, start, end):
+        return self.load_ranges(index, [(start, end)])[0]
+
+    def load_ranges(self, index, ranges):
+        import asyncio
+        return asyncio.run(self._fetch_all(index, ranges))
+
+    def _connect(self):
+        import http.client
+        parts = urlsplit(self.url)
+        if parts.scheme == 'https':
+            return http.client.HTTPSConnection(
+                parts.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(parts.netloc, timeout=self.timeout)
+
+    def _request(self, connection, url):
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    async def _fetch_all(self, index, ranges):
+        import asyncio
+        pool = asyncio.Queue()
+        for _ in range(max(1, min(self.max_in_flight, len(ranges)))):
+            pool.put_nowait(None)
+        try:
+            return await asyncio.gather(
+                *[self._fetch(pool, index, start, end)
+                  for start, end in ranges])
+        finally:
+            while not pool.empty():
+                connection = pool.get_nowait()
+                if connection is not None:
+                    connection.close()
+
+    async def _fetch(self, pool, index, start, end):
+        import asyncio
+        import http.client
+        url = self.url.format(
+            index=quote(index), start=start, end=end,
+            start_month=start.month - 1, end_month=end.month - 1)
+        loop = asyncio.get_running_loop()
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count('fetch_retries')
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            self._count('fetch_requests')
+            # taking a connection from the pool caps the requests in flight
+            connection = await pool.get()
+            try:
+                if connection is None:
+                    connection = self._connect()
+                status, body = await loop.run_in_executor(
+                    None, self._request, connection, url)
+            except (OSError, http.client.HTTPException) as exc:
+                if connection is not None:
+                    connection.close()
+                connection = None
+                error = exc
+                continue
+            finally:
+                pool.put_nowait(connection)
+            if status == 200:
+                try:
+                    return _parse_price_csv(body.decode('utf-8'))
+                except (ValueError, IndexError) as exc:
+                    # e.g. an html error page, which retrying will not fix
+                    error = 'invalid price csv ({})'.format(exc)
+                    break
+            error = 'HTTP {}'.format(status)
+            if status != 429 and status < 500:
+                break
+        raise PriceFetchError(
+            'Failed to fetch {} prices from {:%Y-%m-%d} to {:%Y-%m-%d}: '
+            '{}'.format(index, start, end, error))
+
+
+class PriceStore(object):
+    """On-disk cache of daily index prices, usable like a `{date: price}`
+    dict.
+
+    Prices are kept as an `.npy` file of records with sorted int64 dates
+    (days since the epoch) and float64 prices, which is memory-mapped on
+    open, so opening the store costs the same whatever its size. Prices that
+    are set are held in memory until `flush`, which merges them into the
+    file. Existing entries are never rewritten and nothing is written when
+    there is nothing new. The merged file is written next to the old one
+    and moved into place atomically while holding an exclusive lock, so
+    several processes can safely share one store.
+
+    :param filename str     path of the store
+
+    """
+    dtype = numpy.dtype([('date', '<i8'), ('price', '<f8')])
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._pending = {}
+        self._records = self._read()
+
+    @staticmethod
+    def _key(date):
+        return int(numpy.datetime64(date, 'D').astype('int64'))
+
+    def _read(self):
+        if not os.path.exists(self.filename):
+            return numpy.empty(0, dtype=self.dtype)
+        return numpy.load(self.filename, mmap_mode='r')
+
+    def _find(self, key):
+        dates = self._records['date']
+        i = numpy.searchsorted(dates, key)
+        if i < len(dates) and dates[i] == key:
+            return i
+        return None
+
+    def __len__(self):
+        return len(self._records) + sum(
+            1 for key in self._pending if self._find(key) is None)
+
+    def __contains__(self, date):
+        key = self._key(date)
+        return key in self._pending or self._find(key) is not None
+
+    def __getitem__(self, date):
+        key = self._key(date)
+        if key in self._pending:
+            return self._pending[key]
+        i = self._find(key)
+        if i is None:
+            raise KeyError(date)
+        return float(self._records['price'][i])
+
+    def __setitem__(self, date, price):
+        self._pending[self._key(date)] = float(price)
+
+    def get(self, date, default=None):
+        try:
+            return self[date]
+        except KeyError:
+            return default
+
+    def update(self, items):
+        """Set many prices at once from a mapping or (date, price) pairs"""
+        if hasattr(items, 'items'):
+            items = items.items()
+        for date, price in items:
+            self[date] = price
+
+    def series(self):
+        """All stored prices as sorted (datetime64[D], float64) arrays"""
+        records = self._merge(self._records)
+        return (records['date'].astype('datetime64[D]'),
+                numpy.array(records['price']))
+
+    def _merge(self, records):
+        keys = numpy.fromiter(self._pending, dtype='int64',
+                              count=len(self._pending))
+        keys = keys[~numpy.isin(keys, records['date'])]
+        if not len(keys):
+            return records
+        new = numpy.empty(len(keys), dtype=self.dtype)
+        new['date'] = keys
+        new['price'] = [self._pending[key] for key in keys.tolist()]
+        merged = numpy.concatenate([records, new])
+        return merged[numpy.argsort(merged['date'], kind='mergesort')]
+
+    def flush(self):
+        """Merge the prices set since the last flush into the file"""
+        if not self._pending:
+            return
+        with open(self.filename + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # another process may have written since we opened the store
+            current = self._read()
+            merged = self._merge(current)
+            if len(merged) != len(current):
+                _atomic_save(self.filename, numpy.save, merged)
+        self._pending = {}
+        self._records = self._read()
+
+
+class TradingCalendar(object):
+    """Prices of an index on its trading days as dense sorted arrays, with
+    an index from every calendar day in between to the nearest trading day
+    at or before it, so that looking up prices by date is a single array
+    access.
+
+    :param dates    numpy.ndarray   datetime64[D] dates. Dates without a
+        finite price are known market holidays and are kept in `closed`.
+    :param prices   numpy.ndarray   price on each of `dates`
+
+    """
+    def __init__(self, dates, prices):
+        dates = numpy.asarray(dates, dtype='datetime64[D]')
+        prices = numpy.asarray(prices, dtype=float)
+        order = numpy.argsort(dates, kind='mergesort')
+        dates, prices = dates[order], prices[order]
+        keep = numpy.isfinite(prices)
+        self.dates, self.prices = dates[keep], prices[keep]
+        self.closed = dates[~keep]
+        if len(self.dates):
+            self.first = self.dates[0]
+            days = numpy.arange(self.dates[0], self.dates[-1] + 1)
+        else:
+            self.first = numpy.datetime64(0, 'D')
+            days = numpy.empty(0, dtype='datetime64[D]')
+        self._day_index = numpy.searchsorted(self.dates, days, 'right') - 1
+
+    @classmethod
+    def from_cache(cls, cache):
+        """Calendar of the prices in a `PriceStore` or a dict of prices keyed
+        by datetime
+
+        """
+        if isinstance(cache, PriceStore):
+            return cls(*cache.series())
+        return cls(numpy.array(list(cache), dtype='datetime64[D]'),
+                   numpy.array(list(cache.values()), dtype=float))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def index_of(self, dates):
+        """Index of the nearest trading day at or before each of `dates`, or
+        -1 for dates before the first trading day
+
+        """
+        offsets = (numpy.asarray(dates, dtype='datetime64[D]') -
+                   self.first).astype('int64')
+        if not len(self._day_index):
+            return numpy.full(offsets.shape, -1)
+        return numpy.where(
+            offsets < 0, -1,
+            self._day_index[numpy.clip(offsets, 0, len(self._day_index) - 1)])
+
+    def prices_at(self, dates):
+        """Price on the nearest trading day at or before each of `dates`,
+        NaN before the first trading day
+
+        """
+        index = self.index_of(dates)
+        prices = numpy.full(index.shape, numpy.nan)
+        prices[index >= 0] = self.prices[index[index >= 0]]
+        return prices
+
+    def holidays_skipped(self, dates):
+        """Number of weekdays stepped back over from each of `dates` to its
+        nearest trading day, or -1 where any of those weekdays is not known
+        to be a holiday, or there is no earlier trading day
+
+        """
+        dates = numpy.asarray(dates, dtype='datetime64[D]')
+        index = self.index_of(dates)
+        valid = index >= 0
+        prior = numpy.where(valid, self.dates[numpy.maximum(index, 0)]
+                            if len(self) else dates, dates)
+        skipped = numpy.busday_count(prior + 1, dates + 1)
+        known = (numpy.searchsorted(self.closed, dates, 'right') -
+                 numpy.searchsorted(self.closed, prior, 'right'))
+        return numpy.where(valid & (known == skipped), skipped, -1)
+
+    def between(self, start, end):
+        """`(dates, prices)` of the trading days from `start` to `end`"""
+        lo = numpy.searchsorted(self.dates, numpy.datetime64(start, 'D'))
+        hi = numpy.searchsorted(self.dates, numpy.datetime64(end, 'D'),
+                                'right')
+        return self.dates[lo:hi], self.prices[lo:hi]
+
+
+def daily_pe(pe_dates, pe_ratios, days, method='ffill'):
+    """Pe ratio on each of `days` from the monthly series. With 'ffill' each
+    month's pe applies from its date until the next one. With 'linear' it is
+    interpolated between the months. NaN before the first month.
+
+    """
+    pe_dates = numpy.asarray(pe_dates, dtype='datetime64[D]')
+    pe_ratios = numpy.asarray(pe_ratios, dtype=float)
+    days = numpy.asarray(days, dtype='datetime64[D]')
+    if method == 'ffill':
+        index = numpy.searchsorted(pe_dates, days, 'right') - 1
+        return numpy.where(index >= 0, pe_ratios[numpy.maximum(index, 0)],
+                           numpy.nan)
+    if method == 'linear':
+        x = pe_dates.astype('int64')
+        return numpy.interp(days.astype('int64'), x, pe_ratios,
+                            left=numpy.nan)
+    raise ValueError("Unknown method {!r}".format(method))
+
+
+class ResultCache(object):
+    """On-disk cache of simulation results, so that re-running the same
+    investors over the same data does not recompute them.
+
+    Results are addressed by content: `data_key` hashes the pe and price
+    series a run uses, and within that each investor's result is found by
+    its parameters (buy and sell thresholds, initial cash and shares and
+    income). Every `store` writes one chunk file holding the results of a
+    number of investors, so a run that partly overlaps earlier ones only
+    has to compute the investors that are missing. Looking up a chunk marks
+    it as used, and the least recently used chunks are deleted whenever the
+    cache grows beyond `max_bytes`.
+
+    :param path str     directory of the cache
+    :param max_bytes    int     size the cache is kept under
+
+    """
+    # bump whenever the simulation gives different results for the same
+    # inputs, so that old results are no longer found
+    version = 1
+
+    def __init__(self, path, max_bytes=2 ** 30):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def data_key(self, kind, *arrays):
+        """Hash identifying results of `kind` computed from `arrays`"""
+        digest = hashlib.sha1('{}:{}'.format(self.version, kind).encode())
+        for array in arrays:
+            array = numpy.ascontiguousarray(array)
+            digest.update('{}{}'.format(array.dtype.str,
+                                        array.shape).encode())
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def _chunks(self, data_key):
+        directory = os.path.join(self.path, data_key)
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, name)
+                for name in sorted(os.listdir(directory))
+                if name.endswith('.npz')]
+
+    def lookup(self, data_key, params):
+        """Find the results of the investors given by the rows of `params`.
+        Returns `(found, values)` where `found` is a boolean mask of the
+        rows with a cached result and `values` holds those results, in the
+        order of the rows.
+
+        """
+        params = numpy.ascontiguousarray(params, dtype=float)
+        # look up each distinct row once, duplicates share its result
+        unique, inverse = numpy.unique(params.reshape(len(params), -1),
+                                       axis=0, return_inverse=True)
+        rows = dict((row.tobytes(), i) for i, row in enumerate(unique))
+        found = numpy.zeros(len(unique), dtype=bool)
+        values = None
+        for filename in self._chunks(data_key):
+            if found.all():
+                break
+            try:
+                with numpy.load(filename) as chunk:
+                    # the values are only read from chunks with a match
+                    matches = []
+                    for j, row in enumerate(chunk['params']):
+                        i = rows.get(row.tobytes())
+                        if i is not None and not found[i]:
+                            matches.append((i, j))
+                    if not matches:
+                        continue
+                    chunk_values = chunk['values']
+            except (OSError, ValueError, KeyError):
+                # evicted or replaced by another process meanwhile
+                continue
+            if values is None:
+                values = numpy.empty(
+                    (len(unique),) + chunk_values.shape[1:],
+                    dtype=chunk_values.dtype)
+            for i, j in matches:
+                values[i] = chunk_values[j]
+                found[i] = True
+            try:
+                os.utime(filename)
+            except OSError:
+                pass
+        found, inverse = found[inverse.ravel()], inverse.ravel()
+        if values is None:
+            return found, numpy.empty((0,))
+        return found, values[inverse[found]]
+
+    def store(self, data_key, params, values):
+        """Cache `values`, the results of the investors given by the rows of
+        `params`, then evict old results if the cache is too big
+
+        """
+        params = numpy.ascontiguousarray(params, dtype=float)
+        if not len(params):
+            return
+        params, first = numpy.unique(params.reshape(len(params), -1), axis=0,
+                                     return_index=True)
+        values = numpy.asarray(values)[first]
+        directory = os.path.join(self.path, data_key)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = os.path.join(directory, '{}.npz'.format(
+            hashlib.sha1(params.tobytes()).hexdigest()))
+        _atomic_save(filename, numpy.savez, params=params, values=values)
+        self.evict()
+
+    def size(self):
+        """Total size of the cached results in bytes"""
+        return sum(os.path.getsize(filename)
+                   for filename, _ in self._entries())
+
+    def _entries(self):
+        entries = []
+        if os.path.isdir(self.path):
+            for data_key in os.listdir(self.path):
+                for filename in self._chunks(data_key):
+                    try:
+                        entries.append((filename,
+                                        os.stat(filename).st_mtime_ns))
+                    except OSError:
+                        pass
+        return entries
+
+    def evict(self):
+        """Delete the least recently used results until the cache is no
+        larger than `max_bytes`
+
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        sizes = []
+        for filename, _ in entries:
+            try:
+                sizes.append(os.path.getsize(filename))
+            except OSError:
+                sizes.append(0)
+        total = sum(sizes)
+        for (filename, _), size in zip(entries, sizes):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+
+def _investor_params(buy_at, sell_at, init_cash, shares, income):
+    # rows identifying investors in a `ResultCache`
+    return numpy.column_stack(numpy.broadcast_arrays(
+        *[numpy.asarray(x, dtype=float)
+          for x in (buy_at, sell_at, init_cash, shares, income)]))
 
 
 class Investor(object):
@@ -60,6 +812,865 @@ class Investor(object):
             self.buy_all(market_price)
 
 
+class Strategy(object):
+    """A vectorized investing policy. Subclasses implement `react`, which
+    works on arrays of investor state so that all investors following the
+    strategy are moved forward one month at once. Per investor parameters
+    are arrays with one entry per investor following the strategy, in the
+    order of the suite.
+
+    """
+    def react(self, pe_ratio, market_price, cash, shares, buy_at, sell_at):
+        """Return the `(cash, shares)` arrays after reacting to the month's
+        pe ratio and market price. `buy_at` and `sell_at` are the suite's
+        thresholds of the investors, which a strategy may ignore.
+
+        """
+        raise NotImplementedError
+
+
+class ThresholdStrategy(Strategy):
+    """All in at or below the buy threshold, all out above the sell
+    threshold. The default, mirroring `Investor.react_to_pe`.
+
+    """
+    def react(self, pe_ratio, market_price, cash, shares, buy_at, sell_at):
+        sell = (shares != 0.) & (pe_ratio > sell_at)
+        buy = ~sell & (cash != 0.) & (pe_ratio <= buy_at)
+        cash = numpy.where(sell, cash + market_price * shares, cash)
+        shares = numpy.where(sell, 0., shares)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            shares = numpy.where(buy, shares + cash / market_price, shares)
+        cash = numpy.where(buy, 0., cash)
+        return cash, shares
+
+
+def _rebalance(market_price, cash, shares, fraction):
+    # move to holding `fraction` of net worth in shares
+    worth = cash + shares * market_price
+    return worth * (1. - fraction), worth * fraction / market_price
+
+
+class PeScaledAllocation(Strategy):
+    """Holds a fraction of net worth in shares that falls linearly from all
+    of it at a pe ratio of `low` to none at `high`, rebalancing every month.
+
+    :param low  [float, ...]    pe ratio at or below which to be all in
+    :param high [float, ...]    pe ratio at or above which to be all out
+
+    """
+    def __init__(self, low, high):
+        self.low = numpy.asarray(low, dtype=float)
+        self.high = numpy.asarray(high, dtype=float)
+        if not (self.low < self.high).all():
+            raise ValueError("low must be below high")
+
+    def react(self, pe_ratio, market_price, cash, shares, buy_at, sell_at):
+        fraction = numpy.clip(
+            (self.high - pe_ratio) / (self.high - self.low), 0., 1.)
+        return _rebalance(market_price, cash, shares, fraction)
+
+
+class DollarCostAveraging(Strategy):
+    """Buys shares for up to `amount` of cash every month whatever the pe
+    ratio, and never sells.
+
+    :param amount   [float, ...]    cash to invest per month
+
+    """
+    def __init__(self, amount):
+        self.amount = numpy.asarray(amount, dtype=float)
+
+    def react(self, pe_ratio, market_price, cash, shares, buy_at, sell_at):
+        spend = numpy.minimum(cash, self.amount)
+        return cash - spend, shares + spend / market_price
+
+
+class RebalancingBands(Strategy):
+    """Keeps a `target` fraction of net worth in shares. When the fraction
+    drifts more than `band` away from it, moves `step` of the way back, so
+    a `step` below 1 rebalances gradually.
+
+    :param target   [float, ...]    fraction of net worth to hold in shares
+    :param band [float, ...]    drift tolerated before rebalancing
+    :param step [float, ...]    part of the drift undone per rebalance
+
+    """
+    def __init__(self, target, band=0.05, step=1.):
+        self.target = numpy.asarray(target, dtype=float)
+        self.band = numpy.asarray(band, dtype=float)
+        self.step = numpy.asarray(step, dtype=float)
+
+    def react(self, pe_ratio, market_price, cash, shares, buy_at, sell_at):
+        worth = cash + shares * market_price
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            fraction = numpy.where(worth > 0.,
+                                   shares * market_price / worth,
+                                   self.target)
+        drift = self.target - fraction
+        fraction = numpy.where(numpy.abs(drift) > self.band,
+                               fraction + self.step * drift, fraction)
+        return _rebalance(market_price, cash, shares, fraction)
+
+
+def _group_strategies(strategies):
+    """Group investor positions by strategy, as slices where the investors
+    of a strategy are contiguous and index arrays otherwise
+
+    """
+    groups = {}
+    for i, strategy in enumerate(strategies):
+        groups.setdefault(id(strategy), (strategy, []))[1].append(i)
+    result = []
+    for strategy, positions in groups.values():
+        positions = numpy.array(positions)
+        if positions[-1] - positions[0] + 1 == len(positions):
+            positions = slice(positions[0], positions[-1] + 1)
+        result.append((strategy, positions))
+    return result
+
+
+_THRESHOLD_STRATEGY = ThresholdStrategy()
+
+
+def _take_investors(value, positions):
+    # a per month value, selecting the investors if it varies by investor
+    value = numpy.asarray(value)
+    if value.ndim and value.shape[-1] > 1:
+        return value[..., positions]
+    return value
+
+
+class InvestorSuite(object):
+    """Array-backed equivalent of a list of `Investor` instances. Every
+    attribute is a numpy array with one entry per investor, so the whole
+    suite can be moved forward one month with a handful of vectorized
+    operations. Produces the same results as stepping each `Investor`
+    individually.
+
+    :param buy_at   [float, ...]    buy thresholds
+    :param sell_at  [float, ...]    sell thresholds. If None, will be equal
+        to `buy_at`.
+    :param init_cash [float, ...]   initial cash (scalar or per investor)
+    :param shares   [float, ...]    initial shares (scalar or per investor)
+    :param income   [float, ...]    cash increase on call to `get_paid`
+    :param strategies   [Strategy, ...]     strategy of each investor, or one
+        `Strategy` for all of them. Investors sharing a strategy instance
+        are moved forward together. If None, all use `ThresholdStrategy`.
+
+    """
+    def __init__(self, buy_at, sell_at=None, init_cash=10000., shares=0.,
+                 income=2000., strategies=None):
+        if sell_at is None:
+            sell_at = buy_at
+        arrays = numpy.broadcast_arrays(
+            *[numpy.asarray(x, dtype=float)
+              for x in (buy_at, sell_at, init_cash, shares, income)])
+        self.buy_at, self.sell_at, self.init_cash, shares, self.income = [
+            numpy.array(x) for x in arrays]
+        self.cash = self.init_cash.copy()
+        self.shares = shares
+        count = self.buy_at.shape[-1] if self.buy_at.ndim else 1
+        if isinstance(strategies, Strategy):
+            strategies = [strategies] * count
+        if strategies is not None and len(strategies) != count:
+            raise ValueError("Need one strategy per investor")
+        self.strategies = strategies
+        self._groups = None
+        if strategies is not None and count:
+            self._groups = _group_strategies(strategies)
+
+    @classmethod
+    def from_investors(cls, investors, strategies=None):
+        """Build a suite from the current state of `Investor` instances"""
+        return cls(
+            [inv.buy_at for inv in investors],
+            [inv.sell_at for inv in investors],
+            [inv.cash for inv in investors],
+            [inv.shares for inv in investors],
+            [inv.income for inv in investors],
+            strategies)
+
+    def __len__(self):
+        return len(self.cash)
+
+    def get_paid(self):
+        """Receive the income"""
+        self.cash += self.income
+
+    def get_net_worth(self, market_price):
+        """Total net worth is cash + worth of shares"""
+        return self.cash + self.shares * market_price
+
+    def react_to_pe(self, pe_ratio, market_price):
+        """React to P/E depending on investor thresholds (buy, sell, or hold).
+        Mirrors `Investor.react_to_pe` element-wise, or applies the kernel
+        of each investor's strategy.
+
+        """
+        if self._groups is None:
+            self.cash, self.shares = _THRESHOLD_STRATEGY.react(
+                pe_ratio, market_price, self.cash, self.shares, self.buy_at,
+                self.sell_at)
+            return
+        shape = numpy.broadcast_shapes(
+            numpy.shape(pe_ratio), numpy.shape(market_price),
+            self.cash.shape)
+        cash, shares = numpy.empty(shape), numpy.empty(shape)
+        for strategy, positions in self._groups:
+            key = (Ellipsis, positions)
+            cash[key], shares[key] = strategy.react(
+                _take_investors(pe_ratio, positions),
+                _take_investors(market_price, positions),
+                self.cash[key], self.shares[key], self.buy_at[key],
+                self.sell_at[key])
+        self.cash, self.shares = cash, shares
+
+    def simulate(self, pe_ratios, market_prices, worth=None, shares=None,
+                 cash=None, paid=None):
+        """Step the suite through each (pe_ratio, market_price) pair in turn,
+        writing the state after each month into column `i` of the given
+        `investors x months` output matrices (any of which may be None).
+        When steps are shorter than a month, `paid` flags the steps at which
+        the income is received; by default it is received at every step.
+
+        """
+        if paid is None:
+            paid = numpy.ones(len(pe_ratios), dtype=bool)
+        for i, (pe_ratio, market_price) in enumerate(
+                zip(pe_ratios, market_prices)):
+            if paid[i]:
+                self.get_paid()
+            self.react_to_pe(pe_ratio, market_price)
+            if worth is not None:
+                worth[..., i] = self.get_net_worth(market_price)
+            if shares is not None:
+                shares[..., i] = self.shares
+            if cash is not None:
+                cash[..., i] = self.cash
+
+    def simulate_to(self, output, pe_ratios, market_prices,
+                    chunk_months=256, paid=None):
+        """Step the suite through the months like `simulate`, handing the
+        results to the `SimulationOutput` `output` `chunk_months` months (or
+        steps) at a time, so that only one chunk is held in full precision.
+
+        """
+        months = len(pe_ratios)
+        if paid is None:
+            paid = numpy.ones(months, dtype=bool)
+        buffer = numpy.empty((3, len(self), min(chunk_months, months)))
+        output.record_buffer(buffer)
+        for start in range(0, months, chunk_months):
+            stop = min(start + chunk_months, months)
+            worth, shares, cash = buffer[:, :, :stop - start]
+            self.simulate(pe_ratios[start:stop], market_prices[start:stop],
+                          worth, shares, cash, paid[start:stop])
+            output.write(start, worth, shares, cash)
+
+
+class ResultSummary(object):
+    """Summary statistics of each investor's run.
+
+    :param final_worth  numpy.ndarray   net worth after the last month
+    :param cagr numpy.ndarray   annualized return, see `annualized_return`
+    :param max_drawdown numpy.ndarray   largest fall of net worth from its
+        running peak, as a fraction of the peak
+    :param months_invested  numpy.ndarray   number of months (or steps, for
+        daily runs) holding shares
+
+    """
+    fields = ('final_worth', 'cagr', 'max_drawdown', 'months_invested')
+
+    def __init__(self, final_worth, cagr, max_drawdown, months_invested):
+        self.final_worth = final_worth
+        self.cagr = cagr
+        self.max_drawdown = max_drawdown
+        self.months_invested = months_invested
+
+    def save(self, filename, **arrays):
+        """Save the summary, and any extra `arrays`, to an .npz file"""
+        arrays.update((name, getattr(self, name)) for name in self.fields)
+        numpy.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a summary saved with `save`"""
+        with numpy.load(filename) as data:
+            return cls(*[data[name] for name in cls.fields])
+
+
+class SimulationOutput(object):
+    """Chooses which results of a simulation are kept and how.
+
+    The results are handed over a chunk of months at a time, so they can be
+    stored with less precision or streamed to disk as the simulation runs.
+    The summary statistics are always accumulated in full precision.
+
+    :param outputs  [str, ...]  which of the 'worth', 'shares' and 'cash'
+        matrices to keep. May be empty to only keep the summary.
+    :param dtype    numpy.dtype     dtype of the kept matrices, e.g. float32
+    :param path str     directory to write the kept matrices to as .npy files
+        as they are computed, plus the summary as `summary.npz`. Load them
+        with `SimulationOutput.load`, which memory maps the matrices so that
+        slices can be read without reading the whole file. If None, the
+        matrices are kept in memory.
+
+    """
+    matrices = ('worth', 'shares', 'cash')
+
+    def __init__(self, outputs=matrices, dtype=float, path=None):
+        unknown = set(outputs) - set(self.matrices)
+        if unknown:
+            raise ValueError("Unknown outputs {}".format(sorted(unknown)))
+        self.outputs = tuple(outputs)
+        self.dtype = numpy.dtype(dtype)
+        self.path = path
+        self.worth = self.shares = self.cash = None
+        self.summary = None
+        self._stats = None
+        self._matrix_bytes = 0
+
+    def open(self, investors, months, init_cash=10000., income=2000.,
+             paydays=None, stats=None):
+        """Prepare for the results of `investors` investors over `months`
+        months, or steps. `paydays` is the number of times the income is
+        received, for the annualized return, if not once per step. The size
+        of the matrices kept in memory is recorded in the `RunStats`
+        `stats`, if given.
+
+        """
+        if self.path is not None and not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for name in self.outputs:
+            if self.path is None:
+                matrix = numpy.empty((investors, months), dtype=self.dtype)
+            else:
+                matrix = numpy.lib.format.open_memmap(
+                    os.path.join(self.path, name + '.npy'), mode='w+',
+                    dtype=self.dtype, shape=(investors, months))
+            setattr(self, name, matrix)
+        self._stats = stats
+        self._matrix_bytes = sum(
+            getattr(self, name).nbytes for name in self.outputs
+            if self.path is None)
+        if stats is not None:
+            stats.record_matrix_bytes(self._matrix_bytes)
+        self.months = months
+        self._paydays = months if paydays is None else paydays
+        self._init_cash = init_cash
+        self._income = income
+        self._peak = numpy.full(investors, -numpy.inf)
+        self._max_drawdown = numpy.zeros(investors)
+        self._months_invested = numpy.zeros(investors, dtype='int64')
+        self._final_worth = numpy.array(
+            numpy.broadcast_to(init_cash, investors), dtype=float)
+
+    def record_buffer(self, buffer):
+        """Record the full precision chunk `buffer` the results are handed
+        over in, alongside the kept matrices, in the stats given to `open`
+
+        """
+        if self._stats is not None:
+            self._stats.record_matrix_bytes(self._matrix_bytes +
+                                            buffer.nbytes)
+
+    def write(self, start, worth, shares, cash):
+        """Store the `investors x chunk` results of the months from `start`
+        on
+
+        """
+        stop = start + worth.shape[1]
+        for name, chunk in zip(self.matrices, (worth, shares, cash)):
+            matrix = getattr(self, name)
+            if matrix is not None:
+                matrix[:, start:stop] = chunk
+        if not worth.shape[1]:
+            return
+        peak = numpy.maximum(self._peak[:, numpy.newaxis],
+                             numpy.maximum.accumulate(worth, axis=1))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            drawdown = numpy.where(peak > 0., 1. - worth / peak, 0.)
+        self._max_drawdown = numpy.maximum(self._max_drawdown,
+                                           drawdown.max(axis=1))
+        self._peak = peak[:, -1]
+        self._months_invested += (shares > 0.).sum(axis=1)
+        self._final_worth = worth[:, -1].copy()
+
+    def close(self, **arrays):
+        """Finish the summary, flush the matrices and, when writing to
+        `path`, save the summary and any extra `arrays` (e.g. dates and
+        thresholds) to `summary.npz`. Returns the `ResultSummary`.
+
+        """
+        self.summary = ResultSummary(
+            self._final_worth,
+            annualized_return(self._final_worth, self._paydays,
+                              self._init_cash, self._income),
+            self._max_drawdown, self._months_invested)
+        for name in self.outputs:
+            matrix = getattr(self, name)
+            if isinstance(matrix, numpy.memmap):
+                matrix.flush()
+        if self.path is not None:
+            self.summary.save(os.path.join(self.path, 'summary.npz'),
+                              **arrays)
+        return self.summary
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Open the results written to the directory `path`. The matrices
+        are memory mapped with `mmap_mode`.
+
+        """
+        outputs = [name for name in cls.matrices
+                   if os.path.exists(os.path.join(path, name + '.npy'))]
+        output = cls(outputs, path=path)
+        for name in outputs:
+            setattr(output, name, numpy.load(
+                os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+            output.dtype = getattr(output, name).dtype
+        output.summary = ResultSummary.load(
+            os.path.join(path, 'summary.npz'))
+        return output
+
+
+def _ragged_arange(counts):
+    """Concatenation of `arange(count)` for every count in `counts`"""
+    counts = numpy.asarray(counts, dtype='int64')
+    offsets = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return numpy.arange(counts.sum()) - offsets
+
+
+# how an investor reacts while the pe ratio stays in one zone between its
+# thresholds: buy whenever there is cash, sell whenever there are shares,
+# hold, or (sell threshold below buy threshold) alternate selling and buying
+_BUY, _SELL, _HOLD, _ALTERNATE = range(4)
+
+
+class EventSimulation(object):
+    """Result of `simulate_events`.
+
+    The history of every investor is kept as segments of months in which the
+    pe ratio stays in the same zone relative to the investor's thresholds,
+    with the investor's cash and shares at the start of each segment. The
+    final state is available directly; the full `investors x months` worth,
+    shares and cash matrices are only computed when first accessed.
+
+    """
+    def __init__(self, pe_ratios, market_prices, income, segments, cash,
+                 shares):
+        self.pe_ratios = pe_ratios
+        self.market_prices = market_prices
+        self.income = income
+        (self.seg_investor, self.seg_start, self.seg_end, self.seg_zone,
+         self.seg_cash, self.seg_shares) = segments
+        self.cash = cash
+        self.shares = shares
+        self._matrices = None
+
+    @property
+    def months(self):
+        return len(self.pe_ratios)
+
+    @property
+    def events(self):
+        """Number of segments the history was computed in"""
+        return len(self.seg_start)
+
+    def final_worth(self):
+        if not self.months:
+            return self.cash.copy()
+        return self.cash + self.shares * self.market_prices[-1]
+
+    def materialize(self, worth=None, shares=None, cash=None):
+        """Compute the `investors x months` matrices, writing them into the
+        given arrays if any. Returns `(worth, shares, cash)`.
+
+        """
+        size = (len(self.cash), self.months)
+        worth = numpy.empty(size) if worth is None else worth
+        shares = numpy.empty(size) if shares is None else shares
+        cash = numpy.empty(size) if cash is None else cash
+        if not self.events:
+            return worth, shares, cash
+        prices = self.market_prices
+        inverse = numpy.concatenate([[0.], numpy.cumsum(1. / prices)])
+        t0, zone = self.seg_start, self.seg_zone
+        income = self.income[self.seg_investor]
+        cash0 = self.seg_cash + income
+        shares0 = self.seg_shares
+        price0 = prices[t0]
+        # within a segment cash is `c + d * t` and shares `e + f * inverse`
+        buy, sell = zone == _BUY, zone == _SELL
+        c = numpy.where(buy, 0., cash0 - income * t0 +
+                        numpy.where(sell, price0 * shares0, 0.))
+        d = numpy.where(buy, 0., income)
+        e = numpy.where(buy, shares0 + numpy.where(
+            cash0 != 0., cash0 / price0, 0.) - income * inverse[t0 + 1],
+            numpy.where(sell, 0., shares0))
+        f = numpy.where(buy, income, 0.)
+        # segments are sorted by investor and month and cover every month,
+        # so expanding them gives the cells in row-major order
+        lengths = self.seg_end - t0
+        t = numpy.tile(numpy.arange(self.months), len(self.cash))
+        cell_cash = numpy.repeat(d, lengths)
+        cell_cash *= t
+        cell_cash += numpy.repeat(c, lengths)
+        cell_shares = numpy.repeat(f, lengths)
+        cell_shares *= numpy.tile(inverse[1:], len(self.cash))
+        cell_shares += numpy.repeat(e, lengths)
+
+        alternate = numpy.flatnonzero(zone == _ALTERNATE)
+        if len(alternate):
+            growth, reciprocal = _parity_growth(prices)
+            # sells first while holding shares, like `react_to_pe`
+            q = (t0 + (shares0 == 0.)) % 2
+            seg = numpy.repeat(alternate, lengths[alternate])
+            cells = numpy.repeat(self.seg_investor[alternate] * self.months +
+                                 t0[alternate], lengths[alternate]) + \
+                _ragged_arange(lengths[alternate])
+            cell_t = t[cells]
+            worth0 = cash0[seg] + price0[seg] * shares0[seg]
+            alt_worth = _alternate_worth(growth, reciprocal, q[seg], t0[seg],
+                                         cell_t, worth0, income[seg])
+            sold = cell_t % 2 == q[seg]
+            cell_cash[cells] = numpy.where(sold, alt_worth, 0.)
+            cell_shares[cells] = numpy.where(sold, 0.,
+                                             alt_worth / prices[cell_t])
+
+        shares[...] = cell_shares.reshape(size)
+        cash[...] = cell_cash.reshape(size)
+        worth[...] = cash + shares * prices
+        return worth, shares, cash
+
+    def _get_matrices(self):
+        if self._matrices is None:
+            self._matrices = self.materialize()
+        return self._matrices
+
+    @property
+    def worth_matrix(self):
+        return self._get_matrices()[0]
+
+    @property
+    def shares_matrix(self):
+        return self._get_matrices()[1]
+
+    @property
+    def cash_matrix(self):
+        return self._get_matrices()[2]
+
+
+def _threshold_crossings(pe_ratios, thresholds):
+    """Find the months at which the pe ratio crosses each of the sorted
+    `thresholds` (i.e. `pe <= threshold` changes) in one pass over the
+    series. Returns `(ptr, months)` in compressed form: the crossings of
+    threshold `k` are `months[ptr[k]:ptr[k + 1]]`, in ascending order.
+
+    """
+    low = numpy.minimum(pe_ratios[:-1], pe_ratios[1:])
+    high = numpy.maximum(pe_ratios[:-1], pe_ratios[1:])
+    first = numpy.searchsorted(thresholds, low, 'left')
+    counts = numpy.searchsorted(thresholds, high, 'left') - first
+    months = numpy.repeat(numpy.arange(1, len(pe_ratios)), counts)
+    crossed = numpy.repeat(first, counts) + _ragged_arange(counts)
+    order = numpy.argsort(crossed, kind='mergesort')
+    ptr = numpy.searchsorted(crossed[order], numpy.arange(len(thresholds) + 1))
+    return ptr, months[order]
+
+
+def _parity_growth(prices):
+    """Growth of a holding of shares that is only held over the months of
+    one parity: `growth[q, t]` is the product of `prices[s] / prices[s - 1]`
+    over the months `0 < s <= t` with `s % 2 == q`. Returns `growth` and
+    its running sum of reciprocals, with which an investor alternating
+    between selling (in months of parity `q`) and buying grows in closed
+    form.
+
+    """
+    ratio = numpy.ones((2, len(prices)))
+    ratio[0, 2::2] = prices[2::2] / prices[1:-1:2]
+    ratio[1, 1::2] = prices[1::2] / prices[:-1:2]
+    growth = numpy.cumprod(ratio, axis=1)
+    return growth, numpy.cumsum(1. / growth, axis=1)
+
+
+def _alternate_worth(growth, reciprocal, q, t0, t, worth0, income):
+    # worth at month t of an investor that alternates from month t0 on,
+    # selling in the months of parity q and worth `worth0` after month t0
+    g = growth[q, t]
+    return (worth0 * g / growth[q, t0] +
+            income * g * (reciprocal[q, t] - reciprocal[q, t0]))
+
+
+def _advance_segments(prices, seg_investor, seg_start, seg_end, seg_zone,
+                      cash, shares, income):
+    """Cash and shares of every investor at the start of each of its
+    segments, and at the end.
+
+    Over one segment the cash and shares change by an affine map of their
+    values at its start, including while alternating (see
+    `_parity_growth`). The maps are applied to the k-th segment of every
+    investor at once, so the loop runs once per segment rank rather than
+    once per month. While alternating, whether the investor first sells or
+    buys depends on whether it holds shares, which only depends on the kind
+    and length of its previous segments, so that is found up front.
+
+    """
+    segments = len(seg_start)
+    count = len(cash)
+    first = numpy.searchsorted(seg_investor, numpy.arange(count))
+    rank = numpy.arange(segments) - first[seg_investor]
+    length = seg_end - seg_start
+
+    # holding shares at the start of each segment: set by buying or
+    # selling, kept while holding and flipped by an odd alternating segment
+    setter = (seg_zone == _BUY) | (seg_zone == _SELL)
+    last_set = numpy.maximum.accumulate(
+        numpy.where(setter, numpy.arange(segments), -1)) \
+        if segments else seg_start
+    own = last_set >= first[seg_investor]
+    toggles = numpy.cumsum((seg_zone == _ALTERNATE) & (length % 2 == 1))
+    before = numpy.append(0, toggles)[first[seg_investor]]
+    holds_after = numpy.where(
+        own, seg_zone[last_set] == _BUY, shares[seg_investor] != 0.) ^ \
+        ((toggles - numpy.where(own, toggles[last_set], before)) % 2 == 1)
+    holds = numpy.where(rank == 0, shares[seg_investor] != 0.,
+                        numpy.roll(holds_after, 1))
+
+    # lay the segments out by rank and, within a rank, by investor in order
+    # of decreasing segment count, so that the investors with a k-th
+    # segment are always the first ones and each step of the loop below
+    # works on contiguous slices
+    counts = numpy.diff(numpy.append(first, segments))
+    perm = numpy.argsort(-counts, kind='stable')
+    active = numpy.bincount(rank, minlength=1)
+    offsets = numpy.concatenate([[0], numpy.cumsum(active)])
+    order = first[perm][_ragged_arange(active)] + \
+        numpy.repeat(numpy.arange(len(active)), active)
+    t0, t1, zone = seg_start[order], seg_end[order], seg_zone[order]
+    inc = income[seg_investor[order]]
+    sell_parity = (t0 + ~holds[order]) % 2
+    length = t1 - t0
+    p0 = prices[t0]
+
+    # the affine map of each segment, cash' = ca * cash + cs * shares + cb
+    # and shares' = sa * cash + ss * shares + sb
+    inverse = numpy.concatenate([[0.], numpy.cumsum(1. / prices)])
+    buy, sell, hold = zone == _BUY, zone == _SELL, zone == _HOLD
+    ca = (sell | hold).astype(float)
+    cs = numpy.where(sell, p0, 0.)
+    cb = numpy.where(buy, 0., inc * length)
+    sa = numpy.where(buy, 1. / p0, 0.)
+    ss = (buy | hold).astype(float)
+    sb = numpy.where(buy, inc * (1. / p0 + inverse[t1] - inverse[t0 + 1]), 0.)
+    alternate = numpy.flatnonzero(zone == _ALTERNATE)
+    if len(alternate):
+        growth, reciprocal = _parity_growth(prices)
+        q, start = sell_parity[alternate], t0[alternate]
+        last = t1[alternate] - 1
+        factor = growth[q, last] / growth[q, start]
+        added = inc[alternate] * _alternate_worth(growth, reciprocal, q,
+                                                  start, last, 1., 1.)
+        # ends holding cash after a sale, or shares after a purchase
+        sold = last % 2 == q
+        held = numpy.where(sold, 0., factor / prices[last])
+        ca[alternate] = numpy.where(sold, factor, 0.)
+        cs[alternate] = numpy.where(sold, factor * p0[alternate], 0.)
+        cb[alternate] = numpy.where(sold, added, 0.)
+        sa[alternate] = held
+        ss[alternate] = held * p0[alternate]
+        sb[alternate] = numpy.where(sold, 0., added / prices[last])
+
+    cash, shares = cash[perm], shares[perm]
+    seg_cash = numpy.empty(segments)
+    seg_shares = numpy.empty(segments)
+    for lo, hi in zip(offsets[:-1], offsets[1:]):
+        c, sh = seg_cash[lo:hi], seg_shares[lo:hi]
+        c[...], sh[...] = cash[:hi - lo], shares[:hi - lo]
+        cash[:hi - lo] = ca[lo:hi] * c + cs[lo:hi] * sh + cb[lo:hi]
+        shares[:hi - lo] = sa[lo:hi] * c + ss[lo:hi] * sh + sb[lo:hi]
+    final_cash, final_shares = numpy.empty(count), numpy.empty(count)
+    final_cash[perm], final_shares[perm] = cash, shares
+    seg_cash[order], seg_shares[order] = seg_cash.copy(), seg_shares.copy()
+    return seg_cash, seg_shares, final_cash, final_shares
+
+
+def simulate_events(pe_ratios, market_prices, buy_at, sell_at=None,
+                    init_cash=10000., shares=0., income=2000., block=2048):
+    """Event driven equivalent of `InvestorSuite.simulate`.
+
+    An investor only changes what it does when the pe ratio crosses one of
+    its thresholds, and between two crossings its cash and shares follow in
+    closed form (buying with every income, holding the income as cash,
+    having sold, or alternating between selling and buying). So the
+    crossings of every threshold are found in one sorted pass over the pe
+    series, and then the investors are advanced one segment between
+    crossings at a time, which costs O(crossings) rather than
+    O(investors x months). Results agree with `InvestorSuite.simulate` up to
+    floating point rounding. Returns an `EventSimulation`.
+
+    Each segment costs far more than a month of `InvestorSuite.simulate`,
+    so this only pays off when the investors cross their thresholds much
+    less often than once every few months, e.g. on daily data or with
+    thresholds away from the usual pe ratios. On a dense grid of thresholds
+    around the usual pe ratios the step engine is faster. The investors are
+    simulated `block` at a time, which keeps the working arrays small.
+
+    """
+    pe_ratios = numpy.asarray(pe_ratios, dtype=float)
+    prices = numpy.asarray(market_prices, dtype=float)
+    if sell_at is None:
+        sell_at = buy_at
+    buy_at, sell_at, cash, shares, income = [
+        numpy.array(x) for x in numpy.broadcast_arrays(
+            *[numpy.asarray(x, dtype=float)
+              for x in (buy_at, sell_at, init_cash, shares, income)])]
+    blocks = [_simulate_event_block(
+        pe_ratios, prices, *[x[lo:lo + block] for x in (
+            buy_at, sell_at, cash, shares, income)])
+        for lo in range(0, max(len(buy_at), 1), block)]
+    for k, (segments, _, _) in enumerate(blocks):
+        segments[0] += k * block
+    segments = [numpy.concatenate(x)
+                for x in zip(*[segments for segments, _, _ in blocks])]
+    cash, shares = [numpy.concatenate(x) for x in zip(
+        *[(cash, shares) for _, cash, shares in blocks])]
+    return EventSimulation(pe_ratios, prices, income, segments, cash, shares)
+
+
+def _simulate_event_block(pe_ratios, prices, buy_at, sell_at, cash, shares,
+                          income):
+    # `simulate_events` of one block of investors, returning the segments
+    # and the final cash and shares
+    n, count = len(pe_ratios), len(buy_at)
+    low = numpy.minimum(buy_at, sell_at)
+    high = numpy.maximum(buy_at, sell_at)
+
+    # segment boundaries: month 0 plus every crossing of either threshold
+    thresholds = numpy.unique(numpy.concatenate([low, high]))
+    ptr, crossings = _threshold_crossings(pe_ratios, thresholds)
+    low_k = numpy.searchsorted(thresholds, low)
+    high_k = numpy.searchsorted(thresholds, high)
+    low_counts = ptr[low_k + 1] - ptr[low_k]
+    high_counts = numpy.where(high_k != low_k,
+                              ptr[high_k + 1] - ptr[high_k], 0)
+    investor = numpy.concatenate([
+        numpy.arange(count), numpy.repeat(numpy.arange(count), low_counts),
+        numpy.repeat(numpy.arange(count), high_counts)])
+    month = numpy.concatenate([
+        numpy.zeros(count, dtype='int64'),
+        crossings[numpy.repeat(ptr[low_k], low_counts) +
+                  _ragged_arange(low_counts)],
+        crossings[numpy.repeat(ptr[high_k], high_counts) +
+                  _ragged_arange(high_counts)]])
+    keys = numpy.sort(investor * n + month) if n else month[:0]
+    keys = keys[numpy.append(True, keys[1:] != keys[:-1])[:len(keys)]]
+    seg_investor, seg_start = keys // max(n, 1), keys % max(n, 1)
+    last = numpy.append(seg_investor[1:] != seg_investor[:-1], True)
+    seg_end = numpy.where(last, n, numpy.append(seg_start[1:], n))
+
+    pe0 = pe_ratios[seg_start]
+    j = seg_investor
+    seg_zone = numpy.where(
+        pe0 <= low[j], _BUY, numpy.where(
+            pe0 > high[j], _SELL,
+            numpy.where(buy_at[j] < sell_at[j], _HOLD, _ALTERNATE)))
+    seg_cash, seg_shares, cash, shares = _advance_segments(
+        prices, seg_investor, seg_start, seg_end, seg_zone, cash, shares,
+        income)
+    return ([seg_investor, seg_start, seg_end, seg_zone, seg_cash,
+             seg_shares], cash, shares)
+
+
+def _downsample(values, width):
+    """Reduce the columns of the `lines x points` array `values` to two
+    per bucket of `width` buckets, the minimum and the maximum in their
+    original order, so that peaks still show once drawn `width` pixels
+    wide. Returns `(columns, values)`, both `lines x columns`.
+
+    """
+    lines, points = values.shape
+    if points <= 2 * width:
+        return numpy.broadcast_to(numpy.arange(points), values.shape), values
+    size = -(-points // width)
+    padded = numpy.concatenate(
+        [values, values[:, -1:].repeat(size * width - points, axis=1)],
+        axis=1).reshape(lines, width, size)
+    offsets = numpy.arange(width) * size
+    low = numpy.minimum(offsets + padded.argmin(axis=2), points - 1)
+    high = numpy.minimum(offsets + padded.argmax(axis=2), points - 1)
+    columns = numpy.stack([numpy.minimum(low, high),
+                           numpy.maximum(low, high)], axis=2)
+    columns = columns.reshape(lines, 2 * width)
+    return columns, numpy.take_along_axis(values, columns, axis=1)
+
+
+def _new_figure(width, height, dpi):
+    # figure drawn with Agg independently of pyplot and its backend
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(width / float(dpi), height / float(dpi)), dpi=dpi)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _save_figure(fig, filename):
+    """Write `fig` to `filename`, in the format given by its extension
+    (e.g. png or svg)
+
+    """
+    fig.savefig(filename)
+    return fig
+
+
+def render_lines(dates, values, labels=None, colors=None, title=None,
+                 width=1200, height=600, dpi=100, max_legend=10):
+    """Draw every row of `values` against `dates` as one `LineCollection`
+    on a new Agg figure, downsampled to the pixel width of the plot.
+
+    Up to `max_legend` rows get a legend entry from `labels`. With more rows
+    they are instead colored by `colors`, one value per row, and a colorbar
+    is added.
+
+    """
+    from matplotlib.collections import LineCollection
+    from matplotlib.dates import (AutoDateLocator, ConciseDateFormatter,
+                                  date2num)
+    from matplotlib.lines import Line2D
+    fig = _new_figure(width, height, dpi)
+    ax = fig.add_subplot(1, 1, 1)
+    x = date2num(numpy.asarray(dates, dtype='datetime64[D]'))
+    values = numpy.asarray(values, dtype=float).reshape(-1, len(x))
+    columns, values = _downsample(values, int(width))
+    lines = LineCollection(numpy.stack([x[columns], values], axis=2),
+                           linewidths=1.)
+    if len(values) <= max_legend:
+        lines.set_color(['C{}'.format(i % 10) for i in range(len(values))])
+    elif colors is not None:
+        lines.set_array(numpy.asarray(colors, dtype=float))
+    ax.add_collection(lines)
+    if len(x):
+        ax.set_xlim(x[0], x[-1])
+    if values.size:
+        low, high = numpy.nanmin(values), numpy.nanmax(values)
+        margin = 0.05 * (high - low) or 1.
+        ax.set_ylim(low - margin, high + margin)
+    locator = AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(ConciseDateFormatter(locator))
+    if labels is not None and len(values) <= max_legend:
+        handles = [Line2D([], [], color='C{}'.format(i % 10))
+                   for i in range(len(values))]
+        ax.legend(handles, labels, loc='upper left')
+    elif len(values) > max_legend and colors is not None:
+        fig.colorbar(lines, ax=ax)
+    if title:
+        ax.set_title(title)
+    return fig
+
+
 class CapeValidator(object):
     """
     Compares the performance of a suite of investors with different buy/sell
@@ -75,10 +1686,23 @@ class CapeValidator(object):
     :param end_date datetime    datetime at which to stop analysis. If None,
         will go to current day.
     :param index    str     stock symbol of index to invest in.
+    :param price_source PriceSource     where to load index prices missing
+        from the cache. If None, will fetch them from yahoo.
+    :param strategies   [Strategy, ...]     strategy of each investor, see
+        `InvestorSuite`. If None, all use `ThresholdStrategy`.
+    :param result_cache ResultCache     where to look up results of earlier
+        runs with the same data and investors, and to store new ones. Only
+        used for runs with the default strategy.
+    :param pe_cache bool    whether to keep the parsed CAPE data in a hidden
+        `.npz` file next to `pe_data_file`, see `load_pe_data`
+    :param cache_dir    str     directory of the index price cache. If None,
+        the current directory.
 
     """
     def __init__(self, pe_data_file, start_date, buy_thresholds,
-                 sell_thresholds=None, end_date=None, index='^GSPC'):
+                 sell_thresholds=None, end_date=None, index='^GSPC',
+                 price_source=None, strategies=None, result_cache=None,
+                 pe_cache=True, cache_dir=None):
         if sell_thresholds is None:
             sell_thresholds = [None] * len(buy_thresholds)
         if len(buy_thresholds) != len(sell_thresholds):
@@ -86,113 +1710,651 @@ class CapeValidator(object):
         if end_date is None:
             end_date = datetime.now()
         self.investors = []
-        self.pe_array = []
+        self.strategies = strategies
+        self.result_cache = result_cache
+        self.pe_cache = pe_cache
+        self.cache_dir = cache_dir
+        self.suite = None
+        self.pe_dates = numpy.empty(0, dtype='datetime64[D]')
+        self.pe_ratios = numpy.empty(0)
+        if price_source is None:
+            price_source = YahooPriceSource()
+        self.stats = RunStats()
         self.index = index
         self.index_cache = {}
+        self.price_source = price_source
+        price_source.stats = self.stats
+
+        self.market_prices = numpy.empty(0)
+        self._matrix_buffer = None
+        self._events = None
+        self.output = None
+
+        self.load_pe_array(pe_data_file, start_date, end_date)
+        self.init_investors(buy_thresholds, sell_thresholds)
+        self.load_index_cache()
+
+    def _allocate_matrices(self, months):
+        """Size the buffer behind the worth, shares and cash matrices for
+        `months` months, keeping the results calculated so far. The buffer
+        grows geometrically, so that adding a few months at a time does not
+        reallocate the whole history every time.
+
+        """
+        buffer = self._matrix_buffer
+        if buffer is None or buffer.shape[2] < months:
+            capacity = months
+            if buffer is not None:
+                capacity = max(months, 2 * buffer.shape[2])
+            new_buffer = numpy.empty((3, len(self.investors), capacity))
+            if buffer is not None:
+                new_buffer[:, :, :buffer.shape[2]] = buffer
+            self._matrix_buffer = buffer = new_buffer
+            self.stats.record_matrix_bytes(buffer.nbytes)
+
+    def _matrices(self):
+        """The worth, shares and cash matrices as views on the buffer. The
+        results of an event driven run are written to it on first access.
+
+        """
+        months = len(self.pe_ratios)
+        self._allocate_matrices(months)
+        matrices = self._matrix_buffer[:, :, :months]
+        if self._events is not None:
+            events, self._events = self._events, None
+            with self.stats.phase('materialize'):
+                events.materialize(*matrices[:, :, :events.months])
+        return matrices
+
+    def _matrix(self, name):
+        if self.output is None:
+            return self._matrices()[SimulationOutput.matrices.index(name)]
+        matrix = getattr(self.output, name)
+        if matrix is None:
+            raise ValueError("The {} matrix was not kept, see the outputs "
+                             "of the SimulationOutput".format(name))
+        return matrix
+
+    @property
+    def worth_matrix(self):
+        return self._matrix('worth')
+
+    @property
+    def shares_matrix(self):
+        return self._matrix('shares')
+
+    @property
+    def cash_matrix(self):
+        return self._matrix('cash')
+
+    @property
+    def _cache_filename(self):
+        return os.path.join(self.cache_dir or '',
+                            '.cache_{}.npy'.format(self.index))
+
+    @property
+    def _legacy_cache_filename(self):
+        return os.path.join(self.cache_dir or '',
+                            '.cache_{}.pkl'.format(self.index))
+
+    @_phase('load_pe_data')
+    def load_pe_array(self, pe_data_file, start_date, end_date):
+        """Load the CAPE data from the specified file"""
+        self.pe_dates, self.pe_ratios = load_pe_data(
+            pe_data_file, start_date, end_date, self.pe_cache)
+
+    @property
+    def pe_array(self):
+        """The CAPE data as a list of [date, pe] pairs"""
+        return [list(x) for x in zip(self._pe_datetimes(),
+                                     self.pe_ratios.tolist())]
+
+    def _pe_datetimes(self):
+        return self.pe_dates.astype('datetime64[us]').astype(datetime).tolist()
+
+    def init_investors(self, buy_thresholds, sell_thresholds):
+        """Initialize Investor instances from threshold lists"""
+        for b, s in zip(buy_thresholds, sell_thresholds):
+            self.investors.append(Investor(b, s))
+
+    @_phase('load_index_cache')
+    def load_index_cache(self):
+        """Open the cache for the specified index. A pickled cache left by
+        older versions is imported the first time.
+
+        """
+        self.index_cache = PriceStore(self._cache_filename)
+        if not len(self.index_cache) and \
+                os.path.exists(self._legacy_cache_filename):
+            with open(self._legacy_cache_filename, 'rb') as fp:
+                self.index_cache.update(pickle.load(fp))
+            self.index_cache.flush()
+
+    @_phase('save_index_cache')
+    def save_index_cache(self):
+        """Save any newly loaded prices to disk"""
+        if not isinstance(self.index_cache, PriceStore):
+            store = PriceStore(self._cache_filename)
+            store.update(self.index_cache)
+            self.index_cache = store
+        self.index_cache.flush()
+
+    def load_prices(self, start, end):
+        """Load the index prices between `start` and `end` from the price
+        source into the cache with a single request.
+
+        """
+        with self.stats.phase('fetch_prices'):
+            self._cache_prices(
+                start, end, *self.price_source.load(self.index, start, end))
+
+    def _cache_prices(self, start, end, dates, prices):
+        # weekdays between the first and last price returned without a
+        # price are cached as NaN so that they are known to be market
+        # holidays. Outside of them (or with no prices at all) a missing
+        # day may just as well be a short or failed response.
+        if not len(dates):
+            return
+        closed = numpy.arange(dates.min(), dates.max() + 1)
+        closed = closed[numpy.is_busday(closed)]
+        closed = closed[~numpy.isin(closed, dates)]
+        keys = closed.astype('datetime64[us]').astype(datetime)
+        self.index_cache.update((key, numpy.nan) for key in keys)
+        keys = dates.astype('datetime64[us]').astype(datetime)
+        self.index_cache.update(zip(keys, prices.tolist()))
+
+    def _get_market_price(self, date, try_next=2):
+        """Get the market price for the given date from the cache, loading it
+        from the price source if it is not there yet.
+
+        Accounts for holidays by stepping backwards through time (at most
+        `try_next` times) when the market was closed on the specified date.
+
+        """
+        while date.weekday() > 4:
+            date -= timedelta(1)
+        if date in self.index_cache:
+            self.stats.count('cache_hits')
+        else:
+            self.stats.count('cache_misses')
+            # load the weeks around it so stepping back over holidays is
+            # free, and a holiday lies between the prices returned
+            self.load_prices(date - timedelta(7), date + timedelta(7))
+        return self._resolve_price(date, try_next)
+
+    def _resolve_price(self, date, try_next):
+        # price of a weekday that has been looked up in the cache
+        price = self.index_cache.get(date, numpy.nan)
+        if not numpy.isnan(price):
+            return price
+        if try_next:
+            self.stats.count('holiday_fallbacks')
+            return self._get_market_price(date - timedelta(1), try_next - 1)
+        raise LookupError('No {} price found for {:%Y-%m-%d}'.format(
+            self.index, date))
+
+    def _get_market_prices(self, dates):
+        """Get the market prices for a sequence of dates. Every date missing
+        from the cache is collected first and the weeks around each of them
+        are loaded with one `load_ranges` call on the price source.
+
+        """
+        weekdays = []
+        for date in dates:
+            while date.weekday() > 4:
+                date -= timedelta(1)
+            weekdays.append(date)
+        missing = [date for date in weekdays if date not in self.index_cache]
+        self.stats.count('cache_hits', len(weekdays) - len(missing))
+        self.stats.count('cache_misses', len(missing))
+        ranges = []
+        for date in sorted(missing):
+            start, end = date - timedelta(7), date + timedelta(7)
+            if ranges and start <= ranges[-1][1] + timedelta(1):
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        if ranges:
+            with self.stats.phase('fetch_prices'):
+                results = self.price_source.load_ranges(self.index, ranges)
+                for (start, end), (range_dates, prices) in zip(ranges,
+                                                               results):
+                    self._cache_prices(start, end, range_dates, prices)
+        with self.stats.phase('price_lookup'):
+            return self._resolve_prices(weekdays, 2)
+
+    def _resolve_prices(self, weekdays, try_next):
+        # vectorized `_resolve_price` through a trading calendar of the
+        # cache, leaving only dates it can not settle to the scalar lookup
+        calendar = self.trading_calendar(load=False)
+        days = numpy.array(weekdays, dtype='datetime64[D]')
+        skipped = calendar.holidays_skipped(days)
+        fast = (skipped >= 0) & (skipped <= try_next)
+        prices = numpy.empty(len(days))
+        prices[fast] = calendar.prices_at(days[fast])
+        fallbacks = int(skipped[fast].sum())
+        self.stats.count('holiday_fallbacks', fallbacks)
+        self.stats.count('cache_hits', fallbacks)
+        for i in numpy.flatnonzero(~fast):
+            prices[i] = self._resolve_price(weekdays[i], try_next)
+        return prices
+
+    def trading_calendar(self, load=True):
+        """The `TradingCalendar` of the cached prices of the index. With
+        `load`, the prices of every weekday from the first CAPE month to the
+        last are loaded into the cache first, in one request.
+
+        """
+        if load and len(self.pe_dates):
+            start = self.pe_dates[0].astype('datetime64[M]').astype(
+                'datetime64[D]') - 7
+            days = numpy.arange(start, self.pe_dates[-1] + 1)
+            days = days[numpy.is_busday(days)]
+            cached = TradingCalendar.from_cache(self.index_cache)
+            known = numpy.union1d(cached.dates, cached.closed)
+            missing = days[~numpy.isin(days, known)]
+            if len(missing):
+                self.stats.count('cache_misses', len(missing))
+                self.load_prices(*missing[[0, -1]].astype(
+                    'datetime64[us]').astype(datetime).tolist())
+                self.save_index_cache()
+        return TradingCalendar.from_cache(self.index_cache)
+
+    def calculate_worth_vs_time(self, engine='step', output=None):
+        """Calculate the worth, shares, and cash of all the investors across
+        the specified time interval
+
+        :param engine   str     'step' to simulate month by month, or 'event'
+            to use `simulate_events`, which only computes the matrices when
+            they are first accessed. 'event' is only faster when the
+            investors rarely cross their thresholds.
+        :param output   SimulationOutput    where to keep the results, e.g.
+            only some matrices, as float32 or streamed to disk. The matrix
+            attributes then come from it, and so does its `summary`. Only with
+            the 'step' engine, and the run can not be `advance`d or saved.
+            If None, all three matrices are kept in memory.
+
+        """
+        if engine not in ('step', 'event'):
+            raise ValueError("Unknown engine {!r}".format(engine))
+        if output is not None and engine != 'step':
+            raise ValueError("An output can only be used with the step "
+                             "engine")
+        if self.strategies is not None and engine != 'step':
+            raise ValueError("Strategies can only be used with the step "
+                             "engine")
+        self.market_prices = self._get_market_prices(self._pe_datetimes())
+        self.suite = InvestorSuite.from_investors(self.investors,
+                                                  self.strategies)
+        self._events = None
+        self.output = output
+        if self.result_cache is not None and output is None and \
+                self.strategies is None and len(self.pe_ratios):
+            self._simulate_cached(engine)
+            self.save_index_cache()
+            return
+        with self.stats.phase('simulate'):
+            if output is not None:
+                suite = self.suite
+                output.open(len(suite), len(self.pe_ratios),
+                            suite.cash.copy(), suite.income,
+                            stats=self.stats)
+                suite.simulate_to(output, self.pe_ratios, self.market_prices)
+                output.close(dates=self.pe_dates.astype('int64'),
+                             buy_at=suite.buy_at, sell_at=suite.sell_at)
+            elif engine == 'step':
+                self.suite.simulate(self.pe_ratios, self.market_prices,
+                                    *self._matrices())
+            else:
+                suite = self.suite
+                self._events = simulate_events(
+                    self.pe_ratios, self.market_prices, suite.buy_at,
+                    suite.sell_at, suite.cash, suite.shares, suite.income)
+                suite.cash = self._events.cash
+                suite.shares = self._events.shares
+                self.stats.count('events', self._events.events)
+        self.save_index_cache()
+
+    def _simulate_cached(self, engine):
+        """Fill the matrices from the result cache, simulating only the
+        investors whose results are not in it
+
+        """
+        suite, cache = self.suite, self.result_cache
+        key = cache.data_key('matrices-' + engine,
+                             self.pe_dates.astype('int64'), self.pe_ratios,
+                             self.market_prices)
+        params = _investor_params(suite.buy_at, suite.sell_at, suite.cash,
+                                  suite.shares, suite.income)
+        with self.stats.phase('result_cache'):
+            found, values = cache.lookup(key, params)
+        missing = ~found
+        self.stats.count('result_cache_hits', int(found.sum()))
+        self.stats.count('result_cache_misses', int(missing.sum()))
+        matrices = self._matrices()
+        if found.any():
+            matrices[:, found] = values.transpose(1, 0, 2)
+        if missing.any():
+            with self.stats.phase('simulate'):
+                args = [x[missing] for x in (suite.buy_at, suite.sell_at,
+                                             suite.cash, suite.shares,
+                                             suite.income)]
+                if engine == 'step':
+                    results = numpy.empty(
+                        (3, int(missing.sum()), len(self.pe_ratios)))
+                    InvestorSuite(*args).simulate(
+                        self.pe_ratios, self.market_prices, *results)
+                else:
+                    results = numpy.stack(simulate_events(
+                        self.pe_ratios, self.market_prices,
+                        *args).materialize())
+            matrices[:, missing] = results
+            with self.stats.phase('result_cache'):
+                cache.store(key, params[missing], results.transpose(1, 0, 2))
+        suite.shares = matrices[1, :, -1].copy()
+        suite.cash = matrices[2, :, -1].copy()
+
+    def calculate_daily(self, method='ffill', output=None, chunk_days=4096):
+        """Simulate the investors on every trading day from the first CAPE
+        month to the last instead of once a month. The income is received on
+        the first trading day of each month.
+
+        :param method   str     how the monthly CAPE is spread over the
+            days, see `daily_pe`
+        :param output   SimulationOutput    where to keep the daily results.
+            If None, only the summary is kept.
+        :param chunk_days   int     days simulated per chunk
+
+        Returns the output, the days are in `daily_dates`.
+
+        """
+        if output is None:
+            output = SimulationOutput(outputs=())
+        calendar = self.trading_calendar()
+        if len(self.pe_dates):
+            days, prices = calendar.between(self.pe_dates[0],
+                                            self.pe_dates[-1])
+        else:
+            days, prices = calendar.dates[:0], calendar.prices[:0]
+        pe_ratios = daily_pe(self.pe_dates, self.pe_ratios, days, method)
+        months = days.astype('datetime64[M]')
+        paid = numpy.append(True, months[1:] != months[:-1])[:len(days)]
+        suite = InvestorSuite.from_investors(self.investors, self.strategies)
+        with self.stats.phase('simulate'):
+            output.open(len(suite), len(days), suite.cash.copy(),
+                        suite.income, paydays=int(paid.sum()),
+                        stats=self.stats)
+            suite.simulate_to(output, pe_ratios, prices, chunk_days, paid)
+            output.close(dates=days.astype('int64'), buy_at=suite.buy_at,
+                         sell_at=suite.sell_at)
+        self.daily_dates = days
+        return output
+
+    def advance(self, new_rows):
+        """Simulate new months without recomputing the history.
+
+        `new_rows` are `(MM/YYYY, pe)` pairs as found in the CAPE data file.
+        Months up to the last one simulated so far are ignored; the others
+        are simulated starting from the current investor state and appended
+        to the results. Returns the number of months added. Raises
+        ValueError unless the rows go on month by month, without skipping a
+        month after the last one simulated.
 
-        self.load_pe_array(pe_data_file, start_date, end_date)
-        self.init_investors(buy_thresholds, sell_thresholds)
-        self.load_index_cache()
-        size = (len(self.investors), len(self.pe_array))
-        self.worth_matrix = numpy.empty(size)
-        self.shares_matrix = numpy.empty(size)
-        self.cash_matrix = numpy.empty(size)
+        """
+        if self.suite is None:
+            raise RuntimeError("Nothing to advance, run "
+                               "calculate_worth_vs_time first")
+        if self.output is not None:
+            raise RuntimeError("Can not advance a run with a "
+                               "SimulationOutput")
+        dates, pe_ratios = parse_pe_data('\n'.join(
+            '{},{}'.format(date_str, pe) for date_str, pe in new_rows))
+        if not len(dates):
+            return 0
+        # dates are in the month after the CAPE month they are for
+        months = dates.astype('datetime64[M]').astype('int64')
+        first = months[0] - 1
+        if len(self.pe_dates):
+            # the rows may start before the last month, but not after it
+            first = min(first, self.pe_dates[-1].astype(
+                'datetime64[M]').astype('int64'))
+        previous = numpy.append(first, months[:-1])
+        gaps = numpy.flatnonzero(months != previous + 1)
+        if len(gaps):
+            raise ValueError("Expected the month after {:%m/%Y}, got "
+                             "{:%m/%Y}".format(*[
+                                 (month - 1).astype('datetime64[M]').astype(
+                                     datetime)
+                                 for month in (previous[gaps[0]],
+                                               months[gaps[0]])]))
+        if len(self.pe_dates):
+            new = dates > self.pe_dates[-1]
+            dates, pe_ratios = dates[new], pe_ratios[new]
+        if not len(dates):
+            return 0
+        market_prices = self._get_market_prices(
+            dates.astype('datetime64[us]').astype(datetime).tolist())
+        start = len(self.pe_ratios)
+        self.pe_dates = numpy.concatenate([self.pe_dates, dates])
+        self.pe_ratios = numpy.concatenate([self.pe_ratios, pe_ratios])
+        self.market_prices = numpy.concatenate(
+            [self.market_prices, market_prices])
+        with self.stats.phase('simulate'):
+            self.suite.simulate(pe_ratios, market_prices,
+                                *self._matrices()[:, :, start:])
+        self.save_index_cache()
+        return len(dates)
 
-    @property
-    def _cache_filename(self):
-        return '.cache_{}.pkl'.format(self.index)
-
-    def _parse_pe_date(self, date_str):
-        # the date_str is the beginning of the month, but we want the end
-        # because the CAPE for a given month is the avg of prices for the
-        # entire month
-        date0 = datetime.strptime(date_str, '%m/%Y')
-        date = date0 + timedelta(27)
-        while date.month == date0.month or date.weekday() > 4:
-            date += timedelta(1)
-        return date
+    def save_state(self, path):
+        """Save the investor state and the results to the directory `path`.
 
-    def load_pe_array(self, pe_data_file, start_date, end_date):
-        """Load the CAPE data from the specified file"""
-        with open(pe_data_file) as fp:
-            for line in fp:
-                line = line.strip()
-                if line:
-                    date_str, pe = line.split(',')
-                    pe = float(pe)
-                    date = self._parse_pe_date(date_str)
-                    if start_date <= date <= end_date:
-                        self.pe_array.append([date, pe])
+        Results are stored in chunk files holding a range of months. Months
+        already saved in `path` are not written again, so saving after
+        `advance` only adds a chunk with the new months.
 
-    def init_investors(self, buy_thresholds, sell_thresholds):
-        """Initialize Investor instances from threshold lists"""
-        for b, s in zip(buy_thresholds, sell_thresholds):
-            self.investors.append(Investor(b, s))
+        """
+        if self.suite is None:
+            raise RuntimeError("Nothing to save, run "
+                               "calculate_worth_vs_time first")
+        if self.output is not None:
+            raise RuntimeError("The results of a run with a SimulationOutput "
+                               "are saved by its path")
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        state_filename = os.path.join(path, 'state.npz')
+        identity = {
+            'index': numpy.array(self.index),
+            'buy_at': [inv.buy_at for inv in self.investors],
+            'sell_at': [inv.sell_at for inv in self.investors],
+            'init_cash': [inv.init_cash for inv in self.investors],
+            'init_shares': [inv.shares for inv in self.investors],
+            'income': [inv.income for inv in self.investors],
+        }
+        saved = 0
+        if os.path.exists(state_filename):
+            with numpy.load(state_filename) as state:
+                saved = int(state['months'])
+                same_run = 'dates' in state and all(
+                    numpy.array_equal(state[name], value)
+                    for name, value in identity.items()) and \
+                    numpy.array_equal(state['dates'],
+                                      self.pe_dates[:saved].astype('int64'))
+        months = len(self.pe_ratios)
+        if saved and not same_run:
+            # the results of another run, start over
+            for filename in os.listdir(path):
+                if filename.startswith('chunk_'):
+                    os.remove(os.path.join(path, filename))
+            saved = 0
+        if saved > months:
+            raise ValueError("{} already holds {} months, more than the {} "
+                             "simulated here".format(path, saved, months))
+        if months > saved:
+            _atomic_save(
+                os.path.join(path, 'chunk_{:08d}.npz'.format(saved)),
+                numpy.savez,
+                dates=self.pe_dates[saved:].astype('int64'),
+                pe_ratios=self.pe_ratios[saved:],
+                market_prices=self.market_prices[saved:],
+                worth=self.worth_matrix[:, saved:],
+                shares=self.shares_matrix[:, saved:],
+                cash=self.cash_matrix[:, saved:])
+        _atomic_save(
+            state_filename, numpy.savez, months=months,
+            dates=self.pe_dates.astype('int64'), cash=self.suite.cash,
+            shares=self.suite.shares, **identity)
 
-    def load_index_cache(self):
-        """Load the cache for the specified index, if available"""
-        if os.path.exists(self._cache_filename):
-            with open(self._cache_filename, 'rb') as fp:
-                self.index_cache = pickle.load(fp)
+    @classmethod
+    def from_state(cls, path, price_source=None, strategies=None,
+                   cache_dir=None):
+        """Restore a validator saved with `save_state`, ready to `advance`.
+        Strategies are not saved, so pass the same `strategies` again. The
+        price cache is kept in `cache_dir`, as for `CapeValidator`.
 
-    def save_index_cache(self):
-        """Save the cache to disk"""
-        with open(self._cache_filename, 'wb') as fp:
-            pickle.dump(self.index_cache, fp)
+        """
+        with numpy.load(os.path.join(path, 'state.npz')) as state:
+            state = dict(state)
+        months = int(state['months'])
+        chunks = []
+        for filename in sorted(os.listdir(path)):
+            if filename.startswith('chunk_') and \
+                    int(filename[6:14]) < months:
+                if int(filename[6:14]) != sum(len(c['dates'])
+                                              for c in chunks):
+                    raise ValueError("The chunks in {} do not join up at "
+                                     "{}".format(path, filename))
+                with numpy.load(os.path.join(path, filename)) as chunk:
+                    chunks.append(dict(chunk))
+        dates = numpy.concatenate([c['dates'] for c in chunks]) \
+            if chunks else numpy.empty(0, dtype='int64')
+        if len(dates) != months or 'dates' in state and \
+                not numpy.array_equal(dates, state['dates']):
+            raise ValueError("The chunks in {} do not hold the {} months of "
+                             "the saved run".format(path, months))
 
-    def _get_market_price(self, date, try_next=2):
-        """Get the market price for the given date from yahoo or the cache.
+        validator = cls.__new__(cls)
+        validator.stats = RunStats()
+        validator.index = str(state['index'])
+        validator.price_source = price_source or YahooPriceSource()
+        validator.price_source.stats = validator.stats
+        validator.investors = [
+            Investor(b, s, c, sh, i) for b, s, c, sh, i in zip(
+                state['buy_at'], state['sell_at'], state['init_cash'],
+                state['init_shares'], state['income'])]
+        validator.strategies = strategies
+        validator.result_cache = None
+        validator.cache_dir = cache_dir
+        validator.suite = InvestorSuite(
+            state['buy_at'], state['sell_at'], state['cash'],
+            state['shares'], state['income'], strategies)
+        validator.pe_dates = dates.astype('datetime64[D]')
+        validator.pe_ratios = numpy.concatenate(
+            [c['pe_ratios'] for c in chunks])
+        validator.market_prices = numpy.concatenate(
+            [c['market_prices'] for c in chunks])
+        validator._matrix_buffer = None
+        validator._events = None
+        validator.output = None
+        for matrix, name in zip(validator._matrices(),
+                                ('worth', 'shares', 'cash')):
+            matrix[...] = numpy.concatenate([c[name] for c in chunks], axis=1)
+        validator.load_index_cache()
+        return validator
 
-        Tries to account for holidays by stepping backwards through time when
-        the specified date is not found. Intermittent network errors may cause
-        unexpected results here.
+    def for_index(self, index):
+        """A validator with the same pe series, investors, price source and
+        stats, but for another index, with its own price cache
 
         """
-        while date.weekday() > 4:
-            date -= timedelta(1)
-        if date in self.index_cache:
-            return self.index_cache[date]
-        try:
-            df = get_data_yahoo(self.index, date, date)
-            price = df['Adj Close'][0]
-        except (IndexError, OSError):
-            # try to account for holidays and wutnot
-            if try_next:
-                date1 = date - timedelta(1)
-                return self._get_market_price(date1, try_next - 1)
-            else:  # pragma no cover
-                raise
-        self.index_cache[date] = price
-        return price
+        validator = copy.copy(self)
+        validator.index = index
+        validator.suite = None
+        validator.market_prices = numpy.empty(0)
+        validator._matrix_buffer = None
+        validator._events = None
+        validator.output = None
+        validator.load_index_cache()
+        return validator
 
-    def calculate_worth_vs_time(self):
-        """Calculate the worth, shares, and cash of all the investors across
-        the specified time interval
+    @_phase('sweep')
+    def sweep(self, buy_thresholds, sell_thresholds, **kwargs):
+        """Run `sweep_thresholds` over the full grid of buy and sell
+        thresholds using this validator's pe and price series and result
+        cache. Keyword arguments are passed on to `sweep_thresholds`.
+
+        """
+        market_prices = self._get_market_prices(self._pe_datetimes())
+        self.save_index_cache()
+        kwargs.setdefault('cache', self.result_cache)
+        return sweep_thresholds(self.pe_ratios, market_prices, buy_thresholds,
+                                sell_thresholds, **kwargs)
+
+    @_phase('optimize')
+    def optimize(self, objective='final_worth', **kwargs):
+        """Run `optimize_thresholds` on this validator's pe and price series,
+        reusing them if already loaded. Keyword arguments are passed on to
+        `optimize_thresholds`.
+
+        """
+        market_prices = self.market_prices
+        if len(market_prices) != len(self.pe_ratios):
+            market_prices = self._get_market_prices(self._pe_datetimes())
+            self.save_index_cache()
+        return optimize_thresholds(self.pe_ratios, market_prices, objective,
+                                   **kwargs)
+
+    @_phase('rolling')
+    def rolling_starts(self, stride=1):
+        """Evaluate this validator's investors from every `stride`-th month
+        of the analysis window as start date, all in one batched run. Returns
+        a `StartDateTable` of final worth and annualized return.
+
+        """
+        market_prices = self._get_market_prices(self._pe_datetimes())
+        self.save_index_cache()
+        starts = numpy.arange(0, len(self.pe_ratios), stride)
+        investor = self.investors[0] if self.investors else Investor(0.)
+        final_worth, cagr = rolling_start_analysis(
+            self.pe_ratios, market_prices, starts,
+            [inv.buy_at for inv in self.investors],
+            [inv.sell_at for inv in self.investors],
+            investor.init_cash, investor.income)
+        return StartDateTable(
+            self.pe_dates[starts], [inv.buy_at for inv in self.investors],
+            [inv.sell_at for inv in self.investors], final_worth, cagr)
+
+    @_phase('monte_carlo')
+    def monte_carlo(self, paths=1000, **kwargs):
+        """Run `monte_carlo` for this validator's investors on synthetic
+        series bootstrapped from its pe and price series. Keyword arguments
+        are passed on to `monte_carlo`.
 
         """
-        i = 0
-        for date, pe_ratio in self.pe_array:
-            market_price = self._get_market_price(date)
-            for j, investor in enumerate(self.investors):
-                investor.get_paid()
-                investor.react_to_pe(pe_ratio, market_price)
-                self.worth_matrix[j][i] = investor.get_net_worth(market_price)
-                self.shares_matrix[j][i] = investor.shares
-                self.cash_matrix[j][i] = investor.cash
-            i += 1
+        market_prices = self._get_market_prices(self._pe_datetimes())
         self.save_index_cache()
+        investor = self.investors[0] if self.investors else Investor(0.)
+        kwargs.setdefault('init_cash', investor.init_cash)
+        kwargs.setdefault('income', investor.income)
+        kwargs.setdefault('strategies', self.strategies)
+        return monte_carlo(
+            self.pe_ratios, market_prices,
+            [inv.buy_at for inv in self.investors],
+            [inv.sell_at for inv in self.investors], paths, **kwargs)
 
+    @_phase('plot')
     def plot_worth_vs_time(self, names=None):
         """Plot the worth of each investor vs. time. If names is specified,
         will use these names in the legend. Otherwise, will name the investors
         based off their thresholds.
 
         """
+        from matplotlib import pyplot as plt
+        from matplotlib.dates import YearLocator, DateFormatter
         if names is None:
             names = [
                 'Investor ({:0.2f},{:0.2f})'.format(inv.buy_at, inv.sell_at)
                 for inv in self.investors]
-        dates = [x[0] for x in self.pe_array]
+        dates = self._pe_datetimes()
         year = YearLocator()
         date_fmt = DateFormatter('%Y')
         plt.xkcd()
@@ -202,28 +2364,59 @@ class CapeValidator(object):
         ax = fig.gca()
         lines = []
         for i in range(len(self.investors)):
-            result = ax.plot_date(dates, self.worth_matrix[i], '-')
+            result = ax.plot(dates, self.worth_matrix[i], '-')
             lines.append(result[0])
         ax.xaxis.set_major_locator(year)
         ax.xaxis.set_major_formatter(date_fmt)
         # ax.xaxis.set_minor_formatter(MonthLocator())
         ax.autoscale_view()
-        ax.legend(lines, names, 'upper left')
+        ax.legend(lines, names, loc='upper left')
         fig.autofmt_xdate()
         return fig
 
+    @_phase('plot')
+    def render_worth_vs_time(self, filename=None, width=1200, height=600,
+                             dpi=100, max_legend=10):
+        """Headless version of `plot_worth_vs_time` that scales to many
+        investors. Draws on an Agg figure with `render_lines` and writes it
+        to `filename` if given (png, svg or any other format matplotlib can
+        write). Returns the figure.
+
+        """
+        names = ['Investor ({:0.2f},{:0.2f})'.format(inv.buy_at, inv.sell_at)
+                 for inv in self.investors]
+        fig = render_lines(
+            self.pe_dates, self.worth_matrix, names,
+            [inv.buy_at for inv in self.investors], 'Net Worth vs. Time',
+            width, height, dpi, max_legend)
+        if len(self.investors) > max_legend:
+            fig.axes[-1].set_ylabel('Buy Threshold')
+        return _save_figure(fig, filename) if filename else fig
+
+    @_phase('plot')
+    def render_pe_ratio(self, filename=None, width=1200, height=600,
+                        dpi=100):
+        """Headless version of `plot_pe_ratio`, see `render_worth_vs_time`"""
+        fig = render_lines(self.pe_dates, self.pe_ratios,
+                           title='PE Ratio vs. Time', width=width,
+                           height=height, dpi=dpi)
+        return _save_figure(fig, filename) if filename else fig
+
+    @_phase('plot')
     def plot_pe_ratio(self):
         """
         Plot the CAPE values for the time interval in question.
          
         """
-        dates = [x[0] for x in self.pe_array]
+        from matplotlib import pyplot as plt
+        from matplotlib.dates import YearLocator, DateFormatter
+        dates = self._pe_datetimes()
         year = YearLocator()
         date_fmt = DateFormatter('%Y')
 
         fig = plt.figure()
         ax_pe = fig.gca()
-        ax_pe.plot_date(dates, [x[1] for x in self.pe_array], '-')
+        ax_pe.plot(dates, self.pe_ratios, '-')
         ax_pe.xaxis.set_major_locator(year)
         ax_pe.xaxis.set_major_formatter(date_fmt)
         ax_pe.autoscale_view()
@@ -232,30 +2425,1489 @@ class CapeValidator(object):
         return fig
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="CAPE Value determination")
-    default_thresholds = ','.join(str(i) for i in range(16, 26)) + ',1000'
-    parser.add_argument('-t', '--buy_thresholds',  default=default_thresholds)
-    parser.add_argument('--sell_thresholds', default=None)
+class MultiIndexValidator(object):
+    """Runs the same suite of investors against several indices.
+
+    The pe series is loaded once and shared. The price series of every
+    index are aligned to its dates, and then all indices are simulated
+    together, with the index as an extra leading axis of the investor
+    state. Results are kept per index in a `CapeValidator` each, found in
+    `validators`, so they can be plotted, advanced or saved like those of a
+    single index run.
+
+    :param indices  [str, ...]  stock symbols of the indices to invest in
+    Other parameters are as for `CapeValidator`.
+
+    """
+    def __init__(self, pe_data_file, start_date, buy_thresholds,
+                 sell_thresholds=None, end_date=None, indices=('^GSPC',),
+                 price_source=None, strategies=None, pe_cache=True,
+                 cache_dir=None):
+        if not len(indices):
+            raise ValueError("Need at least one index")
+        first = CapeValidator(pe_data_file, start_date, buy_thresholds,
+                              sell_thresholds, end_date, indices[0],
+                              price_source, strategies, pe_cache=pe_cache,
+                              cache_dir=cache_dir)
+        self.indices = list(indices)
+        self.stats = first.stats
+        self.validators = dict(
+            [(indices[0], first)] +
+            [(index, first.for_index(index)) for index in indices[1:]])
+
+    def __getitem__(self, index):
+        return self.validators[index]
+
+    def calculate_worth_vs_time(self):
+        """Calculate the worth, shares, and cash of all the investors across
+        the specified time interval for every index in one run
+
+        """
+        validators = [self.validators[index] for index in self.indices]
+        first = validators[0]
+        dates = first._pe_datetimes()
+        prices = numpy.stack([validator._get_market_prices(dates)
+                              for validator in validators])
+        suite = InvestorSuite.from_investors(first.investors)
+        suite = InvestorSuite(
+            suite.buy_at, suite.sell_at,
+            numpy.repeat(suite.cash[numpy.newaxis], len(validators), 0),
+            suite.shares, suite.income, first.strategies)
+        matrices = numpy.empty(
+            (3, len(validators), len(first.investors), len(dates)))
+        self.stats.record_matrix_bytes(matrices.nbytes)
+        with self.stats.phase('simulate'):
+            suite.simulate(first.pe_ratios, prices.T[:, :, numpy.newaxis],
+                           *matrices)
+        for k, validator in enumerate(validators):
+            validator.market_prices = prices[k]
+            validator.suite = InvestorSuite.from_investors(
+                validator.investors, validator.strategies)
+            validator.suite.cash = suite.cash[k].copy()
+            validator.suite.shares = suite.shares[k].copy()
+            validator._matrix_buffer = matrices[:, k]
+            validator._events = None
+            validator.output = None
+            validator.save_index_cache()
+
+    def final_worth(self):
+        """Final worth of every investor, keyed by index"""
+        return dict((index, validator.worth_matrix[:, -1])
+                    for index, validator in self.validators.items())
+
+
+class ThresholdGrid(object):
+    """Final worth of an investor for every (buy, sell) threshold pair.
+
+    :param buy_thresholds   [float, ...]    buy thresholds (grid rows)
+    :param sell_thresholds  [float, ...]    sell thresholds (grid columns)
+    :param worth    numpy.ndarray   `buys x sells` matrix of final worth
+
+    """
+    def __init__(self, buy_thresholds, sell_thresholds, worth):
+        self.buy_thresholds = numpy.asarray(buy_thresholds, dtype=float)
+        self.sell_thresholds = numpy.asarray(sell_thresholds, dtype=float)
+        self.worth = worth
+
+    def __getitem__(self, thresholds):
+        buy, sell = thresholds
+        i = numpy.flatnonzero(self.buy_thresholds == buy)
+        j = numpy.flatnonzero(self.sell_thresholds == sell)
+        if not len(i) or not len(j):
+            raise KeyError(thresholds)
+        return self.worth[i[0], j[0]]
+
+    def best(self):
+        """Return the (buy, sell, worth) of the best performing pair"""
+        i, j = numpy.unravel_index(numpy.argmax(self.worth), self.worth.shape)
+        return (self.buy_thresholds[i], self.sell_thresholds[j],
+                self.worth[i, j])
+
+    def render_heatmap(self, filename=None, width=800, height=600,
+                       dpi=100):
+        """Draw the final worth over the (buy, sell) grid on an Agg figure,
+        marking the best pair, and write it to `filename` if given. Returns
+        the figure.
+
+        """
+        fig = _new_figure(width, height, dpi)
+        ax = fig.add_subplot(1, 1, 1)
+        buys, sells = self.buy_thresholds, self.sell_thresholds
+        mesh = ax.pcolormesh(_cell_edges(sells), _cell_edges(buys),
+                             self.worth, shading='flat')
+        fig.colorbar(mesh, ax=ax).set_label('Final Worth')
+        if self.worth.size:
+            buy, sell, _ = self.best()
+            ax.plot([sell], [buy], 'w*', markersize=12)
+        ax.set_xlabel('Sell Threshold')
+        ax.set_ylabel('Buy Threshold')
+        ax.set_title('Final Worth by Threshold')
+        return _save_figure(fig, filename) if filename else fig
+
+    def save(self, filename):
+        """Save the grid to an .npz file"""
+        numpy.savez(filename, buy_thresholds=self.buy_thresholds,
+                    sell_thresholds=self.sell_thresholds, worth=self.worth)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a grid saved with `save`"""
+        with numpy.load(filename) as data:
+            return cls(data['buy_thresholds'], data['sell_thresholds'],
+                       data['worth'])
+
+
+def _cell_edges(centers):
+    # edges of the cells around sorted cell centers, for pcolormesh
+    centers = numpy.asarray(centers, dtype=float)
+    if len(centers) < 2:
+        return numpy.concatenate([centers - 0.5, centers[-1:] + 0.5])
+    middle = (centers[1:] + centers[:-1]) / 2.
+    return numpy.concatenate([[2 * centers[0] - middle[0]], middle,
+                              [2 * centers[-1] - middle[-1]]])
+
+
+# pe and price series of the sweep being run, set once per worker process
+_sweep_data = {}
+
+
+def _init_sweep_worker(pe_ratios, market_prices):
+    _sweep_data['pe_ratios'] = pe_ratios
+    _sweep_data['market_prices'] = market_prices
+
+
+def _sweep_chunk(buy_thresholds, sell_thresholds, init_cash, income,
+                 engine='step'):
+    if engine == 'event':
+        return simulate_events(
+            _sweep_data['pe_ratios'], _sweep_data['market_prices'],
+            buy_thresholds, sell_thresholds, init_cash,
+            income=income).final_worth()
+    suite = InvestorSuite(buy_thresholds, sell_thresholds, init_cash,
+                          income=income)
+    suite.simulate(_sweep_data['pe_ratios'], _sweep_data['market_prices'])
+    return suite.get_net_worth(_sweep_data['market_prices'][-1])
+
+
+def sweep_thresholds(pe_ratios, market_prices, buy_thresholds,
+                     sell_thresholds, init_cash=10000., income=2000.,
+                     chunk_size=4096, max_workers=None, engine='step',
+                     cache=None):
+    """Simulate an investor for every pair in the full `buy_thresholds x
+    sell_thresholds` grid and return the final worths as a `ThresholdGrid`.
+
+    The grid is split into chunks of `chunk_size` investors which are run on
+    a process pool. The pe and price series are handed to each worker once
+    when it starts rather than with every chunk. With `max_workers=1` the
+    chunks are run in this process instead. `engine` is 'step' or 'event'
+    as for `CapeValidator.calculate_worth_vs_time`; 'step' is the faster one
+    on dense grids of thresholds. With a `ResultCache`,
+    only the pairs it does not hold yet are simulated.
+
+    """
+    pe_ratios = numpy.asarray(pe_ratios, dtype=float)
+    market_prices = numpy.asarray(market_prices, dtype=float)
+    buys, sells = numpy.meshgrid(buy_thresholds, sell_thresholds,
+                                 indexing='ij')
+    buys, sells = buys.ravel(), sells.ravel()
+    worth = numpy.empty(len(buys))
+    todo = numpy.ones(len(buys), dtype=bool)
+    if cache is not None:
+        key = cache.data_key('final_worth-' + engine, pe_ratios,
+                             market_prices)
+        params = _investor_params(buys, sells, init_cash, 0., income)
+        found, values = cache.lookup(key, params)
+        worth[found] = values
+        todo = ~found
+    todo_buys, todo_sells = buys[todo], sells[todo]
+    chunks = [(todo_buys[i:i + chunk_size], todo_sells[i:i + chunk_size])
+              for i in range(0, len(todo_buys), chunk_size)]
+    if max_workers == 1 or not chunks:
+        _init_sweep_worker(pe_ratios, market_prices)
+        results = [_sweep_chunk(b, s, init_cash, income, engine)
+                   for b, s in chunks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(
+                max_workers, initializer=_init_sweep_worker,
+                initargs=(pe_ratios, market_prices)) as executor:
+            futures = [executor.submit(_sweep_chunk, b, s, init_cash, income,
+                                       engine)
+                       for b, s in chunks]
+            results = [future.result() for future in futures]
+    if results:
+        worth[todo] = numpy.concatenate(results)
+        if cache is not None:
+            cache.store(key, params[todo], worth[todo])
+    return ThresholdGrid(buy_thresholds, sell_thresholds,
+                         worth.reshape(len(buy_thresholds),
+                                       len(sell_thresholds)))
+
+
+def threshold_levels(pe_ratios):
+    """The thresholds that can give different results on `pe_ratios`.
+
+    An investor buys when the pe ratio is at or below its buy threshold and
+    sells when it is above its sell threshold, so its results only change
+    when a threshold crosses one of the pe ratios. Every threshold in
+    `[levels[k], levels[k + 1])` acts the same as `levels[k]`. The first
+    level is below all the pe ratios (never buy, always sell) and the last
+    is the highest pe ratio (always buy, never sell).
+
+    """
+    pe_ratios = numpy.asarray(pe_ratios, dtype=float)
+    levels = numpy.unique(pe_ratios[numpy.isfinite(pe_ratios)])
+    below = levels[:1] - 1. if len(levels) else numpy.zeros(1)
+    return numpy.concatenate([below, levels])
+
+
+def _objective_values(summary, objective):
+    if objective == 'final_worth':
+        values = summary.final_worth
+    elif objective == 'cagr':
+        values = summary.cagr
+    elif objective == 'calmar':
+        # drawdowns below 1% count as 1%, so that a run that never falls
+        # does not win on the drawdown alone
+        values = summary.cagr / numpy.maximum(summary.max_drawdown, 0.01)
+    else:
+        raise ValueError("Unknown objective {!r}".format(objective))
+    return numpy.where(numpy.isnan(values), -numpy.inf, values)
+
+
+class ThresholdOptimum(object):
+    """Best (buy, sell) thresholds found by `optimize_thresholds`.
+
+    :param buy_at   float   best buy threshold, the lowest of `buy_range`
+    :param sell_at  float   best sell threshold, the lowest of `sell_range`
+    :param value    float   objective of the best pair
+    :param buy_range    (float, float)  interval of buy thresholds that act
+        the same as `buy_at`, the upper end excluded
+    :param sell_range   (float, float)  same for the sell threshold
+    :param buy_thresholds   numpy.ndarray   buy threshold of every pair
+        simulated during the search
+    :param sell_thresholds  numpy.ndarray   sell threshold of every pair
+    :param values   numpy.ndarray   objective of every pair
+    :param levels   int     number of distinct threshold levels, the search
+        space being `levels x levels` pairs
+
+    """
+    def __init__(self, buy_at, sell_at, value, buy_range, sell_range,
+                 buy_thresholds, sell_thresholds, values, levels):
+        self.buy_at = buy_at
+        self.sell_at = sell_at
+        self.value = value
+        self.buy_range = buy_range
+        self.sell_range = sell_range
+        self.buy_thresholds = buy_thresholds
+        self.sell_thresholds = sell_thresholds
+        self.values = values
+        self.levels = levels
+
+    @property
+    def evaluations(self):
+        """Number of pairs simulated"""
+        return len(self.values)
+
+
+def optimize_thresholds(pe_ratios, market_prices, objective='final_worth',
+                        init_cash=10000., income=2000., coarse=96, keep=8,
+                        restarts=8):
+    """Search for the (buy, sell) thresholds with the best `objective`
+    without simulating the full grid.
+
+    The search runs over the distinct `threshold_levels` of the pe ratios
+    only, as the results do not change between them. A `coarse x coarse`
+    grid of levels is simulated first. The grid spacing is then halved
+    around the `keep` best pairs until neighbouring levels are reached, and
+    finally the best pair is moved to a better neighbour while there is one.
+    The refinement is then repeated from each of the next `restarts` best
+    pairs of the coarse grid on its own, as the optimum often sits on a
+    narrow ridge away from the best coarse pairs. All the pairs of a round
+    are simulated as one batch.
+
+    :param objective    str     'final_worth', 'cagr' or 'calmar' (CAGR per
+        maximum drawdown, see `ResultSummary`)
+
+    Returns a `ThresholdOptimum`. Like any local refinement, the search can
+    miss a narrow optimum that the coarse grid does not come near; on the
+    bundled monthly data (about 1.2M pairs) the defaults simulate about 1%
+    of the pairs.
+
+    """
+    pe_ratios = numpy.asarray(pe_ratios, dtype=float)
+    market_prices = numpy.asarray(market_prices, dtype=float)
+    levels = threshold_levels(pe_ratios)
+    count = len(levels)
+    scores = {}
+
+    def evaluate(pairs):
+        pairs = [pair for pair in set(pairs) if pair not in scores]
+        if not pairs:
+            return
+        index = numpy.array(pairs).T
+        suite = InvestorSuite(levels[index[0]], levels[index[1]], init_cash,
+                              income=income)
+        output = SimulationOutput(outputs=())
+        output.open(len(suite), len(pe_ratios), init_cash, income)
+        suite.simulate_to(output, pe_ratios, market_prices)
+        values = _objective_values(output.close(), objective)
+        scores.update(zip(pairs, values.tolist()))
+
+    def grid(center, step, radius):
+        # level indices around `center` at `step` apart, within `radius`
+        lo, hi = max(center - radius, 0), min(center + radius, count - 1)
+        return sorted(set(range(lo, hi + 1, step)) | {hi})
+
+    step = max(1, -(-count // coarse))
+    # with the levels next to the ends, which trade on the single most
+    # extreme month only and are easily missed otherwise
+    start = sorted(set(grid(0, step, count)) | {1, count - 2} -
+                   {-1, count})
+    evaluate([(i, j) for i in start for j in start])
+    ranked = sorted(scores, key=scores.get, reverse=True)
+
+    def refine(best, step):
+        # only the pairs refined from `best` compete for the next round
+        seen = set(best)
+        while step > 1:
+            radius, step = step, max(1, step // 2)
+            pairs = [(i, j) for b, s in best
+                     for i in grid(b, step, radius)
+                     for j in grid(s, step, radius)]
+            evaluate(pairs)
+            seen.update(pairs)
+            best = sorted(seen, key=scores.get, reverse=True)[:keep]
+        b, s = best[0]
+        while True:
+            pairs = [(i, j) for i in grid(b, 1, 1) for j in grid(s, 1, 1)]
+            evaluate(pairs)
+            if max(pairs, key=scores.get) == (b, s):
+                break
+            b, s = max(pairs, key=scores.get)
+
+    refine(ranked[:keep], step)
+    for pair in ranked[keep:keep + restarts]:
+        refine([pair], step)
+
+    pairs = numpy.array(list(scores), dtype=int).reshape(-1, 2)
+    values = numpy.array(list(scores.values()))
+    b, s = max(scores, key=scores.get)
+    upper = numpy.append(levels[1:], numpy.inf)
+    return ThresholdOptimum(
+        levels[b], levels[s], scores[(b, s)], (levels[b], upper[b]),
+        (levels[s], upper[s]), levels[pairs[:, 0]], levels[pairs[:, 1]],
+        values, count)
+
+
+class StartDateTable(object):
+    """Final worth and annualized return of each investor for each start
+    date.
+
+    :param start_dates  numpy.ndarray   datetime64 start dates (table rows)
+    :param buy_thresholds   [float, ...]    buy threshold of each investor
+        (table columns)
+    :param sell_thresholds  [float, ...]    sell threshold of each investor
+    :param final_worth  numpy.ndarray   `starts x investors` final worth
+    :param cagr numpy.ndarray   `starts x investors` annualized return
+
+    """
+    def __init__(self, start_dates, buy_thresholds, sell_thresholds,
+                 final_worth, cagr):
+        self.start_dates = numpy.asarray(start_dates, dtype='datetime64[D]')
+        self.buy_thresholds = numpy.asarray(buy_thresholds, dtype=float)
+        self.sell_thresholds = numpy.asarray(sell_thresholds, dtype=float)
+        self.final_worth = final_worth
+        self.cagr = cagr
+
+    def save(self, filename):
+        """Save the table to an .npz file"""
+        numpy.savez(filename, start_dates=self.start_dates.astype('int64'),
+                    buy_thresholds=self.buy_thresholds,
+                    sell_thresholds=self.sell_thresholds,
+                    final_worth=self.final_worth, cagr=self.cagr)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a table saved with `save`"""
+        with numpy.load(filename) as data:
+            return cls(data['start_dates'].astype('datetime64[D]'),
+                       data['buy_thresholds'], data['sell_thresholds'],
+                       data['final_worth'], data['cagr'])
+
+    def save_csv(self, filename):
+        """Write one row per start date and investor"""
+        with open(filename, 'w') as fp:
+            fp.write('start_date,buy_at,sell_at,final_worth,cagr\n')
+            for i, start_date in enumerate(self.start_dates):
+                for j in range(len(self.buy_thresholds)):
+                    fp.write('{},{},{},{!r},{!r}\n'.format(
+                        start_date, self.buy_thresholds[j],
+                        self.sell_thresholds[j],
+                        float(self.final_worth[i, j]),
+                        float(self.cagr[i, j])))
+
+
+def annualized_return(final_worth, months, init_cash=10000., income=2000.,
+                      iterations=60):
+    """Money-weighted annualized return (IRR) of investors that start with
+    `init_cash`, receive `income` every month for `months` months (the
+    first together with the initial cash) and end up with `final_worth`.
+    Unlike a plain CAGR of net worth, this does not count the income itself
+    as growth. Solved by bisection, element-wise over broadcast arrays.
+
+    """
+    final_worth, months, init_cash, income = numpy.broadcast_arrays(
+        *[numpy.asarray(x, dtype=float)
+          for x in (final_worth, months, init_cash, income)])
+    lo = numpy.full(final_worth.shape, 0.5)
+    hi = numpy.full(final_worth.shape, 1.5)
+    for _ in range(iterations):
+        growth = (lo + hi) / 2.
+        # worth of the cash flows at the end, had they grown by `growth`
+        # every month: (init_cash + income) * g^(n-1) + income * sum g^k
+        powers = growth ** (months - 1)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            series = numpy.where(growth == 1., months - 1.,
+                                 (powers - 1.) / (growth - 1.))
+        value = (init_cash + income) * powers + income * series
+        low = value < final_worth
+        lo = numpy.where(low, growth, lo)
+        hi = numpy.where(low, hi, growth)
+    # there is no return to speak of over a single month
+    return numpy.where(months > 1, ((lo + hi) / 2.) ** 12 - 1., numpy.nan)
+
+
+def rolling_start_analysis(pe_ratios, market_prices, start_indices,
+                           buy_thresholds, sell_thresholds=None,
+                           init_cash=10000., income=2000.):
+    """Simulate every investor from every month in `start_indices` to the
+    end of the series in one batched computation.
+
+    The investor state is a `starts x investors` array. Each month every
+    started row is stepped at once, while rows whose start date has not come
+    yet are left untouched. Returns `(final_worth, cagr)` matrices, with the
+    rows in the order of the sorted start indices.
+
+    """
+    pe_ratios = numpy.asarray(pe_ratios, dtype=float)
+    market_prices = numpy.asarray(market_prices, dtype=float)
+    starts = numpy.unique(start_indices)
+    if sell_thresholds is None:
+        sell_thresholds = buy_thresholds
+    suite = InvestorSuite(
+        numpy.asarray(buy_thresholds, dtype=float)[numpy.newaxis, :],
+        numpy.asarray(sell_thresholds, dtype=float)[numpy.newaxis, :],
+        numpy.full((len(starts), 1), float(init_cash)), income=income)
+    for t in range(starts[0] if len(starts) else 0, len(pe_ratios)):
+        started = (starts <= t)[:, numpy.newaxis]
+        suite.cash += numpy.where(started, suite.income, 0.)
+        suite.react_to_pe(numpy.where(started, pe_ratios[t], numpy.nan),
+                          market_prices[t])
+    final_worth = suite.get_net_worth(market_prices[-1]) \
+        if len(market_prices) else suite.cash
+    months = (len(pe_ratios) - starts)[:, numpy.newaxis]
+    return final_worth, annualized_return(final_worth, months, init_cash,
+                                          income)
+
+
+def evaluate_thresholds(pe_ratios, market_prices, buy_thresholds,
+                        sell_thresholds, starts, ends=None, init_cash=10000.,
+                        income=2000.):
+    """Simulate one investor per element of the arrays, each over its own
+    months `starts[i]` up to (not including) `ends[i]`, in one batched run.
+    Returns `(final_worth, cagr)` arrays.
+
+    """
+    pe_ratios = numpy.asarray(pe_ratios, dtype=float)
+    market_prices = numpy.asarray(market_prices, dtype=float)
+    starts = numpy.asarray(starts, dtype=int)
+    ends = numpy.broadcast_to(len(pe_ratios) if ends is None else ends,
+                              starts.shape).astype(int)
+    if (starts < 0).any() or (ends <= starts).any() or \
+            (ends > len(pe_ratios)).any():
+        raise ValueError("Every investor needs at least one month within "
+                         "the series")
+    suite = InvestorSuite(buy_thresholds, sell_thresholds,
+                          numpy.full(starts.shape, float(init_cash)),
+                          income=income)
+    final_worth = suite.cash.copy()
+    for t in range(starts.min() if len(starts) else 0,
+                   ends.max() if len(ends) else 0):
+        active = (starts <= t) & (t < ends)
+        suite.cash += numpy.where(active, suite.income, 0.)
+        suite.react_to_pe(numpy.where(active, pe_ratios[t], numpy.nan),
+                          market_prices[t])
+        done = ends == t + 1
+        final_worth[done] = suite.get_net_worth(market_prices[t])[done]
+    return final_worth, annualized_return(final_worth, ends - starts,
+                                          init_cash, income)
+
+
+def _bootstrap_blocks(pe_ratios, market_prices, paths, months, block, seed):
+    # historical monthly log changes of pe and price, and the first month of
+    # every block of every path
+    if len(pe_ratios) < 2:
+        raise ValueError("Need at least two months of history to bootstrap")
+    steps = numpy.diff(numpy.log(numpy.stack([pe_ratios, market_prices])))
+    rng = numpy.random.RandomState(seed)
+    blocks = -(-(months - 1) // block)
+    return steps, rng.randint(0, steps.shape[1], size=(paths, blocks))
+
+
+def _bootstrap_walk(pe0, price0, steps, starts, months, block):
+    index = (starts[:, :, numpy.newaxis] + numpy.arange(block)) % \
+        steps.shape[1]
+    index = index.reshape(len(starts), -1)[:, :months - 1]
+    walk = numpy.zeros((2, len(starts), months))
+    numpy.cumsum(steps[:, index], axis=2, out=walk[:, :, 1:])
+    walk = numpy.exp(walk, out=walk)
+    return pe0 * walk[0], price0 * walk[1]
+
+
+def bootstrap_paths(pe_ratios, market_prices, paths, months=None, block=12,
+                    seed=None):
+    """Generate synthetic pe and price series by a circular block bootstrap
+    of the historical monthly changes.
+
+    Each path starts at the first historical pe and price and is built from
+    blocks of `block` consecutive months of log pe changes and log returns,
+    drawn at random. Pe changes and returns are drawn together so their
+    correlation is kept. Returns `(pe_ratios, market_prices)` arrays of
+    shape `paths x months`.
+
+    """
+    pe_ratios = numpy.asarray(pe_ratios, dtype=float)
+    market_prices = numpy.asarray(market_prices, dtype=float)
+    months = len(pe_ratios) if months is None else months
+    steps, starts = _bootstrap_blocks(pe_ratios, market_prices, paths,
+                                      months, block, seed)
+    return _bootstrap_walk(pe_ratios[0], market_prices[0], steps, starts,
+                           months, block)
+
+
+class MonteCarloResult(object):
+    """Final worth of each investor on each synthetic path.
+
+    :param buy_thresholds   [float, ...]    buy threshold of each investor
+    :param sell_thresholds  [float, ...]    sell threshold of each investor
+    :param final_worth  numpy.ndarray   `paths x investors` final worth
+
+    """
+    def __init__(self, buy_thresholds, sell_thresholds, final_worth):
+        self.buy_thresholds = numpy.asarray(buy_thresholds, dtype=float)
+        self.sell_thresholds = numpy.asarray(sell_thresholds, dtype=float)
+        self.final_worth = final_worth
+
+    def mean(self):
+        """Mean final worth of each investor"""
+        return self.final_worth.mean(axis=0)
+
+    def percentile(self, q):
+        """Percentile(s) `q` of the final worth of each investor"""
+        return numpy.percentile(self.final_worth, q, axis=0)
+
+    def save(self, filename):
+        """Save the result to an .npz file"""
+        numpy.savez(filename, buy_thresholds=self.buy_thresholds,
+                    sell_thresholds=self.sell_thresholds,
+                    final_worth=self.final_worth)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a result saved with `save`"""
+        with numpy.load(filename) as data:
+            return cls(data['buy_thresholds'], data['sell_thresholds'],
+                       data['final_worth'])
+
+    def save_csv(self, filename, percentiles=(5, 25, 50, 75, 95)):
+        """Write the mean and percentiles of each investor's final worth"""
+        values = self.percentile(percentiles)
+        with open(filename, 'w') as fp:
+            fp.write('buy_at,sell_at,mean,{}\n'.format(
+                ','.join('p{}'.format(q) for q in percentiles)))
+            for j, mean in enumerate(self.mean()):
+                fp.write('{},{},{}\n'.format(
+                    self.buy_thresholds[j], self.sell_thresholds[j],
+                    ','.join(repr(float(x)) for x in
+                             [mean] + list(values[:, j]))))
+
+
+def monte_carlo(pe_ratios, market_prices, buy_thresholds,
+                sell_thresholds=None, paths=1000, months=None, block=12,
+                seed=None, init_cash=10000., income=2000., batch_size=None,
+                strategies=None):
+    """Simulate every investor on `paths` synthetic series from
+    `bootstrap_paths` and return a `MonteCarloResult`.
+
+    Paths are run `batch_size` at a time, with the investor state of a batch
+    held as one `paths x investors` suite that is stepped through the months
+    together, and the synthetic series of a batch are only generated when it
+    is run, so memory stays bounded however many paths are asked for. By
+    default batches hold about 64k investor paths. Results only depend on
+    `seed`, not on the batch size. `strategies` are as for `InvestorSuite`.
+
+    """
+    if sell_thresholds is None:
+        sell_thresholds = buy_thresholds
+    buys = numpy.asarray(buy_thresholds, dtype=float)
+    sells = numpy.asarray(sell_thresholds, dtype=float)
+    pe_ratios = numpy.asarray(pe_ratios, dtype=float)
+    market_prices = numpy.asarray(market_prices, dtype=float)
+    months = len(pe_ratios) if months is None else months
+    if batch_size is None:
+        batch_size = max(1, 2 ** 16 // max(len(buys), 1))
+    steps, starts = _bootstrap_blocks(pe_ratios, market_prices, paths,
+                                      months, block, seed)
+    final_worth = numpy.empty((paths, len(buys)))
+    for first in range(0, paths, batch_size):
+        batch = slice(first, first + batch_size)
+        pe_paths, price_paths = _bootstrap_walk(
+            pe_ratios[0], market_prices[0], steps, starts[batch], months,
+            block)
+        suite = InvestorSuite(
+            buys[numpy.newaxis, :], sells[numpy.newaxis, :],
+            numpy.full((len(pe_paths), 1), float(init_cash)), income=income,
+            strategies=strategies)
+        suite.simulate(pe_paths.T[:, :, numpy.newaxis],
+                       price_paths.T[:, :, numpy.newaxis])
+        final_worth[batch] = suite.get_net_worth(price_paths[:, -1:])
+    return MonteCarloResult(buys, sells, final_worth)
+
+
+class ShardedSweep(object):
+    """A sweep of every (buy, sell) threshold pair from every start date on
+    every index, split into shards that can be run by separate worker
+    processes or machines sharing the directory `path`.
+
+    The work units are the (index, start date) pairs in a fixed order, and
+    shard `k` of `N` takes every `N`-th of them from the `k`-th on. Each
+    worker writes its shard's results to `path` atomically when it is done,
+    so a restarted run skips the shards already there. `merge` combines
+    them once they are all done. The workers share a price cache in `path`.
+
+    Create the plan with `create`, then run `python -m capeval worker
+    --shard k/N --sweep_dir path` for each shard (or `run_local`).
+
+    """
+    plan_filename = 'plan.json'
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, self.plan_filename)) as fp:
+            self.plan = json.load(fp)
+        self.stats = RunStats()
+
+    @classmethod
+    def create(cls, path, pe_data_file, start_date, buy_thresholds,
+               sell_thresholds, shards, end_date=None, indices=('^GSPC',),
+               start_stride=1, price_file=None, init_cash=10000.,
+               income=2000.):
+        """Plan a sweep of the `buy_thresholds x sell_thresholds` grid from
+        every `start_stride`-th month between `start_date` and `end_date`
+        on each of `indices`, in `shards` shards, and write the plan to
+        `path`. An existing plan in `path` is kept, so that restarting a
+        sweep resumes it, but only if it is the same sweep.
+
+        The CAPE data and the price files of `indices` (if `price_file` is
+        given) are copied into `path`, so that workers only need that
+        directory, wherever it is mounted.
+
+        """
+        copies = {'pe_data.csv': pe_data_file}
+        if price_file:
+            ext = '.npy' if price_file.endswith('.npy') else '.csv'
+            planned_price_file = os.path.join('prices', '{index}' + ext)
+            for index in indices:
+                copies[planned_price_file.format(index=index)] = \
+                    price_file.format(index=index)
+        contents = {}
+        for name, filename in copies.items():
+            with open(filename, 'rb') as fp:
+                contents[name] = fp.read()
+        pe_dates, _ = load_pe_data(pe_data_file, start_date, end_date,
+                                   use_cache=False)
+        plan = {
+            'pe_data_file': 'pe_data.csv',
+            'sha1': {name: hashlib.sha1(data).hexdigest()
+                     for name, data in contents.items()},
+            'start_date': start_date.strftime('%Y-%m-%d'),
+            'end_date': end_date and end_date.strftime('%Y-%m-%d'),
+            'indices': list(indices),
+            'starts': [str(date) for date in pe_dates[::start_stride]],
+            'buy_thresholds': [float(b) for b in buy_thresholds],
+            'sell_thresholds': [float(s) for s in sell_thresholds],
+            'shards': int(shards),
+            'price_file': price_file and planned_price_file,
+            'init_cash': init_cash,
+            'income': income,
+        }
+        filename = os.path.join(path, cls.plan_filename)
+        if os.path.exists(filename):
+            with open(filename) as fp:
+                existing = json.load(fp)
+            changed = sorted(key for key in set(plan) | set(existing)
+                             if plan.get(key) != existing.get(key))
+            if changed:
+                raise ValueError("{} holds a different sweep (differing in "
+                                 "{})".format(path, ', '.join(changed)))
+        else:
+            for name, data in contents.items():
+                directory = os.path.dirname(os.path.join(path, name))
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                _atomic_save(os.path.join(path, name),
+                             lambda fp, data=data: fp.write(data))
+            # the plan is written last, as it marks the copies complete
+            _atomic_save(filename,
+                         lambda fp: fp.write(json.dumps(plan).encode()))
+        return cls(path)
+
+    @property
+    def shards(self):
+        return self.plan['shards']
+
+    def units(self, shard=None):
+        """The (index, start position) work units, of one shard or all"""
+        units = [(index, start) for index in self.plan['indices']
+                 for start in range(len(self.plan['starts']))]
+        return units if shard is None else units[shard::self.shards]
+
+    def _shard_filename(self, shard):
+        return os.path.join(self.path, 'shard-{:05d}-of-{:05d}.npz'.format(
+            shard, self.shards))
+
+    def pending(self):
+        """The shards whose results are not written yet"""
+        return [k for k in range(self.shards)
+                if not os.path.exists(self._shard_filename(k))]
+
+    def _planned_file(self, name):
+        """The copy `name` of an input file in the sweep directory, checked
+        against the sha1 it had when the sweep was planned
+
+        """
+        filename = os.path.join(self.path, name)
+        with open(filename, 'rb') as fp:
+            if hashlib.sha1(fp.read()).hexdigest() != self.plan['sha1'][name]:
+                raise ValueError("{} changed since the sweep was planned"
+                                 .format(filename))
+        return filename
+
+    def _thresholds(self):
+        buys, sells = numpy.meshgrid(self.plan['buy_thresholds'],
+                                     self.plan['sell_thresholds'],
+                                     indexing='ij')
+        return buys.ravel(), sells.ravel()
+
+    def run_shard(self, shard, shards=None):
+        """Run shard `shard` of the plan, unless it is done already. Returns
+        whether it was run.
+
+        """
+        if shards is not None and shards != self.shards:
+            raise ValueError("The sweep in {} has {} shards, not {}".format(
+                self.path, self.shards, shards))
+        if not 0 <= shard < self.shards:
+            raise ValueError("No shard {} of {}".format(shard, self.shards))
+        if os.path.exists(self._shard_filename(shard)):
+            self.stats.count('shards_skipped')
+            return False
+        plan = self.plan
+        pe_data_file = self._planned_file(plan['pe_data_file'])
+        units = self.units(shard)
+        buys, sells = self._thresholds()
+        final_worth = numpy.empty((len(units), len(buys)))
+        cagr = numpy.empty((len(units), len(buys)))
+        with self.stats.phase('shard'):
+            for index in plan['indices']:
+                rows = [i for i, unit in enumerate(units) if unit[0] == index]
+                if not rows:
+                    continue
+                source = None
+                if plan['price_file']:
+                    source = LocalPriceSource(self._planned_file(
+                        plan['price_file'].format(index=index)))
+                end_date = plan['end_date'] and \
+                    datetime.strptime(plan['end_date'], '%Y-%m-%d')
+                validator = CapeValidator(
+                    pe_data_file,
+                    datetime.strptime(plan['start_date'], '%Y-%m-%d'), [],
+                    end_date=end_date, index=index, price_source=source,
+                    cache_dir=self.path)
+                market_prices = validator._get_market_prices(
+                    validator._pe_datetimes())
+                validator.save_index_cache()
+                starts = [units[i][1] for i in rows]
+                start_dates = numpy.array(plan['starts'],
+                                          dtype='datetime64[D]')[starts]
+                positions = numpy.searchsorted(validator.pe_dates,
+                                               start_dates)
+                worth, returns = rolling_start_analysis(
+                    validator.pe_ratios, market_prices, positions, buys,
+                    sells, plan['init_cash'], plan['income'])
+                # rolling_start_analysis returns the sorted unique starts
+                order = numpy.searchsorted(numpy.unique(positions), positions)
+                final_worth[rows] = worth[order]
+                cagr[rows] = returns[order]
+        _atomic_save(self._shard_filename(shard), numpy.savez,
+                     units=numpy.arange(len(self.units()))[
+                         shard::self.shards],
+                     final_worth=final_worth, cagr=cagr)
+        self.stats.count('shards_run')
+        self.stats.count('units', len(units))
+        return True
+
+    def run_local(self, processes=None):
+        """Run the pending shards as worker processes on this machine, at
+        most `processes` at a time, then `merge` them
+
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.abspath(__file__))] +
+            [p for p in [env.get('PYTHONPATH')] if p])
+
+        def work(shard):
+            return subprocess.call(
+                [sys.executable, '-m', 'capeval', 'worker', '--shard',
+                 '{}/{}'.format(shard, self.shards), '--sweep_dir',
+                 self.path], env=env)
+
+        pending = self.pending()
+        with self.stats.phase('workers'):
+            with ThreadPoolExecutor(processes or os.cpu_count()) as pool:
+                codes = list(pool.map(work, pending))
+        failed = [k for k, code in zip(pending, codes) if code]
+        if failed:
+            raise RuntimeError("Shards {} of the sweep in {} failed".format(
+                failed, self.path))
+        return self.merge()
+
+    def merge(self):
+        """Combine the results of all the shards into a `StartDateTable` of
+        every (buy, sell) pair for each index
+
+        """
+        pending = self.pending()
+        if pending:
+            raise RuntimeError("Shards {} of the sweep in {} are not done"
+                               .format(pending, self.path))
+        buys, sells = self._thresholds()
+        units = len(self.units())
+        final_worth = numpy.empty((units, len(buys)))
+        cagr = numpy.empty((units, len(buys)))
+        for shard in range(self.shards):
+            with numpy.load(self._shard_filename(shard)) as data:
+                final_worth[data['units']] = data['final_worth']
+                cagr[data['units']] = data['cagr']
+        starts = numpy.array(self.plan['starts'], dtype='datetime64[D]')
+        tables = {}
+        for i, index in enumerate(self.plan['indices']):
+            rows = slice(i * len(starts), (i + 1) * len(starts))
+            tables[index] = StartDateTable(starts, buys, sells,
+                                           final_worth[rows], cagr[rows])
+        return tables
+
+
+class QueryServer(object):
+    """Answers "what would thresholds (buy, sell) from month X have
+    returned?" from pe and price series that are loaded once and kept in
+    memory, reloading them when the CAPE data file changes.
+
+    Queries submitted concurrently are collected for `batch_window` seconds
+    and simulated together with `evaluate_thresholds`. `serve` puts a JSON
+    API in front of it: POST /query takes one query or a list of them, and
+    GET /status describes the loaded data.
+
+    A query is a dict with `buy_at` and optionally `sell_at` (the buy
+    threshold by default), `start` and `end` months as `MM/YYYY` (the first
+    and last months of the data by default, both inclusive).
+
+    The price cache is kept in `cache_dir`, as for `CapeValidator`.
+
+    """
+    def __init__(self, pe_data_file, start_date, end_date=None,
+                 index='^GSPC', price_source=None, batch_window=0.002,
+                 init_cash=10000., income=2000., cache_dir=None):
+        self.pe_data_file = pe_data_file
+        self.cache_dir = cache_dir
+        self.start_date = start_date
+        self.end_date = end_date
+        self.index = index
+        self.price_source = price_source
+        self.batch_window = batch_window
+        self.init_cash = init_cash
+        self.income = income
+        self.stats = RunStats()
+        self._mtime = None
+        self._pending = []
+        self._closed = False
+        self._condition = threading.Condition()
+        self.reload()
+        self._batcher = threading.Thread(target=self._run_batches,
+                                         daemon=True)
+        self._batcher.start()
+
+    def reload(self):
+        """Load the pe data and the prices of its months"""
+        with self.stats.phase('reload'):
+            mtime = os.stat(self.pe_data_file).st_mtime_ns
+            validator = CapeValidator(
+                self.pe_data_file, self.start_date, [],
+                end_date=self.end_date, index=self.index,
+                price_source=self.price_source, cache_dir=self.cache_dir)
+            market_prices = validator._get_market_prices(
+                validator._pe_datetimes())
+            validator.save_index_cache()
+            # rows are dated just after the month they are the CAPE of
+            self.months = validator.pe_dates.astype('datetime64[M]') - 1
+            self.pe_ratios = validator.pe_ratios
+            self.market_prices = market_prices
+            self._mtime = mtime
+        self.stats.count('reloads')
+
+    def _month(self, month_str, side):
+        month = numpy.datetime64(datetime.strptime(month_str, '%m/%Y'), 'M')
+        return int(numpy.searchsorted(self.months, month, side))
+
+    def _parse_query(self, query):
+        buy_at = float(query['buy_at'])
+        sell_at = float(query.get('sell_at', buy_at))
+        start = self._month(query['start'], 'left') \
+            if query.get('start') else 0
+        end = self._month(query['end'], 'right') \
+            if query.get('end') else len(self.months)
+        if end <= start:
+            raise ValueError("No CAPE data from {} to {}".format(
+                query.get('start'), query.get('end')))
+        return buy_at, sell_at, start, end
+
+    def evaluate(self, queries):
+        """Simulate `queries` in one batch. Returns a result dict, or the
+        ValueError raised by an invalid query, for each query.
+
+        """
+        results = [None] * len(queries)
+        rows = []
+        for i, query in enumerate(queries):
+            try:
+                rows.append((i,) + self._parse_query(query))
+            except (KeyError, TypeError, ValueError) as e:
+                results[i] = ValueError("Invalid query {!r}: {}".format(
+                    query, e))
+        if not rows:
+            return results
+        positions, buys, sells, starts, ends = zip(*rows)
+        with self.stats.phase('evaluate'):
+            final_worth, cagr = evaluate_thresholds(
+                self.pe_ratios, self.market_prices, buys, sells, starts,
+                ends, self.init_cash, self.income)
+        for j, i in enumerate(positions):
+            results[i] = {
+                'buy_at': buys[j], 'sell_at': sells[j],
+                'start': '{:%m/%Y}'.format(
+                    self.months[starts[j]].astype(datetime)),
+                'end': '{:%m/%Y}'.format(
+                    self.months[ends[j] - 1].astype(datetime)),
+                'months': ends[j] - starts[j],
+                'final_worth': float(final_worth[j]),
+                'cagr': None if numpy.isnan(cagr[j]) else float(cagr[j]),
+            }
+        return results
+
+    def submit(self, queries):
+        """Queue `queries` for the next batch and wait for their results,
+        as from `evaluate`
+
+        """
+        items = [{'query': query, 'done': threading.Event()}
+                 for query in queries]
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The query server is closed")
+            self._pending.extend(items)
+            self._condition.notify()
+        for item in items:
+            item['done'].wait()
+        return [item['result'] for item in items]
+
+    def _run_batches(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+            # give queries arriving at the same time the chance to join
+            time.sleep(self.batch_window)
+            with self._condition:
+                batch, self._pending = self._pending, []
+            try:
+                if os.stat(self.pe_data_file).st_mtime_ns != self._mtime:
+                    self.reload()
+                results = self.evaluate([item['query'] for item in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            self.stats.count('batches')
+            self.stats.count('queries', len(batch))
+            for item, result in zip(batch, results):
+                item['result'] = result
+                item['done'].set()
+
+    def close(self):
+        """Stop the batching thread, failing any queries still queued"""
+        with self._condition:
+            self._closed = True
+            pending, self._pending = self._pending, []
+            self._condition.notify()
+        for item in pending:
+            item['result'] = RuntimeError("The query server is closed")
+            item['done'].set()
+        self._batcher.join()
+
+    def status(self):
+        """The loaded data and the run statistics"""
+        first, last = ['{:%m/%Y}'.format(month.astype(datetime))
+                       for month in self.months[[0, -1]]] \
+            if len(self.months) else (None, None)
+        return {'index': self.index, 'months': len(self.months),
+                'first': first, 'last': last, 'stats': self.stats.as_dict()}
+
+    def serve(self, host='127.0.0.1', port=8000):
+        """An HTTP server for the JSON API, to be run with `serve_forever`"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, code, body):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if urlsplit(self.path).path != '/status':
+                    return self._reply(404, {'error': 'Not found'})
+                self._reply(200, server.status())
+
+            def do_POST(self):
+                if urlsplit(self.path).path != '/query':
+                    return self._reply(404, {'error': 'Not found'})
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    queries = json.loads(self.rfile.read(length))
+                except ValueError as e:
+                    return self._reply(400, {'error': str(e)})
+                single = not isinstance(queries, list)
+                results = [
+                    {'error': str(result)}
+                    if isinstance(result, Exception) else result
+                    for result in server.submit(
+                        [queries] if single else queries)]
+                self._reply(200, results[0] if single else results)
+
+            def log_message(self, format, *args):
+                pass
+
+        return ThreadingHTTPServer((host, port), Handler)
+
+
+def _parse_range(range_str):
+    """Parse `start:stop:step` (stop inclusive) or a comma separated list"""
+    if ':' not in range_str:
+        return numpy.array([float(x) for x in range_str.split(',')])
+    start, stop, step = [float(x) for x in range_str.split(':')]
+    count = int(numpy.floor((stop - start) / step + 1e-9)) + 1
+    return numpy.round(start + step * numpy.arange(count), 10)
+
+
+def _add_common_arguments(parser, validator=True):
+    # commands that do not go through `_make_validator` only take the
+    # options they use, so that the others are rejected instead of ignored
+    if validator:
+        default_thresholds = ','.join(
+            str(i) for i in range(16, 26)) + ',1000'
+        parser.add_argument('-t', '--buy_thresholds',
+                            default=default_thresholds)
+        parser.add_argument('--sell_thresholds', default=None)
     parser.add_argument('--pe_file', default='pe_data.csv')
-    parser.add_argument('--index', default='^GSPC')
+    parser.add_argument('--index', default='^GSPC',
+                        help='stock symbol of the index. `run` also takes a '
+                             'comma separated list to compare indices.')
+    parser.add_argument('--price_file', default=None,
+                        help='read prices from this csv/npy file instead of '
+                             'yahoo. May contain an {index} placeholder.')
     parser.add_argument('--start_date', default='01/1980')
     parser.add_argument('--end_date', default=None)
-    args = parser.parse_args()
+    parser.add_argument('--stats_json', '--stats-json', default=None,
+                        help='write phase timings and cache counters to this '
+                             'JSON file')
+    if validator:
+        parser.add_argument('--fetch_concurrency', type=int, default=None,
+                            help='fetch missing prices with this many '
+                                 'concurrent requests instead of through '
+                                 'pandas')
+        parser.add_argument('--result_cache', default=None,
+                            help='directory to cache simulation results in')
+        parser.add_argument('--result_cache_bytes', type=int,
+                            default=2 ** 30,
+                            help='size the result cache is kept under')
+        parser.add_argument('--cache_dir', default=None,
+                            help='directory of the index price cache, by '
+                                 'default the current directory')
 
+
+def _make_validator(args, investors=True):
     buys = [float(b) for b in args.buy_thresholds.split(',')]
     sells = args.sell_thresholds
     if sells:
         sells = [float(b) for b in sells.split(',')]
+    if not investors:
+        buys, sells = [], None
     d0 = datetime.strptime(args.start_date, '%m/%Y')
     if args.end_date:
         d1 = datetime.strptime(args.end_date, '%m/%Y')
     else:
         d1 = datetime.now()
+    source = None
+    if args.price_file:
+        source = LocalPriceSource(args.price_file)
+    elif args.fetch_concurrency:
+        source = AsyncHttpPriceSource(max_in_flight=args.fetch_concurrency)
+    if ',' in args.index:
+        return MultiIndexValidator(args.pe_file, d0, buys, sells, d1,
+                                   args.index.split(','), source,
+                                   cache_dir=args.cache_dir)
+    cache = None
+    if args.result_cache:
+        cache = ResultCache(args.result_cache, args.result_cache_bytes)
+    return CapeValidator(args.pe_file, d0, buys, sells, d1, args.index,
+                         source, result_cache=cache,
+                         cache_dir=args.cache_dir)
+
 
-    validator = CapeValidator(args.pe_file, d0, buys, sells, d1, args.index)
+def _run_indices(args):
+    validator = _make_validator(args)
     validator.calculate_worth_vs_time()
-    import ipdb; ipdb.set_trace()
-    validator.plot_worth_vs_time()
-    # validator.plot_pe_ratio()
-    plt.show()
+    print('index,buy_at,sell_at,final_worth')
+    for index, final_worth in sorted(validator.final_worth().items()):
+        for investor, worth in zip(validator[index].investors, final_worth):
+            print('{},{},{},{:0.2f}'.format(index, investor.buy_at,
+                                            investor.sell_at, worth))
+    return validator
+
+
+def _run(args):
+    if ',' in args.index:
+        return _run_indices(args)
+    validator = _make_validator(args)
+    if args.output_dir or args.outputs is not None or args.float32 or \
+            args.daily:
+        outputs = () if args.daily else SimulationOutput.matrices
+        if args.outputs is not None:
+            outputs = [name for name in args.outputs.split(',') if name]
+        output = SimulationOutput(
+            outputs, 'float32' if args.float32 else float, args.output_dir)
+        if args.daily:
+            validator.calculate_daily(args.daily, output)
+        else:
+            validator.calculate_worth_vs_time(args.engine, output)
+        print(','.join(('buy_at', 'sell_at') + ResultSummary.fields))
+        for i, investor in enumerate(validator.investors):
+            print('{},{},{}'.format(
+                investor.buy_at, investor.sell_at,
+                ','.join('{:0.4f}'.format(getattr(output.summary, name)[i])
+                         for name in ResultSummary.fields)))
+        return validator
+    validator.calculate_worth_vs_time(args.engine)
+    if args.state:
+        validator.save_state(args.state)
+    print('buy_at,sell_at,final_worth')
+    for investor, worth in zip(validator.investors,
+                               validator.suite.get_net_worth(
+                                   validator.market_prices[-1])):
+        print('{},{},{:0.2f}'.format(investor.buy_at, investor.sell_at,
+                                     worth))
+    return validator
+
+
+def _sweep(args):
+    validator = _make_validator(args, investors=False)
+    grid = validator.sweep(_parse_range(args.buy_range),
+                           _parse_range(args.sell_range),
+                           max_workers=args.workers, engine=args.engine)
+    if args.output:
+        grid.save(args.output)
+    if args.heatmap_output:
+        grid.render_heatmap(args.heatmap_output)
+    print('Best: buy at {:0.2f}, sell at {:0.2f}, worth {:0.2f}'.format(
+        *grid.best()))
+    return validator
+
+
+def _optimize(args):
+    validator = _make_validator(args, investors=False)
+    optimum = validator.optimize(args.objective, coarse=args.coarse,
+                                 keep=args.keep, restarts=args.restarts)
+    print('Best {}: {:0.4f} buying at {:0.2f} (up to {:0.2f}), selling '
+          'above {:0.2f} (up to {:0.2f}), after {} of {} simulations'.format(
+              args.objective, optimum.value, optimum.buy_at,
+              optimum.buy_range[1], optimum.sell_at, optimum.sell_range[1],
+              optimum.evaluations, optimum.levels ** 2))
+    return validator
+
+
+def _sharded_sweep(args):
+    d0 = datetime.strptime(args.start_date, '%m/%Y')
+    d1 = datetime.strptime(args.end_date, '%m/%Y') if args.end_date \
+        else None
+    sweep = ShardedSweep.create(
+        args.sweep_dir, args.pe_file, d0, _parse_range(args.buy_range),
+        _parse_range(args.sell_range), args.shards, d1,
+        args.index.split(','), args.start_stride, args.price_file)
+    tables = sweep.run_local(args.processes)
+    for index, table in sorted(tables.items()):
+        table.save(os.path.join(args.sweep_dir, 'result_{}.npz'.format(
+            index.lstrip('^'))))
+        mean = table.cagr.mean(axis=0)
+        best = numpy.argmax(mean)
+        print('{}: best mean annualized return {:0.4f} buying at {:0.2f}, '
+              'selling above {:0.2f}'.format(
+                  index, mean[best], table.buy_thresholds[best],
+                  table.sell_thresholds[best]))
+    return sweep
+
+
+def _serve(args):
+    d0 = datetime.strptime(args.start_date, '%m/%Y')
+    d1 = datetime.strptime(args.end_date, '%m/%Y') if args.end_date \
+        else None
+    source = LocalPriceSource(args.price_file) if args.price_file else None
+    server = QueryServer(args.pe_file, d0, d1, args.index, source,
+                         args.batch_window, cache_dir=args.cache_dir)
+    httpd = server.serve(args.host, args.port)
+    print('Serving {} months of {} on http://{}:{}'.format(
+        len(server.months), args.index, *httpd.server_address[:2]))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        server.close()
+    return server
+
+
+def _worker(args):
+    shard, shards = [int(x) for x in args.shard.split('/')]
+    sweep = ShardedSweep(args.sweep_dir)
+    sweep.run_shard(shard, shards)
+    return sweep
+
+
+def _plot(args):
+    validator = _make_validator(args)
+    validator.calculate_worth_vs_time(args.engine)
+    if args.show:
+        from matplotlib import pyplot as plt
+        validator.plot_worth_vs_time()
+        validator.plot_pe_ratio()
+        plt.show()
+        return validator
+    validator.render_worth_vs_time(args.output, args.width, args.height,
+                                   args.dpi)
+    if args.pe_output:
+        validator.render_pe_ratio(args.pe_output, args.width, args.height,
+                                  args.dpi)
+    return validator
+
+
+def _rolling(args):
+    validator = _make_validator(args)
+    validator.rolling_starts(args.start_stride).save_csv(args.output)
+    return validator
+
+
+def _monte_carlo(args):
+    validator = _make_validator(args)
+    result = validator.monte_carlo(args.paths, block=args.block,
+                                   seed=args.seed)
+    result.save_csv(args.output)
+    return validator
+
+
+def main(argv=None):
+    """Command line entry point. Every command runs unattended."""
+    parser = argparse.ArgumentParser(description="CAPE Value determination")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser(
+        'run', help='simulate the investors and print their final worth')
+    run.add_argument('--state', default=None,
+                     help='save the results to this directory, see '
+                          'CapeValidator.save_state')
+    run.add_argument('--output_dir', default=None,
+                     help='stream the results to .npy files and a summary '
+                          'in this directory')
+    run.add_argument('--outputs', default=None,
+                     help='comma separated matrices to keep out of worth, '
+                          'shares and cash. Empty for the summary only.')
+    run.add_argument('--float32', action='store_true',
+                     help='keep the matrices as float32')
+    run.add_argument('--daily', choices=('ffill', 'linear'), default=None,
+                     help='simulate every trading day, spreading the '
+                          'monthly CAPE over the days with this method. '
+                          'Always steps day by day, so not with --engine.')
+    run.set_defaults(func=_run)
+
+    sweep = commands.add_parser(
+        'sweep', help='sweep the full grid of --buy_range x --sell_range '
+                      'thresholds')
+    sweep.add_argument('--buy_range', default='10:30:0.1',
+                       help='start:stop:step (inclusive) or a list')
+    sweep.add_argument('--sell_range', default='10:30:0.1',
+                       help='start:stop:step (inclusive) or a list')
+    sweep.add_argument('--workers', type=int, default=None)
+    sweep.add_argument('--output', '--sweep_output', default=None,
+                       help='save the sweep grid to this .npz file')
+    sweep.add_argument('--heatmap_output', default=None,
+                       help='render the grid to this png/svg file')
+    sweep.set_defaults(func=_sweep)
+
+    optimize = commands.add_parser(
+        'optimize', help='search for the best thresholds without a full '
+                         'sweep')
+    optimize.add_argument('--objective', default='final_worth',
+                          choices=('final_worth', 'cagr', 'calmar'))
+    optimize.add_argument('--coarse', type=int, default=96,
+                          help='levels per side of the initial grid')
+    optimize.add_argument('--keep', type=int, default=8,
+                          help='best pairs refined in each round')
+    optimize.add_argument('--restarts', type=int, default=8,
+                          help='next best pairs of the initial grid to '
+                               'refine on their own')
+    optimize.set_defaults(func=_optimize)
+
+    sharded = commands.add_parser(
+        'sharded_sweep', help='sweep --buy_range x --sell_range from every '
+                              'start date on every --index, in shards run '
+                              'by worker processes')
+    sharded.add_argument('--sweep_dir', required=True,
+                         help='shared directory for the plan and results')
+    sharded.add_argument('--buy_range', default='10:30:0.5',
+                         help='start:stop:step (inclusive) or a list')
+    sharded.add_argument('--sell_range', default='10:30:0.5',
+                         help='start:stop:step (inclusive) or a list')
+    sharded.add_argument('--start_stride', type=int, default=12)
+    sharded.add_argument('--shards', type=int, default=16)
+    sharded.add_argument('--processes', type=int, default=None,
+                         help='worker processes to run at once')
+    sharded.set_defaults(func=_sharded_sweep)
+
+    serve = commands.add_parser(
+        'serve', help='answer threshold queries over a local JSON API')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--batch_window', type=float, default=0.002,
+                       help='seconds to collect concurrent queries for')
+    serve.add_argument('--cache_dir', default=None,
+                       help='directory of the index price cache, by default '
+                            'the current directory')
+    serve.set_defaults(func=_serve)
+
+    worker = commands.add_parser(
+        'worker', help='run one shard of a sharded sweep')
+    worker.add_argument('--shard', required=True, help='k/N')
+    worker.add_argument('--sweep_dir', required=True)
+    worker.add_argument('--stats_json', '--stats-json', default=None,
+                        help='write phase timings and cache counters to '
+                             'this JSON file')
+    worker.set_defaults(func=_worker)
+
+    plot = commands.add_parser(
+        'plot', help='simulate the investors and render their worth')
+    plot.add_argument('--output', '--plot_output', default='worth.png',
+                      help='png/svg file for the worth plot')
+    plot.add_argument('--pe_output', default=None,
+                      help='png/svg file for the pe ratio plot')
+    plot.add_argument('--width', type=int, default=1200)
+    plot.add_argument('--height', type=int, default=600)
+    plot.add_argument('--dpi', type=int, default=100)
+    plot.add_argument('--show', action='store_true',
+                      help='show the plots interactively instead')
+    plot.set_defaults(func=_plot)
+
+    rolling = commands.add_parser(
+        'rolling', help='evaluate the thresholds from every start date from '
+                        '--start_date on')
+    rolling.add_argument('--start_stride', type=int, default=1,
+                         help='months between start dates')
+    rolling.add_argument('--output', '--rolling_output',
+                         default='rolling_starts.csv',
+                         help='csv file for the table')
+    rolling.set_defaults(func=_rolling)
+
+    monte_carlo = commands.add_parser(
+        'monte_carlo', help='evaluate the thresholds on bootstrapped '
+                            'synthetic pe and price series')
+    monte_carlo.add_argument('--paths', type=int, default=1000,
+                             help='number of synthetic series')
+    monte_carlo.add_argument('--block', type=int, default=12,
+                             help='months per bootstrap block')
+    monte_carlo.add_argument('--seed', type=int, default=0)
+    monte_carlo.add_argument('--output', '--monte_carlo_output',
+                             default='monte_carlo.csv',
+                             help='csv file for the summary')
+    monte_carlo.set_defaults(func=_monte_carlo)
+
+    for command in (run, sweep, optimize, plot, rolling, monte_carlo):
+        _add_common_arguments(command)
+    for command in (sharded, serve):
+        _add_common_arguments(command, validator=False)
+    for command in (run, sweep, plot):
+        command.add_argument('--engine', choices=('step', 'event'),
+                             default='step',
+                             help='simulate month by month or between '
+                                  'threshold crossings; event is only '
+                                  'faster for sparse crossings, e.g. daily '
+                                  'data or thresholds far from the usual '
+                                  'pe ratios')
+    args = parser.parse_args(argv)
+    if args.command != 'sharded_sweep' and ',' in getattr(args, 'index', ''):
+        # only run compares several indices, and only in memory
+        if args.command != 'run':
+            parser.error("{} takes a single --index".format(args.command))
+        given = [option for option, value in (
+            ('--engine', args.engine != 'step'), ('--state', args.state),
+            ('--output_dir', args.output_dir),
+            ('--outputs', args.outputs is not None),
+            ('--float32', args.float32), ('--daily', args.daily),
+            ('--result_cache', args.result_cache)) if value]
+        if given:
+            parser.error("{} can not be used with several indices".format(
+                ', '.join(given)))
+    if args.command == 'run':
+        # a run kept in a SimulationOutput is not saved or cached, and only
+        # the step engine fills one
+        outputs = [option for option, value in (
+            ('--output_dir', args.output_dir),
+            ('--outputs', args.outputs is not None),
+            ('--float32', args.float32), ('--daily', args.daily)) if value]
+        given = [option for option, value in (
+            ('--engine', args.engine != 'step'), ('--state', args.state),
+            ('--result_cache', args.result_cache)) if value]
+        if outputs and given:
+            parser.error("{} can not be used with {}".format(
+                ', '.join(given), ', '.join(outputs)))
+    validator = args.func(args)
+    if args.stats_json:
+        validator.stats.save_json(args.stats_json)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 setup(
     name='foo',
     version='1.0',
@@ -6,7 +6,11 @@ setup(
     author='Will Gaggioli',
     author_email='wgaggioli@gmail.com',
     install_requires=[
+        'numpy',
         'pandas',
         'matplotlib'
-    ]
+    ],
+    entry_points={
+        'console_scripts': ['capeval = capeval:main'],
+    },
 )
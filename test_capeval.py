@@ -1,8 +1,34 @@
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 import numpy
 
-from capeval import Investor, CapeValidator
+from capeval import (Investor, InvestorSuite, CapeValidator,
+                     LocalPriceSource, PriceStore, ThresholdGrid,
+                     AsyncHttpPriceSource, PriceFetchError, RunStats,
+                     sweep_thresholds, load_pe_data, parse_pe_data,
+                     StartDateTable, annualized_return,
+                     rolling_start_analysis,
+                     simulate_events, bootstrap_paths, monte_carlo,
+                     MonteCarloResult, SimulationOutput, ResultSummary,
+                     MultiIndexValidator, ThresholdStrategy,
+                     PeScaledAllocation, DollarCostAveraging,
+                     RebalancingBands, ResultCache, TradingCalendar,
+                     daily_pe, threshold_levels, optimize_thresholds,
+                     ShardedSweep, evaluate_thresholds, QueryServer,
+                     main, _downsample, _parse_range)
 
 
 class TestInvestor(unittest.TestCase):
@@ -105,14 +131,1291 @@ class TestInvestor(unittest.TestCase):
         self.assertEqual(investor2.cash, 0.)
 
 
-class TestCapeValidator(unittest.TestCase):
+class TestInvestorSuite(unittest.TestCase):
     def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.pe = 15. + 10. * rng.random_sample(120)
+        self.prices = 100. * numpy.cumprod(
+            1. + 0.05 * rng.standard_normal(120))
+        self.buys = [14., 18., 20., 22., 24., 26., 19.5, 21.]
+        self.sells = [14., 18., 23., 22., 24., 26., 17., 25.]
+
+    def test_init(self):
+        suite = InvestorSuite(self.buys)
+        self.assertEqual(len(suite), len(self.buys))
+        self.assertEqual(list(suite.sell_at), self.buys)
+        self.assertEqual(list(suite.cash), [10000.] * len(self.buys))
+        self.assertEqual(list(suite.shares), [0.] * len(self.buys))
+        self.assertEqual(list(suite.income), [2000.] * len(self.buys))
+
+        investors = [Investor(16., 20., 5000., 22., 1000.), Investor(18.)]
+        suite = InvestorSuite.from_investors(investors)
+        self.assertEqual(list(suite.buy_at), [16., 18.])
+        self.assertEqual(list(suite.sell_at), [20., 18.])
+        self.assertEqual(list(suite.cash), [5000., 10000.])
+        self.assertEqual(list(suite.shares), [22., 0.])
+        self.assertEqual(list(suite.income), [1000., 2000.])
+
+    def test_matches_investors(self):
+        investors = [Investor(b, s) for b, s in zip(self.buys, self.sells)]
+        investors.append(Investor(20., 20., init_cash=0., income=0.))
+        investors.append(Investor(20., 22., shares=50., income=0.))
+        suite = InvestorSuite.from_investors(investors)
+
+        size = (len(investors), len(self.pe))
+        worth, shares, cash = [numpy.empty(size) for _ in range(3)]
+        suite.simulate(self.pe, self.prices, worth, shares, cash)
+
+        for i, (pe, price) in enumerate(zip(self.pe, self.prices)):
+            for j, investor in enumerate(investors):
+                investor.get_paid()
+                investor.react_to_pe(pe, price)
+                self.assertEqual(worth[j][i], investor.get_net_worth(price))
+                self.assertEqual(shares[j][i], investor.shares)
+                self.assertEqual(cash[j][i], investor.cash)
+        self.assertEqual(list(suite.cash), [inv.cash for inv in investors])
+        self.assertEqual(list(suite.shares),
+                         [inv.shares for inv in investors])
+
+
+class TestStrategies(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(6)
+        self.pe = 15. + 10. * rng.random_sample(120)
+        self.prices = 100. * numpy.cumprod(
+            1. + 0.05 * rng.standard_normal(120))
+        self.buys = [14., 18., 20., 22., 24., 19.5]
+        self.sells = [14., 18., 23., 22., 24., 17.]
+
+    def run_suite(self, suite):
+        size = (len(suite), len(self.pe))
+        worth, shares, cash = [numpy.empty(size) for _ in range(3)]
+        suite.simulate(self.pe, self.prices, worth, shares, cash)
+        return worth, shares, cash
+
+    def test_threshold_is_default(self):
+        expected = self.run_suite(InvestorSuite(self.buys, self.sells))
+        for strategies in (ThresholdStrategy(),
+                           [ThresholdStrategy() for _ in self.buys]):
+            results = self.run_suite(
+                InvestorSuite(self.buys, self.sells, strategies=strategies))
+            for result, matrix in zip(results, expected):
+                self.assertTrue((result == matrix).all())
+        # and so equal to stepping each `Investor`
+        investor = Investor(self.buys[5], self.sells[5])
+        for pe, price in zip(self.pe, self.prices):
+            investor.get_paid()
+            investor.react_to_pe(pe, price)
+        self.assertEqual(expected[0][5, -1],
+                         investor.get_net_worth(self.prices[-1]))
+
+    def test_side_by_side(self):
+        families = [
+            (PeScaledAllocation([12., 15.], [25., 30.]), 2),
+            (DollarCostAveraging([1000., 5000.]), 2),
+            (RebalancingBands([0.6, 0.8], 0.05, [1., 0.5]), 2),
+            (ThresholdStrategy(), 2),
+        ]
+        buys = [20., 22.] * 4
+        alone = []
+        for strategy, count in families:
+            alone.append(self.run_suite(InvestorSuite(
+                buys[:count], strategies=strategy)))
+        # interleave the families so that they are not contiguous
+        order = [0, 2, 4, 6, 1, 3, 5, 7]
+        strategies = [families[i // 2][0] for i in order]
+        together = self.run_suite(InvestorSuite(
+            [buys[i] for i in order], strategies=strategies))
+        for position, i in enumerate(order):
+            for result, matrices in zip(together, alone[i // 2]):
+                self.assertTrue((result[position] == matrices[i % 2]).all())
+        self.assertRaises(ValueError, InvestorSuite, buys,
+                          strategies=strategies[:3])
+
+    def test_kernels(self):
+        worth, shares, cash = self.run_suite(InvestorSuite(
+            [0.], strategies=DollarCostAveraging(3000.)))
+        # the initial cash is spent 3000 a month on top of the income
+        self.assertEqual(list(cash[0, :4]), [9000., 8000., 7000., 6000.])
+        self.assertEqual(cash[0, -1], 0.)
+        self.assertTrue((numpy.diff(shares[0]) > 0.).all())
+
+        worth, shares, cash = self.run_suite(InvestorSuite(
+            [0.], strategies=PeScaledAllocation(15., 25.)))
+        fraction = shares[0] * self.prices / worth[0]
+        numpy.testing.assert_allclose(
+            fraction, numpy.clip((25. - self.pe) / 10., 0., 1.))
+        self.assertRaises(ValueError, PeScaledAllocation, 20., 20.)
+        self.assertRaises(ValueError, PeScaledAllocation, [15., 25.], 20.)
+
+        worth, shares, cash = self.run_suite(InvestorSuite(
+            [0.], strategies=RebalancingBands(0.7, 0.1)))
+        fraction = shares[0] * self.prices / worth[0]
+        self.assertTrue((numpy.abs(fraction - 0.7) <= 0.1 + 1e-12).all())
+
+    def test_batched_axes(self):
+        strategies = [PeScaledAllocation(15., 25.), ThresholdStrategy()]
+        suite = InvestorSuite([[20., 20.]], strategies=strategies,
+                              init_cash=numpy.full((3, 1), 10000.))
+        prices = self.prices[:, numpy.newaxis, numpy.newaxis] * \
+            numpy.array([[1.], [2.], [3.]])
+        suite.simulate(self.pe, prices)
+        single = InvestorSuite([20., 20.], strategies=strategies)
+        single.simulate(self.pe, self.prices * 2.)
+        numpy.testing.assert_allclose(suite.shares[1], single.shares)
+
+
+class TestSimulateEvents(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(2)
+        self.pe = 20. + numpy.cumsum(rng.standard_normal(240))
+        self.prices = 100. * numpy.cumprod(
+            1. + 0.05 * rng.standard_normal(240))
+
+    def check(self, buys, sells, init_cash=10000., shares=0., income=2000.):
+        suite = InvestorSuite(buys, sells, init_cash, shares, income)
+        size = (len(suite), len(self.pe))
+        worth, shares_, cash = [numpy.empty(size) for _ in range(3)]
+        suite.simulate(self.pe, self.prices, worth, shares_, cash)
+        events = simulate_events(self.pe, self.prices, buys, sells,
+                                 init_cash, shares, income)
+        numpy.testing.assert_allclose(events.cash, suite.cash, atol=1e-6)
+        numpy.testing.assert_allclose(events.shares, suite.shares)
+        numpy.testing.assert_allclose(
+            events.final_worth(), suite.get_net_worth(self.prices[-1]))
+        numpy.testing.assert_allclose(events.worth_matrix, worth)
+        numpy.testing.assert_allclose(events.shares_matrix, shares_)
+        numpy.testing.assert_allclose(events.cash_matrix, cash, atol=1e-6)
+        return events
+
+    def test_matches_suite(self):
+        rng = numpy.random.RandomState(3)
+        buys = numpy.round(10. + 20. * rng.random_sample(50), 1)
+        sells = numpy.round(10. + 20. * rng.random_sample(50), 1)
+        self.check(buys, sells)
+        self.check(buys, buys)
+        self.check(buys, sells, init_cash=0., shares=50., income=0.)
+        # thresholds equal to pe values and ones never crossed
+        self.check([self.pe[10], 0., 1000., 0.], [self.pe[10], 1000., 0., 0.])
+
+    def test_fewer_events_than_cells(self):
+        events = self.check([15., 20.], [25., 30.])
+        self.assertLess(events.events, 2 * len(self.pe))
+        self.assertEqual(events.months, len(self.pe))
+
+    def test_alternating(self):
+        # sell below buy: alternates while the pe ratio is between them
+        rng = numpy.random.RandomState(4)
+        sells = numpy.round(10. + 10. * rng.random_sample(40), 1)
+        buys = sells + numpy.round(20. * rng.random_sample(40), 1)
+        self.check(buys, sells)
+        self.check(buys, sells, init_cash=500., shares=20., income=100.)
+        # one segment for the whole series, whatever its length
+        events = self.check([1000.], [0.], shares=[10.])
+        self.assertEqual(events.events, 1)
+
+    def test_empty(self):
+        events = simulate_events(self.pe, self.prices, [])
+        self.assertEqual(events.worth_matrix.shape, (0, len(self.pe)))
+        events = simulate_events(self.pe[:0], self.prices[:0], [20.])
+        self.assertEqual(list(events.final_worth()), [10000.])
+
+
+class TestSweepThresholds(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(1)
+        self.pe = 15. + 10. * rng.random_sample(60)
+        self.prices = 100. * numpy.cumprod(
+            1. + 0.05 * rng.standard_normal(60))
+        self.buys = _parse_range('15:25:2.5')
+        self.sells = _parse_range('16,20,24')
+
+    def test_parse_range(self):
+        self.assertEqual(list(self.buys), [15., 17.5, 20., 22.5, 25.])
+        self.assertEqual(list(_parse_range('0.1:0.3:0.1')), [0.1, 0.2, 0.3])
+
+    def check_grid(self, grid):
+        self.assertEqual(grid.worth.shape, (5, 3))
+        for buy in self.buys:
+            for sell in self.sells:
+                investor = Investor(buy, sell)
+                for pe, price in zip(self.pe, self.prices):
+                    investor.get_paid()
+                    investor.react_to_pe(pe, price)
+                self.assertEqual(grid[buy, sell],
+                                 investor.get_net_worth(self.prices[-1]))
+        buy, sell, worth = grid.best()
+        self.assertEqual(worth, grid.worth.max())
+        self.assertEqual(grid[buy, sell], worth)
+        self.assertRaises(KeyError, grid.__getitem__, (1., 2.))
+
+    def test_serial(self):
+        self.check_grid(sweep_thresholds(
+            self.pe, self.prices, self.buys, self.sells, chunk_size=4,
+            max_workers=1))
+
+    def test_process_pool(self):
+        self.check_grid(sweep_thresholds(
+            self.pe, self.prices, self.buys, self.sells, chunk_size=4,
+            max_workers=2))
+
+    def test_event_engine(self):
+        grid = sweep_thresholds(self.pe, self.prices, self.buys, self.sells,
+                                max_workers=1, engine='event')
+        expected = sweep_thresholds(self.pe, self.prices, self.buys,
+                                    self.sells, max_workers=1)
+        numpy.testing.assert_allclose(grid.worth, expected.worth)
+
+    def test_save_load(self):
+        grid = sweep_thresholds(self.pe, self.prices, self.buys, self.sells,
+                                max_workers=1)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'grid.npz')
+            grid.save(filename)
+            loaded = ThresholdGrid.load(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(list(loaded.buy_thresholds), list(self.buys))
+        self.assertEqual(list(loaded.sell_thresholds), list(self.sells))
+        self.assertTrue((loaded.worth == grid.worth).all())
+
+
+class TestOptimizeThresholds(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(2)
+        self.pe = numpy.round(20. * numpy.exp(numpy.cumsum(
+            0.04 * rng.standard_normal(120))), 1)
+        self.prices = 100. * numpy.exp(numpy.cumsum(
+            0.005 + 0.04 * rng.standard_normal(120)))
+        self.levels = threshold_levels(self.pe)
+
+    def test_levels(self):
+        levels = self.levels
+        self.assertEqual(list(levels[1:]), sorted(set(self.pe)))
+        self.assertLess(levels[0], self.pe.min())
+        # thresholds between two levels act like the lower one
+        grid = sweep_thresholds(self.pe, self.prices, levels,
+                                levels[[0, 5, -1]], max_workers=1)
+        between = sweep_thresholds(
+            self.pe, self.prices, (levels + numpy.append(levels[1:],
+                                                         1000.)) / 2.,
+            levels[[0, 5, -1]] + 0.01, max_workers=1)
+        numpy.testing.assert_allclose(grid.worth, between.worth)
+
+    def test_matches_full_sweep(self):
+        grid = sweep_thresholds(self.pe, self.prices, self.levels,
+                                self.levels, max_workers=1)
+        optimum = optimize_thresholds(self.pe, self.prices, coarse=16,
+                                      keep=4, restarts=2)
+        # the refinement is a heuristic, it gets near the grid optimum
+        self.assertGreater(optimum.value, 0.99 * grid.worth.max())
+        self.assertAlmostEqual(grid[optimum.buy_at, optimum.sell_at],
+                               optimum.value)
+        self.assertLess(optimum.evaluations, grid.worth.size / 4)
+        self.assertEqual(optimum.levels ** 2, grid.worth.size)
+        i = list(self.levels).index(optimum.buy_at)
+        self.assertEqual(optimum.buy_range,
+                         (self.levels[i], self.levels[i + 1]))
+        self.assertEqual(optimum.values.max(), optimum.value)
+
+    def test_real_length(self):
+        # the bundled series, at 0.1 resolution to keep the full grid small
+        pe = numpy.round(load_pe_data('pe_data.csv', use_cache=False)[1], 1)
+        rng = numpy.random.RandomState(0)
+        prices = 100. * numpy.exp(numpy.cumsum(
+            0.004 + 0.04 * rng.standard_normal(len(pe))))
+        levels = threshold_levels(pe)
+        grid = sweep_thresholds(pe, prices, levels, levels, engine='event')
+        optimum = optimize_thresholds(pe, prices)
+        self.assertAlmostEqual(optimum.value / grid.worth.max(), 1.)
+        self.assertLess(optimum.evaluations, grid.worth.size / 4)
+
+    def test_objectives(self):
+        for objective in ('cagr', 'calmar'):
+            optimum = optimize_thresholds(self.pe, self.prices, objective)
+            self.assertTrue(numpy.isfinite(optimum.value))
+            self.assertEqual(optimum.values.max(), optimum.value)
+        self.assertRaises(ValueError, optimize_thresholds, self.pe,
+                          self.prices, 'sharpe')
+
+
+class TestMonteCarlo(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(4)
+        self.pe = 20. * numpy.exp(numpy.cumsum(
+            0.03 * rng.standard_normal(100)))
+        self.prices = 100. * numpy.exp(numpy.cumsum(
+            0.005 + 0.04 * rng.standard_normal(100)))
+        self.buys = [15., 20., 25., 1000.]
+        self.sells = [20., 20., 30., 1000.]
+
+    def test_bootstrap_paths(self):
+        pe, prices = bootstrap_paths(self.pe, self.prices, 5, months=30,
+                                     block=7, seed=1)
+        self.assertEqual(pe.shape, (5, 30))
+        self.assertTrue((pe[:, 0] == self.pe[0]).all())
+        self.assertTrue((prices[:, 0] == self.prices[0]).all())
+        # every step of a path is a historical step, pe and price together
+        history = set(zip(numpy.round(numpy.diff(numpy.log(self.pe)), 9),
+                          numpy.round(numpy.diff(numpy.log(self.prices)), 9)))
+        steps = zip(numpy.round(numpy.diff(numpy.log(pe)), 9).ravel(),
+                    numpy.round(numpy.diff(numpy.log(prices)), 9).ravel())
+        self.assertTrue(set(steps) <= history)
+        again = bootstrap_paths(self.pe, self.prices, 5, months=30,
+                                block=7, seed=1)
+        self.assertTrue((again[0] == pe).all())
+        self.assertTrue((again[1] == prices).all())
+
+    def test_matches_single_path(self):
+        result = monte_carlo(self.pe, self.prices, self.buys, self.sells,
+                             paths=7, months=50, seed=2, batch_size=3)
+        self.assertEqual(result.final_worth.shape, (7, 4))
+        pe, prices = bootstrap_paths(self.pe, self.prices, 7, 50, seed=2)
+        for i in range(7):
+            suite = InvestorSuite(self.buys, self.sells)
+            suite.simulate(pe[i], prices[i])
+            self.assertEqual(list(result.final_worth[i]),
+                             list(suite.get_net_worth(prices[i, -1])))
+        # an investor that always buys ends up with the most on average
+        self.assertEqual(numpy.argmax(result.mean()), 3)
+
+    def test_batch_size_independent(self):
+        results = [monte_carlo(self.pe, self.prices, self.buys, self.sells,
+                               paths=20, seed=3, batch_size=batch_size)
+                   for batch_size in (1, 6, None)]
+        for result in results[1:]:
+            self.assertTrue(
+                (result.final_worth == results[0].final_worth).all())
+
+    def test_save_load(self):
+        result = monte_carlo(self.pe, self.prices, self.buys, self.sells,
+                             paths=10, seed=0)
+        self.assertEqual(result.percentile([5, 95]).shape, (2, 4))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'mc.npz')
+            result.save(filename)
+            loaded = MonteCarloResult.load(filename)
+            result.save_csv(os.path.join(tmpdir, 'mc.csv'))
+            with open(os.path.join(tmpdir, 'mc.csv')) as fp:
+                lines = fp.read().splitlines()
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertTrue((loaded.final_worth == result.final_worth).all())
+        self.assertEqual(lines[0], 'buy_at,sell_at,mean,p5,p25,p50,p75,p95')
+        self.assertEqual(len(lines), 5)
+
+
+class TestRunStats(unittest.TestCase):
+    def test_stats(self):
+        stats = RunStats()
+        with stats.phase('a'):
+            pass
+        with stats.phase('a'):
+            with stats.phase('b'):
+                pass
+        self.assertEqual(sorted(stats.timings), ['a', 'b'])
+        self.assertGreaterEqual(stats.timings['a'], stats.timings['b'])
+        stats.count('x')
+        stats.count('x', 2)
+        stats.record_matrix_bytes(10)
+        stats.record_matrix_bytes(5)
+        self.assertEqual(stats.counters, {'x': 3})
+        self.assertEqual(stats.peak_matrix_bytes, 10)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'stats.json')
+            stats.save_json(filename)
+            with open(filename) as fp:
+                self.assertEqual(json.load(fp), stats.as_dict())
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestRollingStartAnalysis(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(2)
+        self.pe = 15. + 10. * rng.random_sample(48)
+        self.prices = 100. * numpy.cumprod(
+            1. + 0.05 * rng.standard_normal(48))
+        self.buys = [16., 20., 24., 0.]
+        self.sells = [18., 20., 22., 0.]
+
+    def test_matches_separate_runs(self):
+        starts = [0, 5, 10, 47, 20]
+        final_worth, cagr = rolling_start_analysis(
+            self.pe, self.prices, starts, self.buys, self.sells)
+        self.assertEqual(final_worth.shape, (5, 4))
+        for i, start in enumerate(sorted(starts)):
+            suite = InvestorSuite(self.buys, self.sells)
+            suite.simulate(self.pe[start:], self.prices[start:])
+            self.assertEqual(list(final_worth[i]),
+                             list(suite.get_net_worth(self.prices[-1])))
+        # the investor that never buys has no return
+        for val in cagr[:-1, 3]:
+            self.assertAlmostEqual(val, 0.)
+        self.assertTrue(numpy.isnan(cagr[-1]).all())
+
+    def test_annualized_return(self):
+        # always invested in a market growing 1% a month
+        prices = 100. * 1.01 ** numpy.arange(60)
+        final_worth, cagr = rolling_start_analysis(
+            numpy.full(60, 10.), prices, [0, 30], [20.])
+        for val in cagr[:, 0]:
+            self.assertAlmostEqual(val, 1.01 ** 12 - 1.)
+        self.assertAlmostEqual(annualized_return(14000., 2), 0.)
+        self.assertTrue(numpy.isnan(annualized_return(12000., 1)))
+
+    def test_table(self):
+        final_worth, cagr = rolling_start_analysis(
+            self.pe, self.prices, [0, 12], self.buys, self.sells)
+        table = StartDateTable(['2000-01-03', '2001-01-01'], self.buys,
+                               self.sells, final_worth, cagr)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            table.save(os.path.join(tmpdir, 'table.npz'))
+            loaded = StartDateTable.load(os.path.join(tmpdir, 'table.npz'))
+            table.save_csv(os.path.join(tmpdir, 'table.csv'))
+            with open(os.path.join(tmpdir, 'table.csv')) as fp:
+                lines = fp.read().splitlines()
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(list(loaded.start_dates), list(table.start_dates))
+        self.assertTrue((loaded.final_worth == final_worth).all())
+        self.assertEqual(len(lines), 1 + 2 * 4)
+        self.assertTrue(lines[1].startswith('2000-01-03,16.0,18.0,'))
+
+
+def write_price_file(filename, start='1990-01-01', end='2015-01-01',
+                     seed=0):
+    """Write a csv of made up daily prices for offline tests"""
+    dates = numpy.arange(start, end, dtype='datetime64[D]')
+    dates = dates[numpy.is_busday(dates)]
+    rng = numpy.random.RandomState(seed)
+    prices = 100. * numpy.cumprod(1. + 0.01 * rng.standard_normal(len(dates)))
+    with open(filename, 'w') as fp:
+        for date, price in zip(dates, prices):
+            fp.write('{},{!r}\n'.format(date, float(price)))
+
+
+class OfflineTestCase(unittest.TestCase):
+    """Writes made up prices for each of `indices` to `{index}.csv` files in
+    a temporary directory, which the validators keep their price caches in
+    too (`cache_dir=self.tmpdir`), so that nothing is left behind in the
+    current directory.
+
+    """
+    indices = ('TEST',)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for seed, index in enumerate(self.indices):
+            write_price_file(self.path(index + '.csv'), seed=seed)
+        self.price_file = self.path('{index}.csv')
+        self.source = LocalPriceSource(self.price_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+
+class TestLoadPeData(OfflineTestCase):
+    def setUp(self):
+        super(TestLoadPeData, self).setUp()
+        self.filename = self.path('pe.csv')
+        shutil.copy('pe_data.csv', self.filename)
+
+    @staticmethod
+    def first_weekday_after(date_str):
+        # the first weekday after the end of the month `MM/YYYY`
+        date0 = datetime.strptime(date_str, '%m/%Y')
+        date = date0 + timedelta(27)
+        while date.month == date0.month or date.weekday() > 4:
+            date += timedelta(1)
+        return date
+
+    def test_dates_match_calendar(self):
+        with open(self.filename) as fp:
+            rows = [line.strip().split(',') for line in fp if line.strip()]
+        dates, pe_ratios = load_pe_data(self.filename, use_cache=False)
+        self.assertEqual(len(dates), len(rows))
+        expected = [self.first_weekday_after(date) for date, _ in rows]
+        self.assertEqual(
+            dates.astype('datetime64[us]').astype(datetime).tolist(),
+            expected)
+        self.assertEqual(pe_ratios.tolist(), [float(pe) for _, pe in rows])
+
+    def test_spaces(self):
+        dates, pe_ratios = parse_pe_data('01/1881, 18.47\n02/1881 ,18.15 \n')
+        self.assertEqual(list(dates), list(numpy.array(
+            ['1881-02-01', '1881-03-01'], dtype='datetime64[D]')))
+        self.assertEqual(list(pe_ratios), [18.47, 18.15])
+        self.assertEqual(len(parse_pe_data(' \n')[1]), 0)
+
+    def test_bad_rows(self):
+        for text, line in (('01/1881,18.47\n02/1881,18.15,1.0\n', 2),
+                           ('01/1881,18.47\n\n02/1881\n03/1881,17.8\n', 3),
+                           ('01/1881\n18.47\n', 1)):
+            self.assertRaisesRegex(ValueError, 'Line {} '.format(line),
+                                   parse_pe_data, text)
+
+    def test_window(self):
+        dates, pe_ratios = load_pe_data(
+            self.filename, datetime(2011, 8, 1), datetime(2011, 11, 1),
+            use_cache=False)
+        self.assertEqual(list(dates), list(numpy.array(
+            ['2011-08-01', '2011-09-01', '2011-10-03', '2011-11-01'],
+            dtype='datetime64[D]')))
+        self.assertEqual(list(pe_ratios), [22.6, 20.04, 19.69, 20.15])
+
+        dates, pe_ratios = load_pe_data(
+            self.filename, datetime(2011, 8, 2), datetime(2011, 10, 31),
+            use_cache=False)
+        self.assertEqual(list(pe_ratios), [20.04, 19.69])
+
+    def test_cache(self):
+        cache_filename = os.path.join(self.tmpdir, '.pe.csv.npz')
+        expected = load_pe_data(self.filename, use_cache=False)
+        self.assertFalse(os.path.exists(cache_filename))
+        validator = CapeValidator(
+            self.filename, datetime(2000, 1, 1), [20.], index='TEST',
+            price_source=self.source, pe_cache=False, cache_dir=self.tmpdir)
+        self.assertEqual(list(validator.pe_ratios),
+                         list(expected[1][-len(validator.pe_ratios):]))
+        self.assertFalse(os.path.exists(cache_filename))
+        first = load_pe_data(self.filename)
+        self.assertTrue(os.path.exists(cache_filename))
+        second = load_pe_data(self.filename)
+        for result in (first, second):
+            self.assertEqual(list(result[0]), list(expected[0]))
+            self.assertEqual(list(result[1]), list(expected[1]))
+
+        # modifying the csv invalidates the cache
+        with open(self.filename, 'a') as fp:
+            fp.write('09/2014,26.00\n')
+        dates, pe_ratios = load_pe_data(self.filename)
+        self.assertEqual(len(dates), len(expected[0]) + 1)
+        self.assertEqual(dates[-1], numpy.datetime64('2014-10-01'))
+        self.assertEqual(pe_ratios[-1], 26.)
+
+
+class TestIncrementalAdvance(OfflineTestCase):
+    def setUp(self):
+        super(TestIncrementalAdvance, self).setUp()
+        self.buys = [15., 20., 22., 25., 1000.]
+        self.sells = [20., 20., 26., 25., 1000.]
+        with open('pe_data.csv') as fp:
+            rows = [line.strip().split(',') for line in fp if line.strip()]
+        self.rows = [(date, pe) for date, pe in rows
+                     if date.endswith(('/2012', '/2013'))]
+
+    def make_validator(self, end_date):
+        return CapeValidator(
+            'pe_data.csv', datetime(2000, 1, 1), self.buys, self.sells,
+            end_date=end_date, index='TEST', price_source=self.source,
+            pe_cache=False, cache_dir=self.tmpdir)
+
+    def assertResultsEqual(self, validator, expected):
+        self.assertEqual(list(validator.pe_dates), list(expected.pe_dates))
+        self.assertEqual(list(validator.pe_ratios), list(expected.pe_ratios))
+        for name in ('worth_matrix', 'shares_matrix', 'cash_matrix'):
+            self.assertTrue(
+                (getattr(validator, name) == getattr(expected, name)).all(),
+                msg=name)
+
+    def test_advance(self):
+        expected = self.make_validator(datetime(2014, 1, 15))
+        expected.calculate_worth_vs_time()
+
+        validator = self.make_validator(datetime(2012, 1, 15))
+        validator.calculate_worth_vs_time()
+        self.assertRaises(RuntimeError, self.make_validator(None).advance,
+                          self.rows)
+        # rows already simulated are skipped
+        self.assertEqual(validator.advance(self.rows[:6]), 6)
+        self.assertEqual(validator.advance(self.rows[:6]), 0)
+        self.assertEqual(validator.advance(self.rows), 18)
+        self.assertResultsEqual(validator, expected)
+
+    def test_advance_checks_months(self):
+        validator = self.make_validator(datetime(2012, 1, 15))
+        validator.calculate_worth_vs_time()
+        months = len(validator.pe_dates)
+        # a missing month, after the last one simulated or between new ones
+        self.assertRaisesRegex(ValueError, 'after 12/2011, got 02/2012',
+                               validator.advance, self.rows[1:3])
+        self.assertRaisesRegex(ValueError, 'after 01/2012, got 03/2012',
+                               validator.advance,
+                               [self.rows[0], self.rows[2]])
+        # months out of order
+        self.assertRaisesRegex(ValueError, 'after 01/2012, got 12/2011',
+                               validator.advance,
+                               [self.rows[0], ('12/2011', '21.0')] +
+                               self.rows[1:2])
+        self.assertRaisesRegex(ValueError, 'after 02/2012, got 01/2012',
+                               validator.advance,
+                               [self.rows[0], self.rows[1], self.rows[0]])
+        self.assertEqual(len(validator.pe_dates), months)
+        self.assertEqual(validator.advance(self.rows[:2]), 2)
+
+    def test_event_engine(self):
+        expected = self.make_validator(datetime(2014, 1, 15))
+        expected.calculate_worth_vs_time()
+
+        validator = self.make_validator(datetime(2012, 1, 15))
+        validator.calculate_worth_vs_time(engine='event')
+        self.assertNotIn('materialize', validator.stats.timings)
+        self.assertIsNone(validator._matrix_buffer)
+        validator.advance(self.rows)
+        self.assertIn('materialize', validator.stats.timings)
+        for name in ('worth_matrix', 'shares_matrix', 'cash_matrix'):
+            numpy.testing.assert_allclose(getattr(validator, name),
+                                          getattr(expected, name),
+                                          atol=1e-6, err_msg=name)
+        self.assertRaises(ValueError, validator.calculate_worth_vs_time,
+                          engine='daily')
+
+    def test_save_and_restore(self):
+        expected = self.make_validator(datetime(2014, 1, 15))
+        expected.calculate_worth_vs_time()
+
+        path = os.path.join(self.tmpdir, 'state')
+        validator = self.make_validator(datetime(2012, 1, 15))
+        validator.calculate_worth_vs_time()
+        validator.save_state(path)
+
+        validator = CapeValidator.from_state(path, self.source,
+                                             cache_dir=self.tmpdir)
+        self.assertEqual(validator.index, 'TEST')
+        self.assertEqual([inv.sell_at for inv in validator.investors],
+                         self.sells)
+        validator.advance(self.rows[:12])
+        validator.save_state(path)
+        self.assertEqual(len([f for f in os.listdir(path)
+                              if f.startswith('chunk_')]), 2)
+
+        validator = CapeValidator.from_state(path, self.source,
+                                             cache_dir=self.tmpdir)
+        validator.advance(self.rows)
+        self.assertResultsEqual(validator, expected)
+
+    def test_save_over_other_run(self):
+        path = os.path.join(self.tmpdir, 'state')
+        validator = self.make_validator(datetime(2012, 1, 15))
+        validator.calculate_worth_vs_time()
+        validator.save_state(path)
+
+        # a longer run with other thresholds replaces the saved one
+        self.buys, self.sells = [1000.], [1000.]
+        expected = self.make_validator(datetime(2014, 1, 15))
+        expected.calculate_worth_vs_time()
+        expected.save_state(path)
+        self.assertEqual(len([f for f in os.listdir(path)
+                              if f.startswith('chunk_')]), 1)
+        validator = CapeValidator.from_state(path, self.source,
+                                             cache_dir=self.tmpdir)
+        self.assertEqual([inv.buy_at for inv in validator.investors],
+                         [1000.])
+        self.assertResultsEqual(validator, expected)
+
+        # chunks that do not join up are refused
+        os.rename(os.path.join(path, 'chunk_00000000.npz'),
+                  os.path.join(path, 'chunk_00000001.npz'))
+        self.assertRaises(ValueError, CapeValidator.from_state, path,
+                          self.source)
+
+
+class TestSimulationOutput(OfflineTestCase):
+    def setUp(self):
+        super(TestSimulationOutput, self).setUp()
+        self.buys = [15., 20., 22., 25., 0., 1000.]
+        self.sells = [20., 20., 26., 25., 0., 1000.]
+        self.expected = self.make_validator()
+        self.expected.calculate_worth_vs_time()
+
+    def make_validator(self):
+        return CapeValidator(
+            'pe_data.csv', datetime(2000, 1, 1), self.buys, self.sells,
+            end_date=datetime(2014, 1, 15), index='TEST',
+            price_source=self.source, pe_cache=False, cache_dir=self.tmpdir)
+
+    def check_summary(self, summary):
+        worth = self.expected.worth_matrix
+        numpy.testing.assert_array_equal(summary.final_worth, worth[:, -1])
+        peak = numpy.maximum.accumulate(worth, axis=1)
+        numpy.testing.assert_allclose(summary.max_drawdown,
+                                      (1. - worth / peak).max(axis=1))
+        self.assertEqual(list(summary.months_invested),
+                         list((self.expected.shares_matrix > 0.).sum(axis=1)))
+        self.assertEqual(summary.months_invested[4], 0)
+        self.assertEqual(summary.max_drawdown[4], 0.)
+        numpy.testing.assert_allclose(summary.cagr, annualized_return(
+            worth[:, -1], worth.shape[1]))
+
+    def test_in_memory(self):
+        validator = self.make_validator()
+        output = SimulationOutput(['worth'], dtype='float32')
+        validator.calculate_worth_vs_time(output=output)
+        self.assertEqual(validator.worth_matrix.dtype, numpy.float32)
+        numpy.testing.assert_allclose(validator.worth_matrix,
+                                      self.expected.worth_matrix, rtol=1e-6)
+        self.assertRaises(ValueError, getattr, validator, 'cash_matrix')
+        # the float32 worth matrix plus the float64 chunk buffer
+        investors, months = validator.worth_matrix.shape
+        self.assertEqual(validator.stats.peak_matrix_bytes,
+                         investors * months * (4 + 3 * 8))
+        self.assertRaises(RuntimeError, validator.advance, [])
+        self.check_summary(output.summary)
+        self.assertRaises(ValueError, SimulationOutput, ['price'])
+        self.assertRaises(ValueError, validator.calculate_worth_vs_time,
+                          'event', output)
+
+    def test_streamed(self):
+        validator = self.make_validator()
+        path = os.path.join(self.tmpdir, 'results')
+        output = SimulationOutput(['worth', 'shares'], path=path)
+        validator.suite = InvestorSuite.from_investors(validator.investors)
+        validator.market_prices = self.expected.market_prices
+        output.open(len(self.buys), len(self.expected.pe_ratios))
+        # small chunks so that the summary is accumulated across chunks
+        validator.suite.simulate_to(output, self.expected.pe_ratios,
+                                    self.expected.market_prices, 7)
+        output.close(dates=self.expected.pe_dates.astype('int64'))
+
+        loaded = SimulationOutput.load(path)
+        self.assertEqual(loaded.outputs, ('worth', 'shares'))
+        self.assertIsInstance(loaded.worth, numpy.memmap)
+        self.assertIsNone(loaded.cash)
+        numpy.testing.assert_array_equal(
+            loaded.worth[2:4, 10:20], self.expected.worth_matrix[2:4, 10:20])
+        numpy.testing.assert_array_equal(loaded.shares,
+                                         self.expected.shares_matrix)
+        self.check_summary(loaded.summary)
+        with numpy.load(os.path.join(path, 'summary.npz')) as data:
+            self.assertEqual(list(data['dates']),
+                             list(self.expected.pe_dates.astype('int64')))
+
+    def test_summary_only(self):
+        validator = self.make_validator()
+        output = SimulationOutput([], path=os.path.join(self.tmpdir, 'out'))
+        validator.calculate_worth_vs_time(output=output)
+        self.assertEqual(os.listdir(output.path), ['summary.npz'])
+        self.check_summary(ResultSummary.load(
+            os.path.join(output.path, 'summary.npz')))
+
+
+class TestMultiIndexValidator(OfflineTestCase):
+    indices = ('TEST', 'TEST2')
+
+    def setUp(self):
+        super(TestMultiIndexValidator, self).setUp()
+        self.buys = [15., 20., 22., 25., 1000.]
+        self.sells = [20., 20., 26., 25., 1000.]
+
+    def test_matches_single_index(self):
+        multi = MultiIndexValidator(
+            'pe_data.csv', datetime(2000, 1, 1), self.buys, self.sells,
+            datetime(2012, 1, 15), ['TEST', 'TEST2'], self.source,
+            pe_cache=False, cache_dir=self.tmpdir)
+        multi.calculate_worth_vs_time()
+        self.assertIs(multi['TEST2'].stats, multi.stats)
+        self.assertEqual(multi['TEST2'].index, 'TEST2')
+        final_worth = multi.final_worth()
+        self.assertEqual(sorted(final_worth), ['TEST', 'TEST2'])
+        self.assertFalse((final_worth['TEST'] == final_worth['TEST2']).all())
+        for index in ('TEST', 'TEST2'):
+            single = CapeValidator(
+                'pe_data.csv', datetime(2000, 1, 1), self.buys, self.sells,
+                datetime(2012, 1, 15), index, self.source, pe_cache=False,
+                cache_dir=self.tmpdir)
+            single.calculate_worth_vs_time()
+            validator = multi[index]
+            self.assertEqual(list(validator.market_prices),
+                             list(single.market_prices))
+            for name in ('worth_matrix', 'shares_matrix', 'cash_matrix'):
+                self.assertTrue((getattr(validator, name) ==
+                                 getattr(single, name)).all(), msg=name)
+            self.assertEqual(list(validator.suite.cash),
+                             list(single.suite.cash))
+            self.assertTrue(os.path.exists(
+                self.path('.cache_{}.npy'.format(index))))
+
+        # each index carries on on its own
+        with open('pe_data.csv') as fp:
+            rows = [line.strip().split(',') for line in fp
+                    if line.startswith(('01/2012', '02/2012'))]
+        self.assertEqual(multi['TEST2'].advance(rows), 2)
+        self.assertEqual(multi['TEST2'].worth_matrix.shape[1],
+                         multi['TEST'].worth_matrix.shape[1] + 2)
+
+
+class TestShardedSweep(OfflineTestCase):
+    indices = ('TEST', 'TEST2')
+
+    def setUp(self):
+        super(TestShardedSweep, self).setUp()
+        self.sweep_dir = self.path('sweep')
+
+    def create(self, shards=3, end_date=datetime(2012, 1, 15)):
+        return ShardedSweep.create(
+            self.sweep_dir, 'pe_data.csv', datetime(2000, 1, 1),
+            [15., 20., 25.], [20., 30.], shards, end_date,
+            ['TEST', 'TEST2'], 12, self.price_file)
+
+    def check_tables(self, tables, end_date=datetime(2012, 1, 15),
+                     starts=13):
+        self.assertEqual(sorted(tables), ['TEST', 'TEST2'])
+        for index, table in tables.items():
+            self.assertEqual(table.final_worth.shape, (starts, 6))
+            self.assertEqual(list(table.buy_thresholds[:3]), [15., 15., 20.])
+            self.assertEqual(list(table.sell_thresholds[:3]), [20., 30., 20.])
+            validator = CapeValidator(
+                'pe_data.csv', datetime(2000, 1, 1), table.buy_thresholds,
+                table.sell_thresholds, end_date, index,
+                self.source, pe_cache=False, cache_dir=self.tmpdir)
+            expected = validator.rolling_starts(12)
+            self.assertEqual(list(table.start_dates),
+                             list(expected.start_dates))
+            numpy.testing.assert_allclose(table.final_worth,
+                                          expected.final_worth)
+            numpy.testing.assert_allclose(table.cagr, expected.cagr)
+
+    def test_shards(self):
+        sweep = self.create()
+        self.assertEqual(len(sweep.units()), 26)
+        self.assertEqual(sweep.units(1)[:2], [('TEST', 1), ('TEST', 4)])
+        self.assertRaises(ValueError, sweep.run_shard, 0, 4)
+        self.assertTrue(sweep.run_shard(2))
+        self.assertRaises(RuntimeError, sweep.merge)
+        self.assertEqual(sweep.pending(), [0, 1])
+        # restarting keeps the plan and skips the finished shard, but a
+        # different sweep in the same directory is refused
+        self.assertRaisesRegex(ValueError, 'shards', self.create, shards=5)
+        sweep = self.create()
+        self.assertEqual(sweep.shards, 3)
+        for shard in range(3):
+            sweep.run_shard(shard, 3)
+        self.assertEqual(sweep.stats.counters,
+                         {'shards_run': 2, 'shards_skipped': 1, 'units': 18})
+        self.check_tables(sweep.merge())
+
+    def test_worker_command(self):
+        self.create()
+        main(['worker', '--shard', '1/3', '--sweep_dir', self.sweep_dir,
+              '--stats-json', self.path('stats.json')])
+        self.assertEqual(ShardedSweep(self.sweep_dir).pending(), [0, 2])
+        with open(self.path('stats.json')) as fp:
+            self.assertEqual(json.load(fp)['counters']['shards_run'], 1)
+
+    def test_moved_sweep_dir(self):
+        self.create()
+        # a worker that mounts the sweep elsewhere, without the inputs
+        moved = os.path.join(self.tmpdir, 'mounted')
+        os.rename(self.sweep_dir, moved)
+        for index in ('TEST', 'TEST2'):
+            os.rename(self.price_file.format(index=index),
+                      os.path.join(self.tmpdir, index + '.bak'))
+        sweep = ShardedSweep(moved)
+        self.assertTrue(sweep.run_shard(0))
+        with open(os.path.join(moved, 'prices', 'TEST2.csv'), 'a') as fp:
+            fp.write('2014-01-02,1.0\n')
+        self.assertRaisesRegex(ValueError, 'changed', sweep.run_shard, 1)
+
+    def test_worker_processes(self):
+        # the same sweep as the command below, with one shard done
+        self.create(end_date=datetime(2012, 1, 1)).run_shard(0)
+        main(['sharded_sweep', '--sweep_dir', self.sweep_dir, '--shards', '3',
+              '--processes', '2', '--index', 'TEST,TEST2', '--start_date',
+              '01/2000', '--end_date', '01/2012', '--price_file',
+              self.price_file, '--buy_range', '15,20,25', '--sell_range',
+              '20,30', '--start_stride', '12'])
+        tables = ShardedSweep(self.sweep_dir).merge()
+        self.check_tables(tables, datetime(2012, 1, 1), 12)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.sweep_dir, 'result_TEST2.npz')))
+
+
+class TestQueryServer(OfflineTestCase):
+    def setUp(self):
+        super(TestQueryServer, self).setUp()
+        self.pe_file = self.path('pe_data.csv')
+        shutil.copy('pe_data.csv', self.pe_file)
+        self.server = QueryServer(
+            self.pe_file, datetime(2000, 1, 1), datetime(2012, 1, 15),
+            'TEST', self.source, cache_dir=self.tmpdir)
+
+    def tearDown(self):
+        self.server.close()
+        super(TestQueryServer, self).tearDown()
+
+    def expected(self, buy, sell, start=0, end=None):
+        server = self.server
+        suite = InvestorSuite([buy], [sell], [10000.])
+        suite.simulate(server.pe_ratios[start:end],
+                       server.market_prices[start:end])
+        return suite.get_net_worth(server.market_prices[start:end][-1])[0]
+
+    def test_evaluate_thresholds(self):
+        server = self.server
+        final_worth, cagr = evaluate_thresholds(
+            server.pe_ratios, server.market_prices, [20., 25.], [25., 25.],
+            [0, 12], [len(server.pe_ratios), 60])
+        self.assertAlmostEqual(final_worth[0], self.expected(20., 25.))
+        self.assertAlmostEqual(final_worth[1],
+                               self.expected(25., 25., 12, 60))
+        self.assertRaises(ValueError, evaluate_thresholds, server.pe_ratios,
+                          server.market_prices, [20.], [20.], [5], [5])
+
+    def test_queries(self):
+        results = self.server.submit([
+            {'buy_at': 20., 'sell_at': 25.},
+            {'buy_at': 25., 'start': '01/2001', 'end': '12/2004'},
+            {'buy_at': 20., 'start': '01/2020'},
+            {'sell_at': 20.}])
+        self.assertEqual(results[0]['start'], '12/1999')
+        self.assertEqual(results[0]['months'], len(self.server.months))
+        self.assertAlmostEqual(results[0]['final_worth'],
+                               self.expected(20., 25.))
+        start = list(self.server.months).index(numpy.datetime64('2001-01'))
+        self.assertEqual(results[1]['months'], 48)
+        self.assertEqual(results[1]['end'], '12/2004')
+        self.assertAlmostEqual(results[1]['final_worth'],
+                               self.expected(25., 25., start, start + 48))
+        self.assertIsInstance(results[2], ValueError)
+        self.assertIsInstance(results[3], ValueError)
+
+    def test_batching(self):
+        self.server.batch_window = 0.2
+        results = [None] * 8
+        def query(i):
+            results[i] = self.server.submit([{'buy_at': 15. + i}])[0]
+        threads = [threading.Thread(target=query, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(self.server.stats.counters['batches'], 8)
+        self.assertEqual(self.server.stats.counters['queries'], 8)
+        for i, result in enumerate(results):
+            self.assertAlmostEqual(result['final_worth'],
+                                   self.expected(15. + i, 15. + i))
+
+    def test_reload(self):
+        before = self.server.submit([{'buy_at': 1000.}])[0]
+        with open(self.pe_file) as fp:
+            lines = fp.read().splitlines()
+        with open(self.pe_file, 'w') as fp:
+            fp.write('\n'.join(line for line in lines
+                               if '/2011,' not in line
+                               and not line.startswith('12/2010')))
+        stat = os.stat(self.pe_file)
+        os.utime(self.pe_file, ns=(stat.st_atime_ns,
+                                   stat.st_mtime_ns + 10 ** 9))
+        after = self.server.submit([{'buy_at': 1000.}])[0]
+        self.assertEqual(self.server.stats.counters['reloads'], 2)
+        self.assertEqual(after['months'], before['months'] - 13)
+        self.assertEqual(after['end'], '11/2010')
+
+    def test_http(self):
+        from urllib.request import Request, urlopen
+        httpd = self.server.serve(port=0)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+            with urlopen(url + '/status') as response:
+                status = json.loads(response.read())
+            self.assertEqual(status['months'], len(self.server.months))
+            request = Request(url + '/query', data=json.dumps(
+                [{'buy_at': 20., 'sell_at': 25.}, {}]).encode())
+            with urlopen(request) as response:
+                results = json.loads(response.read())
+            self.assertAlmostEqual(results[0]['final_worth'],
+                                   self.expected(20., 25.))
+            self.assertIn('error', results[1])
+            request = Request(url + '/query', data=json.dumps(
+                {'buy_at': 20., 'sell_at': 25.}).encode())
+            with urlopen(request) as response:
+                self.assertEqual(json.loads(response.read()), results[0])
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+
+
+class TestResultCache(OfflineTestCase):
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        self.cache = ResultCache(os.path.join(self.tmpdir, 'results'))
+
+    def make_validator(self, buys, cache=True):
+        return CapeValidator(
+            'pe_data.csv', datetime(2000, 1, 1), buys,
+            end_date=datetime(2014, 1, 15), index='TEST',
+            price_source=self.source,
+            result_cache=self.cache if cache else None, pe_cache=False,
+            cache_dir=self.tmpdir)
+
+    def assertSameResults(self, validator, expected):
+        for name in ('worth_matrix', 'shares_matrix', 'cash_matrix'):
+            self.assertTrue((getattr(validator, name) ==
+                             getattr(expected, name)).all(), msg=name)
+        self.assertEqual(list(validator.suite.cash),
+                         list(expected.suite.cash))
+        self.assertEqual(list(validator.suite.shares),
+                         list(expected.suite.shares))
+
+    def test_lookup_and_store(self):
+        key = self.cache.data_key('test', numpy.arange(3.))
+        for other in (self.cache.data_key('test', numpy.arange(4.)),
+                      self.cache.data_key('other', numpy.arange(3.))):
+            self.assertNotEqual(key, other)
+        params = numpy.array([[1., 2.], [3., 4.]])
+        self.cache.store(key, params, numpy.array([10., 20.]))
+        found, values = self.cache.lookup(
+            key, numpy.array([[3., 4.], [5., 6.], [1., 2.]]))
+        self.assertEqual(list(found), [True, False, True])
+        self.assertEqual(list(values), [20., 10.])
+        found, values = self.cache.lookup(
+            self.cache.data_key('other', numpy.arange(3.)), params)
+        self.assertFalse(found.any())
+
+    def test_duplicate_rows(self):
+        params = numpy.array([[1., 2.], [3., 4.], [1., 2.]])
+        self.cache.store('data', params, numpy.array([10., 20., 10.]))
+        with numpy.load(self.cache._chunks('data')[0]) as chunk:
+            self.assertEqual(len(chunk['params']), 2)
+        found, values = self.cache.lookup(
+            'data', numpy.array([[1., 2.], [5., 6.], [1., 2.], [3., 4.]]))
+        self.assertEqual(list(found), [True, False, True, True])
+        self.assertEqual(list(values), [10., 10., 20.])
+
+    def test_lookup_only_reads_matching_values(self):
+        for i in range(3):
+            self.cache.store('data', [[float(i)]], numpy.full((1, 3), i))
+        getitem = numpy.lib.npyio.NpzFile.__getitem__
+        with mock.patch.object(numpy.lib.npyio.NpzFile, '__getitem__',
+                               autospec=True, side_effect=getitem) as read:
+            found, values = self.cache.lookup('data', [[1.]])
+        self.assertEqual(list(found), [True])
+        self.assertEqual(values.tolist(), [[1, 1, 1]])
+        keys = [call.args[1] for call in read.call_args_list]
+        self.assertEqual(keys.count('values'), 1)
+        self.assertEqual(keys[-1], 'values')
+
+    def test_eviction(self):
+        values = numpy.zeros((1, 1000))
+        for i in range(3):
+            self.cache.store('data', [[float(i)]], values)
+            time.sleep(0.01)
+        self.cache.lookup('data', [[0.]])
+        size = self.cache.size() // 3
+        self.cache.max_bytes = 2 * size
+        self.cache.evict()
+        self.assertLessEqual(self.cache.size(), 2 * size)
+        # the least recently used chunk went, not the oldest one
+        found, _ = self.cache.lookup('data', [[0.], [1.], [2.]])
+        self.assertEqual(list(found), [True, False, True])
+
+    def test_validator(self):
+        buys = [15., 20., 25.]
+        expected = self.make_validator(buys + [22.], cache=False)
+        expected.calculate_worth_vs_time()
+
+        validator = self.make_validator(buys)
+        validator.calculate_worth_vs_time()
+        self.assertEqual(validator.stats.counters['result_cache_misses'], 3)
+
+        # a partly overlapping run only simulates the new investor
+        validator = self.make_validator(buys + [22.])
+        validator.calculate_worth_vs_time()
+        self.assertEqual(validator.stats.counters['result_cache_hits'], 3)
+        self.assertEqual(validator.stats.counters['result_cache_misses'], 1)
+        self.assertSameResults(validator, expected)
+
+        validator = self.make_validator(buys + [22.])
+        validator.calculate_worth_vs_time()
+        self.assertEqual(validator.stats.counters['result_cache_misses'], 0)
+        self.assertSameResults(validator, expected)
+        with open('pe_data.csv') as fp:
+            rows = [line.strip().split(',') for line in fp
+                    if line.startswith('01/2014')]
+        self.assertEqual(validator.advance(rows), 1)
+
+    def test_sweep(self):
+        rng = numpy.random.RandomState(7)
+        pe = 15. + 10. * rng.random_sample(60)
+        prices = 100. * numpy.cumprod(1. + 0.05 * rng.standard_normal(60))
+        buys = _parse_range('15:25:2.5')
+        expected = sweep_thresholds(pe, prices, buys, [20., 24.],
+                                    max_workers=1)
+        sweep_thresholds(pe, prices, buys[:3], [20., 24.], max_workers=1,
+                         cache=self.cache)
+        key = self.cache.data_key('final_worth-step', pe, prices)
+        self.assertEqual(len(self.cache._chunks(key)), 1)
+        grid = sweep_thresholds(pe, prices, buys, [20., 24.], max_workers=1,
+                                cache=self.cache)
+        self.assertTrue((grid.worth == expected.worth).all())
+        # the second sweep only stored the 4 new pairs
+        with numpy.load(self.cache._chunks(key)[1]) as chunk:
+            n = len(chunk['params'])
+        with numpy.load(self.cache._chunks(key)[0]) as chunk:
+            n = min(n, len(chunk['params']))
+        self.assertEqual(n, 4)
+
+
+class PriceHandler(BaseHTTPRequestHandler):
+    """Serves yahoo style csv prices from `server.source`, failing the first
+    `server.failures` requests with a 503
+
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            fail = server.failures > 0
+            server.failures -= 1
+        try:
+            parts = urlsplit(self.path)
+            index = parts.path.strip('/')
+            query = parse_qs(parts.query)
+            if fail:
+                return self.respond(503, b'try again')
+            if index == 'HTML':
+                return self.respond(200, b'<html>\n<body>Sign in</body>\n'
+                                         b'</html>\n')
+            if index != 'TEST':
+                return self.respond(404, b'no such index')
+            dates, prices = server.source.load(
+                index, datetime.strptime(query['start'][0], '%Y-%m-%d'),
+                datetime.strptime(query['end'][0], '%Y-%m-%d'))
+            lines = ['Date,Open,High,Low,Close,Volume,Adj Close']
+            for date, price in reversed(list(zip(dates, prices))):
+                lines.append('{},0,0,0,0,0,{!r}'.format(date, float(price)))
+            self.respond(200, '\n'.join(lines).encode('utf-8'))
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAsyncHttpPriceSource(OfflineTestCase):
+    def setUp(self):
+        super(TestAsyncHttpPriceSource, self).setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PriceHandler)
+        self.server.source = self.source
+        self.server.lock = threading.Lock()
+        self.server.requests = self.server.in_flight = 0
+        self.server.max_in_flight = self.server.failures = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = ('http://127.0.0.1:{}/'.format(self.server.server_port) +
+                    '{index}?start={start:%Y-%m-%d}&end={end:%Y-%m-%d}')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        super(TestAsyncHttpPriceSource, self).tearDown()
+
+    def test_load_ranges(self):
+        source = AsyncHttpPriceSource(self.url, max_in_flight=3)
+        ranges = [(datetime(2000, 1, 1) + timedelta(30 * i),
+                   datetime(2000, 1, 8) + timedelta(30 * i))
+                  for i in range(20)]
+        results = source.load_ranges('TEST', ranges)
+        self.assertEqual(self.server.requests, 20)
+        self.assertLessEqual(self.server.max_in_flight, 3)
+        for (start, end), (dates, prices) in zip(ranges, results):
+            expected = self.source.load('TEST', start, end)
+            self.assertEqual(list(dates), list(expected[0]))
+            self.assertEqual(list(prices), list(expected[1]))
+
+    def test_retry(self):
+        self.server.failures = 2
+        source = AsyncHttpPriceSource(self.url, retries=2, backoff=0.01)
+        source.stats = RunStats()
+        dates, prices = source.load(
+            'TEST', datetime(2000, 1, 1), datetime(2000, 1, 31))
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(source.stats.counters,
+                         {'fetch_requests': 3, 'fetch_retries': 2})
+        self.assertEqual(list(prices), list(self.source.load(
+            'TEST', datetime(2000, 1, 1), datetime(2000, 1, 31))[1]))
+
+        self.server.failures = 3
+        self.assertRaises(PriceFetchError, source.load, 'TEST',
+                          datetime(2000, 1, 1), datetime(2000, 1, 31))
+
+    def test_errors_fail_loudly(self):
+        source = AsyncHttpPriceSource(self.url, retries=2, backoff=0.01)
+        self.assertRaises(PriceFetchError, source.load, 'NOPE',
+                          datetime(2000, 1, 1), datetime(2000, 1, 31))
+        self.assertEqual(self.server.requests, 1)
+        # a page that is not csv, with a successful status
+        self.assertRaises(PriceFetchError, source.load, 'HTML',
+                          datetime(2000, 1, 1), datetime(2000, 1, 31))
+        self.assertEqual(self.server.requests, 2)
+        # a url that no connection can be made for
+        bad_port = AsyncHttpPriceSource(
+            'http://127.0.0.1:99999x/{index}.csv', retries=1, backoff=0.01)
+        self.assertRaises(PriceFetchError, bad_port.load, 'TEST',
+                          datetime(2000, 1, 1), datetime(2000, 1, 31))
+
+        self.server.server_close()  # stop accepting connections
+        self.assertRaises(PriceFetchError, source.load, 'TEST',
+                          datetime(2000, 1, 1), datetime(2000, 1, 31))
+
+    def test_validator(self):
+        buys = [15., 20., 25.]
+        expected = CapeValidator(
+            'pe_data.csv', datetime(1995, 1, 1), buys,
+            end_date=datetime(2014, 1, 1), index='TEST',
+            price_source=self.source, pe_cache=False, cache_dir=self.tmpdir)
+        expected.index_cache = {}
+        expected.calculate_worth_vs_time()
+        os.remove(self.path('.cache_TEST.npy'))
+
+        validator = CapeValidator(
+            'pe_data.csv', datetime(1995, 1, 1), buys,
+            end_date=datetime(2014, 1, 1), index='TEST',
+            price_source=AsyncHttpPriceSource(self.url), pe_cache=False,
+            cache_dir=self.tmpdir)
+        validator.calculate_worth_vs_time()
+        self.assertEqual(self.server.requests, len(validator.pe_ratios))
+        self.assertTrue(
+            (validator.worth_matrix == expected.worth_matrix).all())
+
+
+class TestCapeValidator(OfflineTestCase):
+    indices = ()
+
+    def setUp(self):
+        super(TestCapeValidator, self).setUp()
         data_file = 'pe_data.csv'
         start_date = datetime(2011, 8, 1)
         end_date = datetime(2011, 11, 15)
         self.buys = [25., 21., 20.1, 19.8, 19.]
         self.validator = CapeValidator(
-            data_file, start_date, self.buys, end_date=end_date)
+            data_file, start_date, self.buys, end_date=end_date,
+            pe_cache=False, cache_dir=self.tmpdir)
 
     def test_init(self):
         expected_dates = [
@@ -276,5 +1579,398 @@ class TestCapeValidator(unittest.TestCase):
             self.validator.worth_matrix[4], expected_worth)
 
 
+class TestPriceStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'prices.npy')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_dict_interface(self):
+        store = PriceStore(self.filename)
+        self.assertEqual(len(store), 0)
+        self.assertNotIn(datetime(2014, 9, 18), store)
+        self.assertIsNone(store.get(datetime(2014, 9, 18)))
+        self.assertRaises(KeyError, store.__getitem__, datetime(2014, 9, 18))
+
+        store[datetime(2014, 9, 18)] = 2011.36
+        store.update({datetime(2014, 9, 17): 2001.57})
+        self.assertIn(datetime(2014, 9, 18), store)
+        self.assertEqual(store[datetime(2014, 9, 18)], 2011.36)
+        self.assertEqual(len(store), 2)
+        self.assertFalse(os.path.exists(self.filename))
+
+        store.flush()
+        self.assertTrue(os.path.exists(self.filename))
+        store = PriceStore(self.filename)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store[datetime(2014, 9, 17)], 2001.57)
+        dates, prices = store.series()
+        self.assertEqual(list(dates), [numpy.datetime64('2014-09-17'),
+                                       numpy.datetime64('2014-09-18')])
+        self.assertEqual(list(prices), [2001.57, 2011.36])
+
+    def test_flush_merges_and_skips_unchanged(self):
+        store1 = PriceStore(self.filename)
+        store2 = PriceStore(self.filename)
+        store1[datetime(2014, 9, 18)] = 2011.36
+        store1.flush()
+        mtime = os.stat(self.filename).st_mtime_ns
+
+        # existing entries are kept, so there is nothing new to write
+        store1[datetime(2014, 9, 18)] = 1.
+        store1.flush()
+        self.assertEqual(os.stat(self.filename).st_mtime_ns, mtime)
+        self.assertEqual(store1[datetime(2014, 9, 18)], 2011.36)
+
+        # a second store opened earlier merges instead of overwriting
+        store2[datetime(2014, 9, 16)] = 1998.98
+        store2[datetime(2014, 9, 19)] = 2010.40
+        store2.flush()
+        store = PriceStore(self.filename)
+        dates, prices = store.series()
+        self.assertEqual(list(prices), [1998.98, 2011.36, 2010.40])
+
+
+class CountingPriceSource(LocalPriceSource):
+    def __init__(self, path):
+        super(CountingPriceSource, self).__init__(path)
+        self.calls = []
+
+    def load(self, index, start, end):
+        self.calls.append((index, start, end))
+        return super(CountingPriceSource, self).load(index, start, end)
+
+
+class TestLocalPriceSource(OfflineTestCase):
+    indices = ()
+
+    def setUp(self):
+        super(TestLocalPriceSource, self).setUp()
+        dates = numpy.arange('2011-07-01', '2012-01-01', dtype='datetime64[D]')
+        dates = dates[numpy.is_busday(dates)]
+        # pretend the market was closed on the first of september
+        self.dates = dates[dates != numpy.datetime64('2011-09-01')]
+        self.prices = 1000. + numpy.arange(len(self.dates), dtype=float)
+
+        self.csv_file = os.path.join(self.tmpdir, 'TEST.csv')
+        with open(self.csv_file, 'w') as fp:
+            fp.write('Date,Open,Adj Close\n')
+            for date, price in reversed(list(zip(self.dates, self.prices))):
+                fp.write('{},0,{}\n'.format(date, price))
+        self.npy_file = os.path.join(self.tmpdir, 'TEST.npy')
+        data = numpy.empty(len(self.dates),
+                           dtype=[('date', 'M8[D]'), ('price', 'f8')])
+        data['date'] = self.dates
+        data['price'] = self.prices
+        numpy.save(self.npy_file, data)
+
+    def test_load(self):
+        for path in (self.csv_file,
+                     os.path.join(self.tmpdir, '{index}.npy')):
+            source = LocalPriceSource(path)
+            dates, prices = source.load(
+                'TEST', datetime(2011, 8, 30), datetime(2011, 9, 5))
+            self.assertEqual(
+                list(dates),
+                list(numpy.array(['2011-08-30', '2011-08-31', '2011-09-02',
+                                  '2011-09-05'], dtype='datetime64[D]')))
+            start = list(self.dates).index(dates[0])
+            self.assertEqual(list(prices), list(self.prices[start:start + 4]))
+
+    def test_validator_offline(self):
+        source = CountingPriceSource(self.csv_file)
+        validator = CapeValidator(
+            'pe_data.csv', datetime(2011, 8, 1), [25., 20.1],
+            end_date=datetime(2011, 11, 15), index='TEST',
+            price_source=source, pe_cache=False, cache_dir=self.tmpdir)
+        validator.calculate_worth_vs_time()
+        self.assertEqual(len(source.calls), 1)
+        # stepping back over the holiday is a cache hit on the day before
+        self.assertEqual(validator.stats.counters, {
+            'cache_hits': 1, 'cache_misses': 4, 'holiday_fallbacks': 1})
+        self.assertEqual(validator.stats.peak_matrix_bytes, 3 * 2 * 4 * 8)
+        for phase in ('load_pe_data', 'load_index_cache', 'fetch_prices',
+                      'price_lookup', 'simulate', 'save_index_cache'):
+            self.assertIn(phase, validator.stats.timings)
+
+        dates = list(self.dates)
+        expected = [
+            self.prices[dates.index(numpy.datetime64('2011-08-01'))],
+            self.prices[dates.index(numpy.datetime64('2011-08-31'))],
+            self.prices[dates.index(numpy.datetime64('2011-10-03'))],
+            self.prices[dates.index(numpy.datetime64('2011-11-01'))],
+        ]
+        # investor 1 always buys, so its shares reveal the prices used
+        shares = numpy.cumsum(
+            [12000. / expected[0]] + [2000. / p for p in expected[1:]])
+        for val1, val2 in zip(validator.shares_matrix[0], shares):
+            self.assertAlmostEqual(val1, val2)
+        self.assertTrue(numpy.isnan(
+            validator.index_cache[datetime(2011, 9, 1)]))
+
+        # everything is cached now, so prices are not loaded again
+        validator.calculate_worth_vs_time()
+        self.assertEqual(len(source.calls), 1)
+        self.assertEqual(validator.stats.counters['cache_hits'], 6)
+        self.assertEqual(validator.stats.counters['holiday_fallbacks'], 2)
+        self.assertEqual(
+            validator._get_market_price(datetime(2011, 9, 1)), expected[1])
+        self.assertEqual(len(source.calls), 1)
+
+    def test_partial_response(self):
+        validator = CapeValidator.__new__(CapeValidator)
+        validator.index_cache = {}
+        # nothing returned: no day is known to be a holiday
+        validator._cache_prices(datetime(2011, 8, 1), datetime(2011, 8, 31),
+                                self.dates[:0], self.prices[:0])
+        self.assertEqual(validator.index_cache, {})
+        # only days between the first and last price are marked holidays
+        days = numpy.array(['2011-08-03', '2011-08-05'],
+                           dtype='datetime64[D]')
+        validator._cache_prices(datetime(2011, 8, 1), datetime(2011, 8, 31),
+                                days, numpy.array([1., 2.]))
+        self.assertEqual(sorted(validator.index_cache), [
+            datetime(2011, 8, 3), datetime(2011, 8, 4),
+            datetime(2011, 8, 5)])
+        self.assertTrue(numpy.isnan(
+            validator.index_cache[datetime(2011, 8, 4)]))
+
+    def test_calculate_daily(self):
+        source = CountingPriceSource(self.csv_file)
+        validator = CapeValidator(
+            'pe_data.csv', datetime(2011, 8, 1), [25., 0.],
+            end_date=datetime(2011, 11, 15), index='TEST',
+            price_source=source, pe_cache=False, cache_dir=self.tmpdir)
+        output = validator.calculate_daily(output=SimulationOutput())
+        self.assertEqual(len(source.calls), 1)
+        days = validator.daily_dates
+        self.assertEqual(days[0], validator.pe_dates[0])
+        self.assertNotIn(numpy.datetime64('2011-09-01'), days)
+        self.assertEqual(output.worth.shape, (2, len(days)))
+        # three kept matrices plus the chunk buffer, all float64
+        self.assertEqual(validator.stats.peak_matrix_bytes,
+                         2 * 2 * 3 * len(days) * 8)
+        # investor 0 buys on every day of the first month, investor 1 never
+        # buys and is paid on the first trading day of each month
+        first_price = self.prices[list(self.dates).index(days[0])]
+        self.assertAlmostEqual(output.shares[0, 0], 12000. / first_price)
+        paid = numpy.diff(output.cash[1]) > 0
+        self.assertEqual(list(days[1:][paid]), list(numpy.array(
+            ['2011-09-02', '2011-10-03', '2011-11-01'],
+            dtype='datetime64[D]')))
+        self.assertEqual(output.summary.final_worth[1], 18000.)
+        self.assertEqual(output.summary.cagr[1], 0.)
+
+        # the monthly run reuses the cached prices
+        validator.calculate_worth_vs_time()
+        self.assertEqual(len(source.calls), 1)
+        self.assertEqual(validator.worth_matrix[1, -1], 18000.)
+
+
+class TestTradingCalendar(unittest.TestCase):
+    def setUp(self):
+        self.dates = numpy.array(
+            ['2011-09-02', '2011-08-31', '2011-09-01', '2011-09-05',
+             '2011-09-06'], dtype='datetime64[D]')
+        self.calendar = TradingCalendar(
+            self.dates, [2., 1., numpy.nan, numpy.nan, 4.])
+
+    def test_index_of(self):
+        calendar = self.calendar
+        self.assertEqual(list(calendar.dates), list(self.dates[[1, 0, 4]]))
+        self.assertEqual(list(calendar.closed), list(self.dates[[2, 3]]))
+        days = numpy.arange('2011-08-30', '2011-09-09',
+                            dtype='datetime64[D]')
+        self.assertEqual(list(calendar.index_of(days)),
+                         [-1, 0, 0, 1, 1, 1, 1, 2, 2, 2])
+        prices = calendar.prices_at(days)
+        self.assertTrue(numpy.isnan(prices[0]))
+        self.assertEqual(list(prices[1:]), [1., 1., 2., 2., 2., 2., 4.,
+                                            4., 4.])
+        self.assertEqual(list(calendar.holidays_skipped(days)),
+                         [-1, 0, 1, 0, 0, 0, 1, 0, -1, -1])
+        dates, prices = calendar.between(datetime(2011, 9, 1),
+                                         datetime(2011, 9, 6))
+        self.assertEqual(list(dates), list(self.dates[[0, 4]]))
+        self.assertEqual(list(prices), [2., 4.])
+
+    def test_from_cache(self):
+        cache = {datetime(2011, 9, 2): 2., datetime(2011, 9, 1): numpy.nan}
+        calendar = TradingCalendar.from_cache(cache)
+        self.assertEqual(list(calendar.prices), [2.])
+        self.assertEqual(len(TradingCalendar([], []).index_of(
+            self.dates)), 5)
+
+    def test_daily_pe(self):
+        pe_dates = numpy.array(['2011-08-01', '2011-09-01'],
+                               dtype='datetime64[D]')
+        days = numpy.array(['2011-07-29', '2011-08-01', '2011-08-16',
+                            '2011-09-30'], dtype='datetime64[D]')
+        pe = daily_pe(pe_dates, [20., 23.1], days)
+        self.assertTrue(numpy.isnan(pe[0]))
+        self.assertEqual(list(pe[1:]), [20., 20., 23.1])
+        pe = daily_pe(pe_dates, [20., 23.1], days, 'linear')
+        self.assertEqual(list(pe[1:]), [20., 21.5, 23.1])
+        self.assertRaises(ValueError, daily_pe, pe_dates, [20., 23.1],
+                          days, 'nearest')
+
+
+class TestRendering(OfflineTestCase):
+    def setUp(self):
+        super(TestRendering, self).setUp()
+
+    def test_downsample(self):
+        values = numpy.random.RandomState(5).random_sample((3, 1000))
+        columns, sampled = _downsample(values, 100)
+        self.assertEqual(sampled.shape, (3, 200))
+        self.assertTrue((numpy.diff(columns, axis=1) >= 0).all())
+        self.assertTrue((sampled.max(axis=1) == values.max(axis=1)).all())
+        self.assertTrue((sampled.min(axis=1) == values.min(axis=1)).all())
+        columns, sampled = _downsample(values[:, :150], 100)
+        self.assertTrue((sampled == values[:, :150]).all())
+
+    def test_render_files(self):
+        buys = numpy.arange(15., 27.)
+        validator = CapeValidator(
+            'pe_data.csv', datetime(2000, 1, 1), buys,
+            end_date=datetime(2014, 1, 15), index='TEST',
+            price_source=self.source, pe_cache=False, cache_dir=self.tmpdir)
+        validator.calculate_worth_vs_time()
+        for name in ('worth.png', 'worth.svg'):
+            filename = os.path.join(self.tmpdir, name)
+            fig = validator.render_worth_vs_time(filename, max_legend=5)
+            self.assertTrue(os.path.getsize(filename) > 0)
+        # one collection for all investors and a colorbar instead of a legend
+        self.assertEqual(len(fig.axes[0].collections), 1)
+        self.assertIsNone(fig.axes[0].get_legend())
+        self.assertEqual(len(fig.axes), 2)
+        fig = validator.render_worth_vs_time(max_legend=20)
+        self.assertEqual(len(fig.axes[0].get_legend().get_texts()), 12)
+        with open(os.path.join(self.tmpdir, 'worth.png'), 'rb') as fp:
+            self.assertEqual(fp.read(4), b'\x89PNG')
+
+        grid = validator.sweep(buys, buys[::2], max_workers=1)
+        filename = os.path.join(self.tmpdir, 'heatmap.png')
+        fig = grid.render_heatmap(filename)
+        self.assertTrue(os.path.getsize(filename) > 0)
+
+
+class TestMain(OfflineTestCase):
+    def setUp(self):
+        super(TestMain, self).setUp()
+        # a copy, so that the parsed pe cache is written to the tmpdir
+        shutil.copy('pe_data.csv', self.tmpdir)
+        self.common = ['--index', 'TEST', '--start_date', '01/2000',
+                       '--end_date', '01/2014', '--price_file',
+                       self.price_file, '--pe_file',
+                       self.path('pe_data.csv'), '--cache_dir', self.tmpdir]
+
+    def test_run_and_plot(self):
+        self.assertEqual(main(['run', '-t', '15,20', '--state',
+                               self.path('state'), '--stats_json',
+                               self.path('stats.json')] + self.common), 0)
+        self.assertTrue(os.path.exists(self.path('state/state.npz')))
+        with open(self.path('stats.json')) as fp:
+            self.assertIn('simulate', json.load(fp)['timings'])
+        main(['plot', '--output', self.path('worth.svg'), '--pe_output',
+              self.path('pe.png'), '--engine', 'event'] + self.common)
+        self.assertTrue(os.path.getsize(self.path('worth.svg')) > 0)
+        self.assertTrue(os.path.getsize(self.path('pe.png')) > 0)
+
+    def test_lazy_imports(self):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, capeval; print(sorted(set(sys.modules) & '
+            '{"matplotlib", "pandas", "asyncio"}))'],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_run_indices(self):
+        write_price_file(self.path('TEST2.csv'), seed=1)
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            self.assertEqual(main(['run', '-t', '15,20'] + self.common[2:] +
+                                  ['--index', 'TEST,TEST2']), 0)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(lines[0], 'index,buy_at,sell_at,final_worth')
+        self.assertEqual([line.split(',')[0] for line in lines[1:]],
+                         ['TEST', 'TEST', 'TEST2', 'TEST2'])
+
+    def test_single_index_options(self):
+        multi = self.common[2:] + ['--index', 'TEST,TEST2']
+        for argv in (['plot'], ['sweep'], ['rolling'], ['optimize'],
+                     ['monte_carlo'], ['serve'], ['run', '--engine', 'event'],
+                     ['run', '--state', self.path('state')],
+                     ['run', '--output_dir', self.path('out')],
+                     ['run', '--outputs', ''], ['run', '--float32'],
+                     ['run', '--daily', 'ffill'],
+                     ['run', '--result_cache', self.path('cache')]):
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                with self.assertRaises(SystemExit):
+                    main(argv + multi)
+            self.assertRegex(stderr.getvalue(),
+                             'single --index|several indices')
+        self.assertFalse(os.path.exists(self.path('state')))
+
+    def test_output_options(self):
+        for given in (['--engine', 'event'], ['--state', self.path('state')],
+                      ['--result_cache', self.path('cache')]):
+            for output in (['--output_dir', self.path('out')],
+                           ['--outputs', ''], ['--float32'],
+                           ['--daily', 'linear']):
+                with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                    with self.assertRaises(SystemExit):
+                        main(['run'] + given + output + self.common)
+                self.assertIn('{} can not be used with {}'.format(
+                    given[0], output[0]), stderr.getvalue())
+        for name in ('state', 'cache', 'out'):
+            self.assertFalse(os.path.exists(self.path(name)))
+
+    def test_daily_engine(self):
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit):
+                main(['run', '--daily', 'ffill', '--engine', 'event'] +
+                     self.common)
+        self.assertIn('--engine can not be used with --daily',
+                      stderr.getvalue())
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            main(['run', '--daily', 'ffill', '--engine', 'step'] +
+                 self.common)
+        self.assertTrue(stdout.getvalue().startswith('buy_at,sell_at,'))
+
+    def test_unused_options(self):
+        sharded = ['sharded_sweep', '--sweep_dir', self.path('sweep')]
+        for argv in (['serve', '--fetch_concurrency', '8'],
+                     ['serve', '--result_cache', self.path('cache')],
+                     ['serve', '-t', '15'],
+                     ['serve', '--sell_thresholds', '20'],
+                     sharded + ['--fetch_concurrency', '8'],
+                     sharded + ['--result_cache', self.path('cache')],
+                     sharded + ['-t', '15'],
+                     sharded + ['--sell_thresholds', '20']):
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                with self.assertRaises(SystemExit):
+                    main(argv + self.common)
+            self.assertIn('unrecognized arguments: ' + argv[-2],
+                          stderr.getvalue())
+        self.assertFalse(os.path.exists(self.path('sweep')))
+
+    def test_sweep(self):
+        main(['sweep', '--buy_range', '15:25:5', '--sell_range', '20,30',
+              '--workers', '1', '--output', self.path('grid.npz'),
+              '--heatmap_output', self.path('grid.png')] + self.common)
+        grid = ThresholdGrid.load(self.path('grid.npz'))
+        self.assertEqual(grid.worth.shape, (3, 2))
+        self.assertTrue(os.path.exists(self.path('grid.png')))
+
+    def test_optimize(self):
+        self.assertEqual(main(['optimize', '--objective', 'cagr',
+                               '--coarse', '4', '--stats_json',
+                               self.path('stats.json')] + self.common), 0)
+        with open(self.path('stats.json')) as fp:
+            self.assertIn('optimize', json.load(fp)['timings'])
+
+
 if __name__ == '__main__':
     unittest.main()